@@ -8,10 +8,18 @@ from llama_index.core.schema import NodeWithScore
 from llama_index.core.retrievers import (
     BaseRetriever,
     VectorIndexRetriever,
-    KeywordTableSimpleRetriever,
 )
+from llama_index.core.vector_stores.types import VectorStoreQueryResult
 
-from typing import List
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from query_batcher import get_query_batcher
+from tracing import bind_context, span
+
+# Shared pool that runs the vector and keyword retrievers side by side
+_retrieval_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval")
 
 class CustomRetriever(BaseRetriever):
     """Custom retriever that performs both semantic search and hybrid search."""
@@ -19,34 +27,179 @@ class CustomRetriever(BaseRetriever):
     def __init__(
         self,
         vector_retriever: VectorIndexRetriever,
-        keyword_retriever: KeywordTableSimpleRetriever,
+        keyword_retriever: BaseRetriever,
         mode: str = "AND",
+        top_k: Optional[int] = None,
+        rrf_k: int = 60,
+        vector_weight: float = 0.5,
     ) -> None:
-        """Init params."""
+        """Init params.
+
+        Modes:
+            AND: nodes found by both retrievers.
+            OR: nodes found by either retriever.
+            RRF: reciprocal-rank fusion, score = sum of 1 / (rrf_k + rank) over both lists.
+            WEIGHTED: min-max normalized scores, combined as
+                vector_weight * vector + (1 - vector_weight) * keyword.
+
+        Results are ordered by fused score (RRF/WEIGHTED) or by rank in the vector then
+        keyword results (AND/OR), and cut to top_k if it is set.
+        """
 
         self._vector_retriever = vector_retriever
         self._keyword_retriever = keyword_retriever
-        if mode not in ("AND", "OR"):
+        if mode not in ("AND", "OR", "RRF", "WEIGHTED"):
             raise ValueError("Invalid mode.")
         self._mode = mode
+        self._top_k = top_k
+        self._rrf_k = rrf_k
+        self._vector_weight = vector_weight
         super().__init__()
 
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
         """Retrieve nodes given query."""
 
-        vector_nodes = self._vector_retriever.retrieve(query_bundle)
-        keyword_nodes = self._keyword_retriever.retrieve(query_bundle)
+        # Run both sub-retrievals concurrently; latency is that of the slower one
+        vector_future = _retrieval_pool.submit(bind_context(self._vector_retrieve, query_bundle))
+        keyword_nodes = self._keyword_retrieve(query_bundle)
+        vector_nodes = vector_future.result()
+
+        return self._combine(vector_nodes, keyword_nodes)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Asynchronously retrieve nodes given query."""
+
+        # Both retrievers do CPU-bound work, so run them on the pool rather than the event loop
+        loop = asyncio.get_running_loop()
+        vector_nodes, keyword_nodes = await asyncio.gather(
+            loop.run_in_executor(_retrieval_pool, bind_context(self._vector_retrieve, query_bundle)),
+            loop.run_in_executor(_retrieval_pool, bind_context(self._keyword_retrieve, query_bundle)),
+        )
+        return self._combine(vector_nodes, keyword_nodes)
+
+    def _vector_retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Embed the query (unless already embedded) and run the vector search, timing each."""
+
+        batcher = get_query_batcher()
+        if batcher is not None and self._can_batch(query_bundle):
+            return self._batched_vector_retrieve(batcher, query_bundle)
+
+        if query_bundle.embedding is None and hasattr(self._vector_retriever, "_embed_model"):
+            with span("embed_query"):
+                query_bundle.embedding = self._vector_retriever._embed_model.get_agg_embedding_from_queries(
+                    query_bundle.embedding_strs
+                )
+        with span("vector_search") as record:
+            nodes = self._vector_retriever.retrieve(query_bundle)
+            record["candidates"] = len(nodes)
+        return nodes
+
+    def _can_batch(self, query_bundle: QueryBundle) -> bool:
+        """Whether the vector search is a plain top-k over a store that supports batched search."""
+
+        retriever = self._vector_retriever
+        return (
+            hasattr(getattr(retriever, "_vector_store", None), "search_batch")
+            and hasattr(retriever, "_embed_model")
+            and len(query_bundle.embedding_strs) == 1
+            and getattr(retriever, "_filters", None) is None
+            and getattr(retriever, "_node_ids", None) is None
+            and getattr(retriever, "_doc_ids", None) is None
+        )
+
+    def _batched_vector_retrieve(self, batcher, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Embed and search together with the queries of concurrent requests."""
 
-        vector_ids = {n.node.node_id for n in vector_nodes}
-        keyword_ids = {n.node.node_id for n in keyword_nodes}
+        retriever = self._vector_retriever
+        store = retriever._vector_store
+        with span("vector_search") as record:
+            result = batcher.search(
+                retriever._embed_model,
+                store,
+                query_bundle.embedding_strs[0],
+                retriever._similarity_top_k,
+                nprobe=store.nprobe,
+                embedding=query_bundle.embedding,
+            )
+            query_bundle.embedding = result["embedding"]
+            nodes = retriever._build_node_list_from_query_result(
+                VectorStoreQueryResult(ids=result["ids"], similarities=result["similarities"])
+            )
+            record.update(
+                candidates=len(nodes),
+                batch_size=result["batch_size"],
+                wait_ms=result["wait_ms"],
+                embed_ms=result["embed_ms"],
+            )
+        return nodes
 
-        combined_dict = {n.node.node_id: n for n in vector_nodes}
-        combined_dict.update({n.node.node_id: n for n in keyword_nodes})
+    def _keyword_retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with span("keyword_search") as record:
+            nodes = self._keyword_retriever.retrieve(query_bundle)
+            record["candidates"] = len(nodes)
+        return nodes
 
-        if self._mode == "AND":
-            retrieve_ids = vector_ids.intersection(keyword_ids)
+    def _combine(self, vector_nodes: List[NodeWithScore], keyword_nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        """Merge the two result lists according to the retriever's mode."""
+
+        with span("merge", mode=self._mode) as record:
+            nodes = self._merge(vector_nodes, keyword_nodes)
+            record["candidates"] = len(nodes)
+        return nodes
+
+    def _merge(self, vector_nodes: List[NodeWithScore], keyword_nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+
+        if self._mode == "RRF":
+            retrieve_nodes = self._fuse(vector_nodes, keyword_nodes, self._rrf_scores)
+        elif self._mode == "WEIGHTED":
+            retrieve_nodes = self._fuse(vector_nodes, keyword_nodes, self._weighted_scores)
         else:
-            retrieve_ids = vector_ids.union(keyword_ids)
+            vector_ids = {n.node.node_id for n in vector_nodes}
+            keyword_ids = {n.node.node_id for n in keyword_nodes}
+
+            combined_dict = {n.node.node_id: n for n in vector_nodes}
+            combined_dict.update({n.node.node_id: n for n in keyword_nodes})
+
+            if self._mode == "AND":
+                retrieve_ids = vector_ids.intersection(keyword_ids)
+            else:
+                retrieve_ids = vector_ids.union(keyword_ids)
+
+            # Keep rank order: vector results first, then keyword-only results
+            ranked_ids = dict.fromkeys(n.node.node_id for n in vector_nodes + keyword_nodes)
+            retrieve_nodes = [combined_dict[rid] for rid in ranked_ids if rid in retrieve_ids]
+
+        if self._top_k is not None:
+            retrieve_nodes = retrieve_nodes[:self._top_k]
+        return retrieve_nodes
+
+    def _fuse(self, vector_nodes, keyword_nodes, score_fn) -> List[NodeWithScore]:
+        """Score every retrieved node with score_fn and sort by fused score."""
+
+        nodes = {n.node.node_id: n.node for n in vector_nodes + keyword_nodes}
+        scores = score_fn(vector_nodes, keyword_nodes)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return [NodeWithScore(node=nodes[node_id], score=score) for node_id, score in ranked]
+
+    def _rrf_scores(self, vector_nodes, keyword_nodes) -> dict:
+        """Reciprocal-rank fusion scores by node id."""
+
+        scores = {}
+        for results in (vector_nodes, keyword_nodes):
+            for rank, n in enumerate(results, start=1):
+                scores[n.node.node_id] = scores.get(n.node.node_id, 0.0) + 1.0 / (self._rrf_k + rank)
+        return scores
+
+    def _weighted_scores(self, vector_nodes, keyword_nodes) -> dict:
+        """Weighted sum of min-max normalized scores by node id."""
 
-        retrieve_nodes = [combined_dict[rid] for rid in retrieve_ids]
-        return retrieve_nodes
\ No newline at end of file
+        scores = {}
+        for results, weight in ((vector_nodes, self._vector_weight), (keyword_nodes, 1.0 - self._vector_weight)):
+            raw = [n.score or 0.0 for n in results]
+            if not raw:
+                continue
+            low, high = min(raw), max(raw)
+            for n, score in zip(results, raw):
+                normalized = (score - low) / (high - low) if high > low else 1.0
+                scores[n.node.node_id] = scores.get(n.node.node_id, 0.0) + weight * normalized
+        return scores
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+# Stores smaller than this are searched exactly unless an ANN index is requested explicitly
+ANN_MIN_VECTORS = 20000
+
+
+class IVFIndex:
+    """
+    Inverted-file (IVF) approximate nearest-neighbour index over a NumpyVectorStore matrix.
+
+    Rows are clustered with spherical k-means; a query scores the `nlist` centroids,
+    probes the `nprobe` closest clusters and exactly rescores only their rows.
+    Raising `nprobe` trades latency for recall. New rows are assigned to their
+    nearest centroid, so inserts do not require retraining.
+    """
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray, trained_size: int):
+        """
+        Args:
+            centroids (np.ndarray): Normalized float32 centroids, shape (nlist, dim).
+            assignments (np.ndarray): Cluster id of every matrix row.
+            trained_size (int): Number of live vectors the centroids were trained on.
+        """
+        self.centroids = centroids
+        self.assignments = np.asarray(assignments, dtype=np.int32)
+        self.trained_size = trained_size
+        self._order = None
+        self._offsets = None
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def train(
+        cls,
+        matrix: np.ndarray,
+        alive: np.ndarray = None,
+        nlist: int = None,
+        n_iter: int = 10,
+        sample_size: int = 65536,
+        seed: int = 0,
+    ):
+        """
+        Train centroids on the live rows of a matrix and assign every row.
+
+        Args:
+            matrix (np.ndarray): Normalized float32 embeddings.
+            alive (np.ndarray): Boolean mask of live rows. Default is all rows.
+            nlist (int): Number of clusters. Default is 4 * sqrt(number of live rows).
+            n_iter (int): k-means iterations. Default is 10.
+            sample_size (int): Maximum number of rows used for training. Default is 65536.
+            seed (int): Random seed for sampling and initialization.
+
+        Returns:
+            IVFIndex: The trained index.
+        """
+        live_rows = np.flatnonzero(alive) if alive is not None else np.arange(matrix.shape[0])
+        if len(live_rows) == 0:
+            raise ValueError("Cannot train an ANN index on an empty vector store.")
+        if nlist is None:
+            nlist = int(4 * np.sqrt(len(live_rows)))
+        nlist = max(1, min(nlist, len(live_rows)))
+
+        rng = np.random.default_rng(seed)
+        sample_rows = live_rows
+        if len(sample_rows) > sample_size:
+            sample_rows = np.sort(rng.choice(live_rows, sample_size, replace=False))
+        sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(n_iter):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=nlist)
+            # Re-seed empty clusters from random sample points
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        index = cls(centroids.astype(np.float32), np.zeros(0, dtype=np.int32), len(live_rows))
+        index.extend(matrix)
+        return index
+
+    def assign(self, vectors: np.ndarray, batch_size: int = 8192):
+        """Return the nearest centroid of each vector."""
+        labels = np.empty(vectors.shape[0], dtype=np.int32)
+        for start in range(0, vectors.shape[0], batch_size):
+            batch = np.asarray(vectors[start:start + batch_size], dtype=np.float32)
+            labels[start:start + batch_size] = np.argmax(batch @ self.centroids.T, axis=1)
+        return labels
+
+    def extend(self, vectors: np.ndarray):
+        """Assign newly appended matrix rows to clusters."""
+        if vectors.shape[0] == 0:
+            return
+        self.assignments = np.concatenate([self.assignments, self.assign(vectors)])
+        self._order = None
+
+    def select(self, rows: np.ndarray):
+        """Keep only the given rows, in order; used when the store compacts deleted rows."""
+        self.assignments = self.assignments[rows]
+        self._order = None
+
+    def needs_retrain(self, live_count: int, growth: float = 2.0):
+        """Return True once the store has grown or shrunk enough that the centroids are stale."""
+        return live_count > self.trained_size * growth or live_count * growth < self.trained_size
+
+    def _lists(self):
+        """Rows grouped by cluster: (order, offsets) with cluster c at order[offsets[c]:offsets[c + 1]]."""
+        if self._order is None:
+            self._order = np.argsort(self.assignments, kind="stable").astype(np.int64)
+            counts = np.bincount(self.assignments, minlength=self.nlist)
+            self._offsets = np.concatenate([[0], np.cumsum(counts)])
+        return self._order, self._offsets
+
+    def candidates(self, query_vector: np.ndarray, nprobe: int):
+        """
+        Return the rows of the nprobe clusters closest to the query.
+
+        Args:
+            query_vector (np.ndarray): Normalized float32 query embedding.
+            nprobe (int): Number of clusters to probe.
+
+        Returns:
+            np.ndarray: Candidate row indices.
+        """
+        order, offsets = self._lists()
+        nprobe = max(1, min(nprobe, self.nlist))
+        centroid_scores = self.centroids @ query_vector
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        return np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probe])
+
+    def save(self, path: str):
+        """Write the index to path atomically."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                assignments=self.assignments,
+                trained_size=np.asarray(self.trained_size),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        """Load an index written by `save`."""
+        with np.load(path) as data:
+            return cls(data["centroids"], data["assignments"], int(data["trained_size"]))
+
+
+def recall_report(store, k: int = 10, nprobe_values=(1, 2, 4, 8, 16, 32, 64), n_queries: int = 200, seed: int = 0):
+    """
+    Measure recall@k and latency of the store's ANN index against exact search.
+
+    Queries are live vectors from the store itself with a small random perturbation.
+
+    Args:
+        store (NumpyVectorStore): A store with an ANN index.
+        k (int): Number of neighbours compared. Default is 10.
+        nprobe_values (tuple): nprobe settings to evaluate.
+        n_queries (int): Number of sampled queries. Default is 200.
+        seed (int): Random seed for query sampling.
+
+    Returns:
+        dict: Exact latency and, per nprobe, mean recall@k and latency in milliseconds.
+    """
+    if store.ann is None:
+        raise ValueError("The vector store has no ANN index.")
+
+    rng = np.random.default_rng(seed)
+    live_rows = np.flatnonzero(store.alive)
+    rows = rng.choice(live_rows, min(n_queries, len(live_rows)), replace=False)
+    queries = np.asarray(store.matrix[rows], dtype=np.float32)
+    queries += rng.normal(scale=0.01, size=queries.shape).astype(np.float32)
+
+    start = time.perf_counter()
+    exact = [set(store.search(q, k, exact=True)[0]) for q in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    report = {
+        "vectors": int(len(live_rows)),
+        "nlist": store.ann.nlist,
+        "k": k,
+        "exact_ms": round(exact_ms, 3),
+        "ann": [],
+    }
+    for nprobe in nprobe_values:
+        start = time.perf_counter()
+        approx = [store.search(q, k, nprobe=nprobe)[0] for q in queries]
+        ann_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        recall = np.mean([len(truth.intersection(found)) / max(len(truth), 1) for truth, found in zip(exact, approx)])
+        report["ann"].append({"nprobe": nprobe, "recall": round(float(recall), 4), "ms": round(ann_ms, 3)})
+    return report
+
+
+if __name__ == "__main__":
+    from numpy_vector_store import NumpyVectorStore
+    from index_versions import current_index_dir
+
+    parser = argparse.ArgumentParser(description="Report ANN recall vs exact search for a user's vector index.")
+    parser.add_argument("user_id")
+    parser.add_argument("--base-dir", default="./user_data")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nlist", type=int, default=None, help="Train a temporary index with this many clusters.")
+    args = parser.parse_args()
+
+    vector_store = NumpyVectorStore.from_persist_dir(
+        os.path.join(current_index_dir(os.path.join(args.base_dir, args.user_id)), "vector_index")
+    )
+    if vector_store.ann is None or args.nlist is not None:
+        vector_store.build_ann_index(nlist=args.nlist)
+    print(json.dumps(recall_report(vector_store, k=args.k, n_queries=args.queries), indent=4))
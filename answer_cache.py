@@ -0,0 +1,205 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Any, Dict
+
+import numpy as np
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.response.schema import AsyncStreamingResponse, Response, StreamingResponse
+from llama_index.core.schema import QueryBundle
+
+from tracing import bind_context, current_trace, span
+
+
+class SemanticAnswerCache:
+    """
+    Per-user cache of answers, looked up by query embedding similarity.
+
+    A query whose normalized embedding has cosine similarity >= threshold with a
+    cached query gets that query's answer. Entries expire after ttl_seconds and
+    the least recently used entries are evicted beyond max_entries. The cache
+    remembers the index fingerprint it was filled against and empties itself
+    when the fingerprint changes.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl_seconds: float = 3600, max_entries: int = 256):
+        """
+        Args:
+            threshold (float): Minimum cosine similarity for a hit. Default is 0.95.
+            ttl_seconds (float): Lifetime of an entry in seconds. Default is 3600.
+            max_entries (int): Maximum number of cached answers. Default is 256.
+        """
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._lock = threading.Lock()
+        self._next_key = 0
+
+    def bind(self, fingerprint: str):
+        """Empty the cache if the user's indices changed since it was filled."""
+        with self._lock:
+            if fingerprint != self.fingerprint:
+                self._entries.clear()
+                self._matrix = None
+                self.fingerprint = fingerprint
+
+    def clear(self):
+        """Drop every cached answer."""
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def _expire(self, now: float):
+        expired = [key for key, (_, _, created) in self._entries.items() if now - created > self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def lookup(self, query_embedding):
+        """
+        Find a cached answer for a query embedding.
+
+        Args:
+            query_embedding (list): The query embedding.
+
+        Returns:
+            tuple: (Response, similarity) on a hit, otherwise (None, best similarity).
+        """
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+        with self._lock:
+            self._expire(time.time())
+            if not self._entries:
+                self.misses += 1
+                return None, 0.0
+            keys = list(self._entries)
+            if self._matrix is None:
+                self._matrix = np.stack([self._entries[key][0] for key in keys])
+            similarities = self._matrix @ query_vector
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                self.misses += 1
+                return None, similarity
+            self.hits += 1
+            # Matrix rows follow recency order, so restack on the next lookup
+            self._entries.move_to_end(keys[best])
+            self._matrix = None
+            return self._entries[keys[best]][1], similarity
+
+    def store(self, query_embedding, response: Response):
+        """Cache the answer to a query."""
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+        with self._lock:
+            self._entries[self._next_key] = (query_vector, response, time.time())
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def stats(self):
+        """Return hit/miss counters and the number of cached answers."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+class CachedQueryEngine(BaseQueryEngine):
+    """Query engine wrapper that answers near-duplicate questions from a SemanticAnswerCache."""
+
+    def __init__(self, query_engine: BaseQueryEngine, cache: SemanticAnswerCache, embed_model: Any) -> None:
+        """
+        Args:
+            query_engine (BaseQueryEngine): The engine that answers cache misses.
+            cache (SemanticAnswerCache): The user's answer cache.
+            embed_model (BaseEmbedding): Embedding model used by the engine's vector retriever.
+        """
+        self._query_engine = query_engine
+        self._cache = cache
+        self._embed_model = embed_model
+        super().__init__(callback_manager=query_engine.callback_manager)
+
+    @property
+    def query_engine(self):
+        return self._query_engine
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def __getattr__(self, name: str):
+        # Expose the wrapped engine's attributes (retriever, node postprocessors, ...)
+        query_engine = self.__dict__.get("_query_engine")
+        if query_engine is None or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(query_engine, name)
+
+    def _get_prompt_modules(self) -> Dict[str, Any]:
+        return {"query_engine": self._query_engine}
+
+    def _lookup(self, query_bundle: QueryBundle):
+        """Embed the query once, reuse it for retrieval, and return a cached answer if any."""
+        if query_bundle.embedding is None:
+            with span("embed_query"):
+                query_bundle.embedding = self._embed_model.get_query_embedding(query_bundle.query_str)
+        with span("answer_cache") as record:
+            cached, similarity = self._cache.lookup(query_bundle.embedding)
+            record["hit"] = cached is not None
+        trace = current_trace()
+        if trace is not None:
+            trace.attributes["cache_hit"] = cached is not None
+        if cached is None:
+            return None
+        metadata = dict(cached.metadata or {})
+        metadata["answer_cache"] = {"hit": True, "similarity": similarity}
+        return Response(response=cached.response, source_nodes=cached.source_nodes, metadata=metadata)
+
+    def _store(self, query_bundle: QueryBundle, response):
+        # Only complete answers backed by sources can be replayed
+        if isinstance(response, StreamingResponse):
+            response.response_gen = self._store_when_done(query_bundle, response, response.response_gen)
+        elif isinstance(response, AsyncStreamingResponse):
+            response.response_gen = self._astore_when_done(query_bundle, response, response.response_gen)
+        elif isinstance(response, Response) and response.response and response.source_nodes:
+            self._cache.store(query_bundle.embedding, response)
+
+    def _store_when_done(self, query_bundle: QueryBundle, response: StreamingResponse, response_gen):
+        """Pass tokens through and cache the full answer once the stream is exhausted."""
+        response_txt = ""
+        for token in response_gen:
+            response_txt += token
+            yield token
+        self._store(query_bundle, Response(response_txt, response.source_nodes, response.metadata))
+
+    async def _astore_when_done(self, query_bundle: QueryBundle, response: AsyncStreamingResponse, response_gen):
+        """Async version of `_store_when_done`."""
+        response_txt = ""
+        async for token in response_gen:
+            response_txt += token
+            yield token
+        self._store(query_bundle, Response(response_txt, response.source_nodes, response.metadata))
+
+    def _query(self, query_bundle: QueryBundle):
+        cached = self._lookup(query_bundle)
+        if cached is not None:
+            return cached
+        response = self._query_engine.query(query_bundle)
+        self._store(query_bundle, response)
+        return response
+
+    async def _aquery(self, query_bundle: QueryBundle):
+        # Embedding the query is CPU-bound, so keep it off the event loop
+        loop = asyncio.get_running_loop()
+        cached = await loop.run_in_executor(None, bind_context(self._lookup, query_bundle))
+        if cached is not None:
+            return cached
+        response = await self._query_engine.aquery(query_bundle)
+        self._store(query_bundle, response)
+        return response
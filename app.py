@@ -1,15 +1,11 @@
 import os  # Import os for checking folder existence
-from chat import initialize_query_engine
 import streamlit as st
-import pandas as pd
-import time
 import json
 from datetime import datetime
-import shutil
-from ocr import process_pdf_files_in_directory
-from document_embedder import create_and_save_user_indices
-import tempfile
-from voicebot import speak_text,recognize_audio
+from ingest_jobs import ensure_workers, get_job_queue, submit_upload
+from chat_store import get_chat_store
+from tracing import start_trace
+from index_versions import current_index_dir
 # Load users from the JSON file
 def load_users():
     try:
@@ -26,7 +22,7 @@ def get_user_folder(user_id):
     return None
 def check_user_directories(user_id: str, base_dir: str = "./user_data"):
     # Construct the paths for vector and keyword directories
-    user_dir = os.path.join(base_dir, user_id)
+    user_dir = current_index_dir(os.path.join(base_dir, user_id))
     vector_store_dir = os.path.join(user_dir, "vector_index")
     keyword_store_dir = os.path.join(user_dir, "keyword_index")
 
@@ -44,22 +40,34 @@ def check_user_directories(user_id: str, base_dir: str = "./user_data"):
             print(f"'{keyword_store_dir}' does not exist for user: {user_id}")
         return False  # One or both directories are missing
 
-# Load chat history from the JSON file
-def load_chats():
-    try:
-        if os.path.exists("chats.json") and os.path.getsize("chats.json") > 0:
-            with open("chats.json", "r") as file:
-                return json.load(file)
-        else:
-            return {}  # Return an empty dictionary if the file doesn't exist or is empty
-    except json.JSONDecodeError:
-        # In case of a corrupted JSON file, return an empty dictionary
-        return {}
-
-# Save chat history to the JSON file
-def save_chats(chat_data):
-    with open("chats.json", "w") as file:
-        json.dump(chat_data, file, indent=4)
+# Number of chat messages shown at first and added by "Show earlier messages"
+CHAT_PAGE_SIZE = 50
+
+def ask_query_engine(user_id, prompt):
+    """
+    Query the user's cached streaming engine.
+
+    The LLM stack (llama_index, the embedding model, Ollama) is imported on the
+    first question rather than at startup; the engine, embedding model and
+    Ollama client are process-wide and survive Streamlit reruns.
+    """
+    from engine_registry import get_query_engine, load_engine_options
+    query_engine = get_query_engine(user_id, **load_engine_options(user_id, streaming=True))
+    return query_engine.query(prompt)
+
+def show_latency_breakdown(trace):
+    """Show where the time of one answer went, stage by stage."""
+    record = trace.to_dict()
+    llm = record["llm"]
+    label = f"Latency: {record['total_ms'] / 1000:.2f}s"
+    if "ttft_ms" in record:
+        label += f", first token after {record['ttft_ms'] / 1000:.2f}s"
+    with st.expander(label):
+        st.caption(
+            f"{llm['calls']} LLM call(s), {llm['prompt_tokens']} prompt / {llm['completion_tokens']} completion tokens"
+            + (" (answer cache hit)" if record.get("cache_hit") else "")
+        )
+        st.dataframe(trace.breakdown(), hide_index=True)
 
 # Get current date in YYYY-MM-DD format
 def get_current_date():
@@ -69,6 +77,35 @@ def save_users(users):
     with open("users.json", "w") as file:
         json.dump(users, file, indent=4)
 
+# Maximum size of one uploaded file
+MAX_UPLOAD_BYTES = 5 * 1024 * 1024
+
+def upload_documents(user_id):
+    """Queue uploaded PDFs for background ingestion; the chat stays usable meanwhile."""
+    uploaded_files = st.file_uploader("Please upload PDFs to proceed.", type=["pdf"], accept_multiple_files=True)
+    if uploaded_files and st.button("Add to knowledge base"):
+        too_large = [f.name for f in uploaded_files if f.size > MAX_UPLOAD_BYTES]
+        if too_large:
+            st.error(f"File size exceeds the 5MB limit: {', '.join(too_large)}. Please upload smaller files.")
+            return
+        submit_upload(user_id, [(f.name, f.getvalue()) for f in uploaded_files])
+        ensure_workers()
+        st.success(f"Queued {len(uploaded_files)} file(s). The index updates in the background; no restart is needed.")
+
+@st.fragment(run_every=2)
+def show_ingestion_jobs(user_id, rerun_when_ready=False):
+    """Show the user's recent ingestion jobs, refreshed every few seconds."""
+    if rerun_when_ready and check_user_directories(user_id):
+        # The first index was just published; reload the page to show the chat
+        st.rerun()
+    jobs = get_job_queue().list_jobs(user_id, limit=5)
+    if not jobs:
+        return
+    st.subheader("Ingestion jobs")
+    for job in jobs:
+        detail = job["error"] if job["status"] == "failed" else (job["message"] or "")
+        st.progress(job["progress"], text=f"{job['description']}: {job['status']} {detail}")
+
 # Set Streamlit app title
 st.title("RAG")
 
@@ -100,15 +137,13 @@ else:
     st.sidebar.button("Logout", on_click=lambda: st.session_state.update({"logged_in": False, "user_id": None}))
     st.sidebar.success(f"Logged in as: {st.session_state.user_id}")
 
-    # Load chat history
-    chat_history = load_chats()
+    # Chat history is stored per message in SQLite; only today's latest page is read
+    chat_store = get_chat_store()
     user_id = st.session_state.user_id
     current_date = get_current_date()
 
-    if user_id not in chat_history:
-        chat_history[user_id] = {}
-    if current_date not in chat_history[user_id]:
-        chat_history[user_id][current_date] = []
+    if "chat_page_limit" not in st.session_state:
+        st.session_state.chat_page_limit = CHAT_PAGE_SIZE
 
     # Retrieve the folder name for the logged-in user
     # folder_name = get_user_folder(st.session_state.user_id)
@@ -124,66 +159,43 @@ else:
             st.header("Chat Functionality")
 
             # Display previous chat messages
-            for message in chat_history[user_id][current_date]:
+            if chat_store.count(user_id, current_date) > st.session_state.chat_page_limit:
+                if st.button("Show earlier messages"):
+                    st.session_state.chat_page_limit += CHAT_PAGE_SIZE
+            for message in chat_store.get_messages(user_id, current_date, limit=st.session_state.chat_page_limit):
                 with st.chat_message(message["role"]):
                     st.markdown(message["content"])
 
             # Input field for the user's message
             if prompt := st.chat_input("Ask something..."):
-                user_message = {"role": "user", "content": prompt}
-                chat_history[user_id][current_date].append(user_message)
+                chat_store.append(user_id, "user", prompt, current_date)
 
                 with st.chat_message("user"):
                     st.markdown(prompt)
 
                 # Generate assistant's response
                 with st.chat_message("assistant"):
+                    trace = start_trace(user_id, prompt)
                     try:
-                        start = time.time()
-                        query_engine=initialize_query_engine(user_id=user_id)
-                        assistant_reply = query_engine.query(prompt)
-                        end = time.time()
-                        
-                        assistant_message = {"role": "assistant", "content": assistant_reply.response}
-                        chat_history[user_id][current_date].append(assistant_message)
-
-                        st.markdown(assistant_reply.response)
+                        from chat import iter_response_text
+                        assistant_reply = ask_query_engine(user_id, prompt)
+
+                        # Render tokens as they are generated; the trace ends with the last token
+                        reply_text = st.write_stream(trace.iter_text(iter_response_text(assistant_reply)))
+
+                        chat_store.append(user_id, "assistant", reply_text, current_date)
+                        show_latency_breakdown(trace)
                     except Exception as e:
-                        error_message = {"role": "assistant", "content": f"Error: {e}"}
-                        chat_history[user_id][current_date].append(error_message)
+                        trace.finish(e)
+                        chat_store.append(user_id, "assistant", f"Error: {e}", current_date)
                         st.markdown(f"Sorry, I encountered an error: {e}")
 
-                # Save chat history
-                save_chats(chat_history)
-
         with tab2:
             st.header("Embeddings Check")
             st.success(f"Embeddings for '{user_id}' exists in the database!")
 
-            # Limit the file upload size to 5MB
-            uploaded_file = st.file_uploader("Please upload a PDF to proceed.", type=["pdf"])
-            
-            if uploaded_file:
-                # Check if the file size is less than or equal to 5MB
-                if uploaded_file.size <= 5 * 1024 * 1024:  # 5MB in bytes
-                    with tempfile.TemporaryDirectory() as temp_dir:
-                        temp_file_path = os.path.join(temp_dir, uploaded_file.name)
-
-                        # Save the uploaded file to the temporary directory
-                        with open(temp_file_path, "wb") as f:
-                            f.write(uploaded_file.getbuffer())
-                        st.success(f"Uploaded {uploaded_file.name} successfully!")
-
-                        # Process the uploaded file
-                        destination_dir=process_pdf_files_in_directory(user_id=user_id, source_dir=temp_dir)
-
-                        # Create indices for the processed files
-                        create_and_save_user_indices(user_id=user_id, input_dir=destination_dir)
-
-                        st.success("File processed and indices created successfully!. Please restart this platform.")
-                else:
-                    st.error("File size exceeds the 5MB limit. Please upload a smaller file.")
-                # st.rerun()
+            upload_documents(user_id)
+            show_ingestion_jobs(user_id)
         with tab3:
             st.header("Voice Chatbot")
             st.info("This tab allows you to interact with the chatbot using your voice.")
@@ -192,21 +204,36 @@ else:
             user_id = st.session_state.user_id
             if check_user_directories(user_id):
                 if st.button("Start Voice Interaction"):
-                    # Recognize audio input
-                    user_query = recognize_audio()
+                    # Audio and TTS libraries are only loaded once voice is used
+                    from voicebot import recognize_audio, SentenceSpeaker
+                    from chat import iter_response_text
+
+                    # Recognize audio input locally
+                    try:
+                        with st.spinner("Listening..."):
+                            user_query = recognize_audio()
+                    except FileNotFoundError as e:
+                        # No speech recognition model has been downloaded
+                        st.error(str(e))
+                        user_query = None
                     if user_query:
                         st.success(f"You said: {user_query}")
-                        with st.spinner("Generating response..."):
+                        trace = start_trace(user_id, user_query)
+                        try:
+                            # Reuse the cached query engine
+                            with st.spinner("Generating response..."):
+                                response = ask_query_engine(user_id, user_query)
+                            st.markdown("**Response:**")
+
+                            # Show the answer as it streams and speak each sentence as soon as it is complete
+                            speaker = SentenceSpeaker()
                             try:
-                                # Initialize query engine
-                                query_engine = initialize_query_engine(user_id=user_id)
-                                response = query_engine.query(user_query)
-                                st.markdown(f"**Response:**  {response.response}")
-                                
-                                # Speak the response
-                                speak_text(f"  {response.response}")
-                            except Exception as e:
-                                st.error(f"Error generating response: {e}")
+                                st.write_stream(speaker.tee(trace.iter_text(iter_response_text(response))))
+                            finally:
+                                speaker.close()
+                        except Exception as e:
+                            trace.finish(e)
+                            st.error(f"Error generating response: {e}")
             else:
                 st.warning("Embeddings for this user do not exist. Please upload a file in the 'Folder Check' tab to create embeddings.")
 
@@ -214,27 +241,5 @@ else:
         st.header("Embeddings Check")
         st.success(f"Embeddings for '{user_id}' exists in the database!")
         
-        # Limit the file upload size to 5MB
-        uploaded_file = st.file_uploader("Please upload a PDF to proceed.", type=["pdf"])
-        
-        if uploaded_file:
-            # Check if the file size is less than or equal to 5MB
-            if uploaded_file.size <= 5 * 1024 * 1024:  # 5MB in bytes
-                # file_path = os.path.join(os.getcwd(), uploaded_file.name)
-                with tempfile.TemporaryDirectory() as temp_dir:
-                        temp_file_path = os.path.join(temp_dir, uploaded_file.name)
-
-                        # Save the uploaded file to the temporary directory
-                        with open(temp_file_path, "wb") as f:
-                            f.write(uploaded_file.getbuffer())
-                        st.success(f"Uploaded {uploaded_file.name} successfully!")
-
-                        # Process the uploaded file
-                        destination_dir=process_pdf_files_in_directory(user_id=user_id, source_dir=temp_dir)
-
-                        # Create indices for the processed files
-                        create_and_save_user_indices(user_id=user_id, input_dir=destination_dir)
-
-                        st.success("File processed and indices created successfully!. Please restart this platform.")
-            else:
-                st.error("File size exceeds the 5MB limit. Please upload a smaller file.")
+        upload_documents(user_id)
+        show_ingestion_jobs(user_id, rerun_when_ready=True)
@@ -0,0 +1,443 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List
+
+import numpy as np
+from llama_index.core.base.llms.types import CompletionResponse, LLMMetadata
+from llama_index.core.llms import MockLLM
+from llama_index.core.llms.callbacks import llm_completion_callback
+
+from chat import initialize_query_engine
+from document_embedder import create_and_save_user_indices
+from embedding_cache import normalize_text
+from index_bundle import load_docstore
+from index_versions import current_index_dir
+from ingest_manifest import load_manifest
+from mock_ollama import mock_answer
+from models import set_llm
+from query_batcher import DEFAULT_WINDOW_MS, configure_query_batching, get_query_batcher
+from tracing import configure_trace_log, start_trace
+
+# Where results are written unless --output is given
+RESULTS_DIR = "./benchmark_results"
+
+# User id the benchmark indices are built for, inside the work directory
+BENCH_USER = "bench"
+
+# Fixed questions about the bundled documents; a node is relevant if it contains `expected`
+BENCHMARK_QUERIES = [
+    {"query": "What is the boy's name?", "expected": "Santiago"},
+    {"query": "Where did the boy spend the night with his sheep?", "expected": "abandoned church"},
+    {"query": "What did the boy do for a living?", "expected": "shepherd"},
+    {"query": "What is a Personal Legend?", "expected": "Personal Legend"},
+    {"query": "Who is the king of Salem?", "expected": "Salem"},
+    {"query": "What are Urim and Thummim?", "expected": "Urim"},
+    {"query": "What did the merchant sell in his shop?", "expected": "crystal"},
+    {"query": "Who is Fatima?", "expected": "Fatima"},
+    {"query": "Where is the treasure buried?", "expected": "Pyramids"},
+    {"query": "What does the alchemist teach the boy?", "expected": "alchemist"},
+    {"query": "What did the old woman interpret?", "expected": "dream"},
+    {"query": "What happens in the desert caravan?", "expected": "caravan"},
+]
+
+# A question answered by one fact; in context-budget mode it must take a single LLM call
+SINGLE_FACT_QUERY = BENCHMARK_QUERIES[0]["query"]
+
+
+class BenchmarkLLM(MockLLM):
+    """
+    Deterministic offline stand-in for Ollama.
+
+    Rerank prompts get a valid 'Doc: n, Relevance: r' answer ranked by word overlap
+    with the question, so LLMRerank keeps nodes as it would with a real model;
+    other prompts get the first `max_tokens` words of their context.
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "BenchmarkLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        # Same context window as the Ollama client, so prompts are packed identically
+        return LLMMetadata(context_window=3900, num_output=self.max_tokens or 64, model_name="benchmark-mock")
+
+    def _answer(self, prompt: str):
+        return mock_answer(prompt, self.max_tokens or 64)
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return CompletionResponse(text=self._answer(prompt))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        def gen():
+            text = ""
+            for word in self._answer(prompt).split(" "):
+                delta = word if not text else " " + word
+                text += delta
+                yield CompletionResponse(text=text, delta=delta)
+        return gen()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on macOS and in kilobytes elsewhere
+        return round(peak / 2**20 if sys.platform == "darwin" else peak / 2**10, 1)
+    except ImportError:
+        import psutil
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / 2**20, 1)
+
+
+def latency_stats(seconds: List[float]):
+    """Mean and p50/p95/p99 of a list of durations, in milliseconds."""
+    values = np.array(seconds) * 1000
+    return {
+        "count": len(seconds),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def known_item_queries(nodes: List[Any], n: int, seed: int, words: int = 12):
+    """
+    Sample n queries that are word windows taken from random chunks.
+
+    Each query's relevant nodes are those containing its exact text, so recall
+    can be judged on any corpus without hand-made labels.
+    """
+    rng = random.Random(seed)
+    candidates = sorted(nodes, key=lambda node: node.node_id)
+    rng.shuffle(candidates)
+    queries = []
+    for node in candidates:
+        tokens = node.get_content().split()
+        if len(tokens) < words * 2:
+            continue
+        start = rng.randrange(0, len(tokens) - words)
+        window = tokens[start:start + words]
+        # Skip windows that are mostly numbers, punctuation or extraction noise
+        if sum(token.isalpha() for token in window) < words * 2 // 3:
+            continue
+        queries.append({"query": " ".join(window), "expected": " ".join(window), "kind": "known_item"})
+        if len(queries) == n:
+            break
+    return queries
+
+
+def judge(queries: List[dict], nodes: List[Any]):
+    """Attach the ids of relevant nodes to each query and drop queries nothing in the corpus matches."""
+    texts = {node.node_id: normalize_text(node.get_content()).lower() for node in nodes}
+    judged = []
+    for query in queries:
+        expected = normalize_text(query["expected"]).lower()
+        relevant = {node_id for node_id, text in texts.items() if expected in text}
+        if relevant:
+            judged.append({**query, "relevant": relevant})
+    return judged
+
+
+def recall(results: List[List[str]], queries: List[dict]):
+    """Share of queries with at least one relevant node among their results."""
+    hits = sum(1 for ids, query in zip(results, queries) if query["relevant"] & set(ids))
+    return round(hits / len(queries), 4) if queries else None
+
+
+def bench_ingest(data_dir: str, work_dir: str, **ingest_options):
+    files = [os.path.join(root, name) for root, _, names in os.walk(data_dir) for name in names]
+    start = time.perf_counter()
+    create_and_save_user_indices(BENCH_USER, data_dir, base_dir=work_dir, incremental=False, **ingest_options)
+    seconds = time.perf_counter() - start
+
+    manifest = load_manifest(current_index_dir(os.path.join(work_dir, BENCH_USER)))
+    chunks = sum(len(entry["node_ids"]) for entry in manifest["files"].values())
+    size = sum(os.path.getsize(path) for path in files)
+    return {
+        "files": len(files),
+        "megabytes": round(size / 2**20, 3),
+        "chunks": chunks,
+        "seconds": round(seconds, 3),
+        "chunks_per_sec": round(chunks / seconds, 2),
+        "mb_per_sec": round(size / 2**20 / seconds, 3),
+    }
+
+
+def bench_retriever(retriever, queries: List[dict], k: int, warmup: int = 1):
+    for query in queries[:warmup]:
+        retriever.retrieve(query["query"])
+    seconds, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        nodes = retriever.retrieve(query["query"])
+        seconds.append(time.perf_counter() - start)
+        results.append([n.node.node_id for n in nodes[:k]])
+    return {
+        "latency": latency_stats(seconds),
+        f"recall@{k}": recall(results, queries),
+        "mean_results": round(sum(len(r) for r in results) / len(results), 2),
+    }
+
+
+def bench_under_load(retriever, queries: List[dict], concurrency: int, rounds: int = 3):
+    """
+    Throughput and latency of concurrent retrievals, without and with query batching.
+
+    Every query is made unique so its embedding is computed rather than served from the cache.
+    """
+    results = {}
+    for name, window_ms in (("unbatched", None), ("batched", DEFAULT_WINDOW_MS)):
+        configure_query_batching(window_ms)
+        work = [f"{q['query']} ({name} {i})" for i in range(rounds) for q in queries]
+        seconds = []
+
+        def run(query):
+            start = time.perf_counter()
+            retriever.retrieve(query)
+            seconds.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(run, work))
+        elapsed = time.perf_counter() - start
+        results[name] = {"queries_per_sec": round(len(work) / elapsed, 2), "latency": latency_stats(seconds)}
+        if get_query_batcher() is not None:
+            results[name]["mean_batch_size"] = get_query_batcher().stats()["mean_batch_size"]
+    configure_query_batching(None)
+    results["concurrency"] = concurrency
+    return results
+
+
+def bench_query_engine(query_engine, queries: List[dict], warmup: int = 1):
+    for query in queries[:warmup]:
+        query_engine.query(query["query"])
+    seconds, results, llm_calls, prompt_tokens = [], [], [], []
+    for query in queries:
+        trace = start_trace(BENCH_USER, query["query"])
+        start = time.perf_counter()
+        response = query_engine.query(query["query"])
+        seconds.append(time.perf_counter() - start)
+        trace.finish()
+        totals = trace.llm_totals()
+        llm_calls.append(totals["calls"])
+        prompt_tokens.append(totals["prompt_tokens"])
+        results.append([n.node.node_id for n in response.source_nodes])
+    return {
+        "latency": latency_stats(seconds),
+        "source_recall": recall(results, queries),
+        "mean_llm_calls": round(float(np.mean(llm_calls)), 3),
+        "mean_prompt_tokens": round(float(np.mean(prompt_tokens)), 1),
+    }
+
+
+def single_fact_llm_calls(query_engine, query: str = SINGLE_FACT_QUERY):
+    """Return the LLM calls made answering a question about one fact."""
+    trace = start_trace(BENCH_USER, query)
+    query_engine.query(query)
+    trace.finish()
+    return trace.llm_totals()["calls"]
+
+
+def run_benchmark(
+    data_dir: str = "./data",
+    work_dir: str = None,
+    queries: List[dict] = None,
+    known_items: int = 50,
+    k: int = 5,
+    modes=("AND", "OR", "RRF"),
+    reranker: str = None,
+    seed: int = 0,
+    embed_backend: str = "torch",
+    context_budget: int = None,
+    concurrency: int = 8,
+):
+    """
+    Build indices from data_dir and time ingestion, index loading, retrieval and full queries.
+
+    Ollama is replaced by BenchmarkLLM, so results are deterministic and the run
+    is offline; query latency is the pipeline's own overhead, without generation time.
+
+    Args:
+        data_dir (str): Documents to index. Default is './data'.
+        work_dir (str): Where indices are built; a fresh temporary directory by default so
+            the embedding cache starts empty.
+        queries (List[dict]): {"query", "expected"} items. Default is BENCHMARK_QUERIES.
+        known_items (int): Known-item queries sampled from the corpus in addition. Default is 50.
+        k (int): Cut-off for recall@k. Default is 5.
+        modes: CustomRetriever modes to measure. Default is AND, OR and RRF.
+        reranker (str): Reranker of the full query engine. Default is the engine's: 'llm',
+            or 'similarity' with context_budget.
+        seed (int): Seed of the known-item sample. Default is 0.
+        embed_backend (str): Embedding backend used for ingestion. Default is 'torch'.
+        context_budget (int): Context budget of the full query engine. Default is None (off).
+        concurrency (int): Threads of the retrieval load test (RRF mode). Default is 8; 0 skips it.
+
+    Returns:
+        dict: The results.
+    """
+    set_llm(BenchmarkLLM(max_tokens=64))
+    # Traces are only used to count LLM calls; keep them out of the server's trace log
+    configure_trace_log(None)
+    own_work_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="rag-bench-")
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "data_dir": os.path.abspath(data_dir),
+            "k": k,
+            "seed": seed,
+            "reranker": reranker,
+            "embed_backend": embed_backend,
+            "context_budget": context_budget,
+            "concurrency": concurrency,
+        },
+    }
+    try:
+        results["ingest"] = bench_ingest(data_dir, work_dir, embed_backend=embed_backend)
+        results["peak_rss_mb_after_ingest"] = peak_rss_mb()
+
+        index_dir = current_index_dir(os.path.join(work_dir, BENCH_USER))
+        nodes = list(load_docstore(index_dir).docs.values())
+        fixed = judge(queries if queries is not None else BENCHMARK_QUERIES, nodes)
+        generated = judge(known_item_queries(nodes, known_items, seed), nodes)
+        results["queries"] = {"fixed": len(fixed), "known_item": len(generated)}
+        all_queries = fixed + generated
+
+        results["load"] = {}
+        results["retrieval"] = {}
+        for mode in modes:
+            start = time.perf_counter()
+            engine = initialize_query_engine(
+                BENCH_USER, base_dir=work_dir, retriever_mode=mode, fusion_top_k=k,
+                similarity_top_k=k, keyword_top_k=k, reranker="none",
+            )
+            results["load"][mode] = {"seconds": round(time.perf_counter() - start, 3)}
+            retriever = engine.retriever
+            results["retrieval"][mode] = {
+                "all": bench_retriever(retriever, all_queries, k),
+                "fixed": bench_retriever(retriever, fixed, k, warmup=0) if fixed else None,
+                "known_item": bench_retriever(retriever, generated, k, warmup=0) if generated else None,
+            }
+            if mode == "RRF" and concurrency:
+                results["retrieval_under_load"] = bench_under_load(retriever, all_queries, concurrency)
+
+        engine = initialize_query_engine(
+            BENCH_USER, base_dir=work_dir, reranker=reranker, rerank_top_n=k, context_budget=context_budget
+        )
+        results["query_engine"] = bench_query_engine(engine, all_queries)
+        # An LLM reranker costs a call of its own whenever the budget cuts the candidates
+        if context_budget and reranker != "llm":
+            calls = single_fact_llm_calls(engine)
+            results["query_engine"]["single_fact_llm_calls"] = calls
+            assert calls == 1, f"A single-fact query made {calls} LLM calls in context-budget mode, expected 1"
+        results["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        if own_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def flatten(results: dict, prefix: str = ""):
+    """Numeric leaves of a results dict keyed by dotted path, for comparisons."""
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if key == "meta":
+            continue
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(baseline: dict, current: dict):
+    """Print every metric of both runs with its relative change."""
+    old, new = flatten(baseline), flatten(current)
+    print(f"Comparing {baseline['meta'].get('commit')} -> {current['meta'].get('commit')}")
+    for path in sorted(set(old) | set(new)):
+        before, after = old.get(path), new.get(path)
+        change = ""
+        if before not in (None, 0) and after is not None:
+            change = f"{(after - before) / before * 100:+.1f}%"
+        print(f"{path:60} {before!s:>12} {after!s:>12} {change:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline retrieval and end-to-end benchmark.")
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--work-dir", default=None, help="Keep the built indices here (default: temporary).")
+    parser.add_argument("--queries", default=None, help="JSON list of {\"query\", \"expected\"} items.")
+    parser.add_argument("--known-items", type=int, default=50)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--modes", default="AND,OR,RRF")
+    parser.add_argument("--reranker", default=None, help="Default: 'llm', or 'similarity' with --context-budget.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--embed-backend", default="torch")
+    parser.add_argument("--context-budget", type=int, default=None)
+    parser.add_argument("--concurrency", type=int, default=8, help="Threads of the retrieval load test; 0 skips it.")
+    parser.add_argument("--output", default=None, help="Results file (default: benchmark_results/<time>-<commit>.json).")
+    parser.add_argument("--compare", default=None, help="Earlier results file to compare against.")
+    args = parser.parse_args()
+
+    queries = None
+    if args.queries:
+        with open(args.queries, "r") as f:
+            queries = json.load(f)
+
+    results = run_benchmark(
+        data_dir=args.data_dir,
+        work_dir=args.work_dir,
+        queries=queries,
+        known_items=args.known_items,
+        k=args.k,
+        modes=tuple(args.modes.split(",")),
+        reranker=args.reranker,
+        seed=args.seed,
+        embed_backend=args.embed_backend,
+        context_budget=args.context_budget,
+        concurrency=args.concurrency,
+    )
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{results['meta']['commit'] or 'nogit'}.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps({key: value for key, value in results.items() if key != "meta"}, indent=2))
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), results)
@@ -0,0 +1,325 @@
+import os
+import re
+import json
+import math
+import unicodedata
+from collections import Counter
+from typing import List
+
+import numpy as np
+from llama_index.core import QueryBundle
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore
+
+# Files written inside a keyword index directory
+META_FILENAME = "bm25_meta.json"
+ARRAY_FILENAMES = {
+    "postings": "bm25_postings.npy",
+    "term_freqs": "bm25_term_freqs.npy",
+    "offsets": "bm25_offsets.npy",
+    "doc_lengths": "bm25_doc_lengths.npy",
+}
+BM25_FORMAT_VERSION = 1
+
+STOPWORDS = frozenset(
+    """a about above after again against all am an and any are as at be because been before being below
+    between both but by can could did do does doing down during each few for from further had has have
+    having he her here hers herself him himself his how i if in into is it its itself just me more most my
+    myself no nor not now of off on once only or other our ours ourselves out over own same she should so
+    some such than that the their theirs them themselves then there these they this those through to too
+    under until up very was we were what when where which while who whom why will with would you your
+    yours yourself yourselves""".split()
+)
+
+# Version of `tokenize` stored with each index; indices built by version 1 only kept ASCII
+TOKENIZER_VERSION = 2
+
+
+def _mark_ranges():
+    """Character class ranges of the combining marks, e.g. Devanagari and Bengali vowel signs."""
+    ranges, start = [], None
+    for code in range(0x10000):
+        is_mark = unicodedata.category(chr(code)).startswith("M")
+        if is_mark and start is None:
+            start = code
+        elif not is_mark and start is not None:
+            ranges.append(f"{re.escape(chr(start))}-{re.escape(chr(code - 1))}")
+            start = None
+    return "".join(ranges)
+
+
+# Scripts written without spaces between words; each of their characters is a token
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+TOKEN_PATTERN = re.compile(f"[{_CJK}]|(?:(?![{_CJK}])[^\\W_]|[{_mark_ranges()}])+")
+_CJK_CHAR = re.compile(f"[{_CJK}]")
+_LEGACY_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str):
+    """
+    Case-fold and split into words of any script, dropping stopwords and single letters.
+
+    Combining marks stay inside their word, and CJK text, which has no spaces
+    between words, is split into single characters, which are kept.
+    """
+    return [
+        token for token in TOKEN_PATTERN.findall(text.casefold())
+        if (len(token) > 1 or _CJK_CHAR.match(token)) and token not in STOPWORDS
+    ]
+
+
+def _legacy_tokenize(text: str):
+    """The ASCII-only tokenizer of version 1 indices, used to query them until they are rebuilt."""
+    return [token for token in _LEGACY_TOKEN_PATTERN.findall(text.lower()) if len(token) > 1 and token not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    Compact inverted index with BM25 scoring.
+
+    Postings are stored per term as delta-encoded uint32 document numbers with
+    uint16 term frequencies in flat arrays, addressed through an offsets array,
+    and memory-mapped on load. Documents added after loading live in a small
+    in-memory segment and deletions are tombstones; both are merged into the
+    flat arrays by `persist`.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        """
+        Args:
+            k1 (float): BM25 term frequency saturation. Default is 1.2.
+            b (float): BM25 length normalization. Default is 0.75.
+        """
+        self.k1 = k1
+        self.b = b
+        self.vocab = {}
+        self.doc_ids = []
+        self.postings = np.zeros(0, dtype=np.uint32)
+        self.term_freqs = np.zeros(0, dtype=np.uint16)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.doc_lengths = np.zeros(0, dtype=np.uint32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._doc_number = {}
+        self._delta = {}
+        self.tokenizer_version = TOKENIZER_VERSION
+
+    def _tokenize(self, text: str):
+        return tokenize(text) if self.tokenizer_version == TOKENIZER_VERSION else _legacy_tokenize(text)
+
+    @classmethod
+    def exists(cls, persist_dir: str):
+        """Return True if a BM25 index has been persisted in persist_dir."""
+        return os.path.exists(os.path.join(persist_dir, META_FILENAME))
+
+    @classmethod
+    def load(cls, persist_dir: str, mmap: bool = True):
+        """
+        Load a persisted index.
+
+        Args:
+            persist_dir (str): The keyword index directory.
+            mmap (bool): Memory-map the postings arrays instead of reading them. Default is True.
+
+        Returns:
+            BM25Index: The loaded index.
+        """
+        with open(os.path.join(persist_dir, META_FILENAME), "r") as f:
+            meta = json.load(f)
+        if meta["version"] != BM25_FORMAT_VERSION:
+            raise ValueError(f"Unsupported BM25 index version: {meta['version']}")
+
+        index = cls(k1=meta["k1"], b=meta["b"])
+        index.vocab = {term: term_id for term_id, term in enumerate(meta["terms"])}
+        index.doc_ids = meta["doc_ids"]
+        index.tokenizer_version = meta.get("tokenizer", 1)
+        for name, filename in ARRAY_FILENAMES.items():
+            setattr(index, name, np.load(os.path.join(persist_dir, filename), mmap_mode="r" if mmap else None))
+        if len(index.doc_lengths) != len(index.doc_ids) or len(index.offsets) != len(index.vocab) + 1:
+            raise ValueError(f"BM25 index at '{persist_dir}' is inconsistent.")
+        index._alive = np.ones(len(index.doc_ids), dtype=bool)
+        index._doc_number = {doc_id: number for number, doc_id in enumerate(index.doc_ids)}
+        return index
+
+    def count(self):
+        """Return the number of live documents."""
+        return int(self._alive.sum())
+
+    def insert_nodes(self, nodes):
+        """
+        Index nodes by their text content; a node id that is already indexed is replaced.
+
+        Args:
+            nodes (list): llama_index nodes to add. Of nodes sharing an id, the last one is kept.
+        """
+        lengths = []
+        # Rows are only added after the loop, so each id may appear once in it
+        nodes = {node.node_id: node for node in nodes}.values()
+        for node in nodes:
+            self.delete_nodes([node.node_id])
+            tokens = self._tokenize(node.get_content())
+            number = len(self.doc_ids)
+            self.doc_ids.append(node.node_id)
+            self._doc_number[node.node_id] = number
+            lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                self._delta.setdefault(term, []).append((number, min(tf, 65535)))
+        if lengths:
+            self.doc_lengths = np.concatenate([self.doc_lengths, np.asarray(lengths, dtype=np.uint32)])
+            self._alive = np.concatenate([self._alive, np.ones(len(lengths), dtype=bool)])
+
+    def delete_nodes(self, node_ids: List[str]):
+        """Remove nodes from the index."""
+        for node_id in node_ids:
+            number = self._doc_number.pop(node_id, None)
+            if number is not None:
+                self._alive[number] = False
+
+    def _term_postings(self, term: str):
+        """Return (doc numbers, term frequencies) for a term across the flat arrays and the delta segment."""
+        docs = [np.zeros(0, dtype=np.int64)]
+        tfs = [np.zeros(0, dtype=np.float32)]
+        term_id = self.vocab.get(term)
+        if term_id is not None:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs.append(np.cumsum(self.postings[start:end], dtype=np.int64))
+            tfs.append(np.asarray(self.term_freqs[start:end], dtype=np.float32))
+        if term in self._delta:
+            delta = np.asarray(self._delta[term], dtype=np.int64)
+            docs.append(delta[:, 0])
+            tfs.append(delta[:, 1].astype(np.float32))
+        docs = np.concatenate(docs)
+        tfs = np.concatenate(tfs)
+        keep = self._alive[docs]
+        return docs[keep], tfs[keep]
+
+    def search(self, query: str, top_k: int = 10):
+        """
+        Score live documents against a query with BM25.
+
+        Args:
+            query (str): The query text.
+            top_k (int): Maximum number of results. Default is 10.
+
+        Returns:
+            list: (node id, score) pairs, best first.
+        """
+        n_docs = self.count()
+        if n_docs == 0:
+            return []
+        lengths = self.doc_lengths.astype(np.float32)
+        avg_length = float(lengths[self._alive].mean()) or 1.0
+        norm = self.k1 * (1 - self.b + self.b * lengths / avg_length)
+
+        scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+        for term in set(self._tokenize(query)):
+            docs, tfs = self._term_postings(term)
+            if len(docs) == 0:
+                continue
+            idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm[docs])
+
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) == 0:
+            return []
+        k = min(top_k, len(matched))
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(self.doc_ids[number], float(scores[number])) for number in top]
+
+    def persist(self, persist_dir: str):
+        """
+        Merge the delta segment and drop deleted documents, then write the index.
+
+        Array files are written under temporary names and renamed into place; the
+        metadata file is renamed last, so a reader never loads a half-written index.
+        """
+        os.makedirs(persist_dir, exist_ok=True)
+
+        # Renumber live documents densely
+        live = np.flatnonzero(self._alive)
+        renumber = np.full(len(self.doc_ids), -1, dtype=np.int64)
+        renumber[live] = np.arange(len(live))
+        doc_ids = [self.doc_ids[number] for number in live]
+        doc_lengths = np.ascontiguousarray(self.doc_lengths[live], dtype=np.uint32)
+
+        # Collect live (term, doc, tf) triples from both segments
+        terms = sorted(set(self.vocab) | set(self._delta))
+        term_rows, doc_rows, tf_rows = [], [], []
+        for term_id, term in enumerate(terms):
+            docs, tfs = self._term_postings(term)
+            term_rows.append(np.full(len(docs), term_id, dtype=np.int64))
+            doc_rows.append(renumber[docs])
+            tf_rows.append(tfs)
+        term_rows = np.concatenate(term_rows) if terms else np.zeros(0, dtype=np.int64)
+        doc_rows = np.concatenate(doc_rows) if terms else np.zeros(0, dtype=np.int64)
+        tf_rows = np.concatenate(tf_rows) if terms else np.zeros(0, dtype=np.float32)
+
+        # Drop terms with no live postings, then sort by (term, doc) and delta-encode
+        counts = np.bincount(term_rows, minlength=len(terms))
+        kept_terms = np.flatnonzero(counts)
+        term_remap = np.full(len(terms), -1, dtype=np.int64)
+        term_remap[kept_terms] = np.arange(len(kept_terms))
+        term_rows = term_remap[term_rows]
+        order = np.lexsort((doc_rows, term_rows))
+        term_rows, doc_rows, tf_rows = term_rows[order], doc_rows[order], tf_rows[order]
+
+        offsets = np.zeros(len(kept_terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts[kept_terms])
+        deltas = np.diff(doc_rows, prepend=0)
+        deltas[offsets[:-1]] = doc_rows[offsets[:-1]]
+
+        arrays = {
+            "postings": deltas.astype(np.uint32),
+            "term_freqs": tf_rows.astype(np.uint16),
+            "offsets": offsets,
+            "doc_lengths": doc_lengths,
+        }
+        for name, filename in ARRAY_FILENAMES.items():
+            path = os.path.join(persist_dir, filename)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, arrays[name])
+            os.replace(path + ".tmp", path)
+
+        meta = {
+            "version": BM25_FORMAT_VERSION,
+            "tokenizer": self.tokenizer_version,
+            "k1": self.k1,
+            "b": self.b,
+            "terms": [terms[term_id] for term_id in kept_terms],
+            "doc_ids": doc_ids,
+        }
+        meta_path = os.path.join(persist_dir, META_FILENAME)
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+        # Continue from the compacted state
+        self.vocab = {term: term_id for term_id, term in enumerate(meta["terms"])}
+        self.doc_ids = doc_ids
+        self.postings, self.term_freqs = arrays["postings"], arrays["term_freqs"]
+        self.offsets, self.doc_lengths = offsets, doc_lengths
+        self._alive = np.ones(len(doc_ids), dtype=bool)
+        self._doc_number = {doc_id: number for number, doc_id in enumerate(doc_ids)}
+        self._delta = {}
+
+
+class BM25Retriever(BaseRetriever):
+    """Keyword retriever returning the top k nodes of a BM25Index, ranked by score."""
+
+    def __init__(self, index: BM25Index, docstore, similarity_top_k: int = 10) -> None:
+        """
+        Args:
+            index (BM25Index): The user's BM25 index.
+            docstore (BaseDocumentStore): Docstore holding the indexed nodes.
+            similarity_top_k (int): Number of nodes returned. Default is 10.
+        """
+        self._index = index
+        self._docstore = docstore
+        self._similarity_top_k = similarity_top_k
+        super().__init__()
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Retrieve nodes given query."""
+        hits = self._index.search(query_bundle.query_str, top_k=self._similarity_top_k)
+        nodes = self._docstore.get_nodes([node_id for node_id, _ in hits])
+        return [NodeWithScore(node=node, score=score) for node, (_, score) in zip(nodes, hits)]
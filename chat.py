@@ -4,22 +4,100 @@ from llama_index.core import (
     Settings,
     get_response_synthesizer,
 )
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.llms.ollama import Ollama
+from llama_index.core.base.response.schema import AsyncStreamingResponse, StreamingResponse
+from llama_index.core.callbacks import CBEventType, EventPayload
 from llama_index.core.retrievers import VectorIndexRetriever, KeywordTableSimpleRetriever
-from llama_index.core.query_engine import RetrieverQueryEngine, MultiStepQueryEngine
-from llama_index.core.postprocessor import LLMRerank
-from llama_index.core.indices.query.query_transform.base import StepDecomposeQueryTransform
+from llama_index.core.query_engine import RetrieverQueryEngine
 from CustomRetriever import CustomRetriever
+from bm25_index import BM25Index, BM25Retriever
+from rerankers import build_reranker
+from context_budget import AdaptiveSynthesizer, ContextBudget
+from answer_cache import CachedQueryEngine, SemanticAnswerCache
+from decompose import DecomposedQueryEngine
+from numpy_vector_store import load_vector_store
+from models import EMBEDDING_CACHE_FILENAME, get_embed_model, get_llm
+from index_versions import current_index_dir
+from index_bundle import is_bundle, load_bundle_index
+from tracing import bind_context, span
 
 import os
+import asyncio
+
+class AsyncRetrieverQueryEngine(RetrieverQueryEngine):
+    """
+    RetrieverQueryEngine that times its stages in the current query trace.
+
+    Its async path runs the rerankers in a worker thread instead of on the event loop.
+    """
+
+    def retrieve(self, query_bundle):
+        with span("retrieve") as record:
+            nodes = self._retriever.retrieve(query_bundle)
+            record["candidates"] = len(nodes)
+        return self._apply_node_postprocessors(nodes, query_bundle=query_bundle)
+
+    async def aretrieve(self, query_bundle):
+        with span("retrieve") as record:
+            nodes = await self._retriever.aretrieve(query_bundle)
+            record["candidates"] = len(nodes)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, bind_context(self._apply_node_postprocessors, nodes, query_bundle=query_bundle)
+        )
+
+    def _apply_node_postprocessors(self, nodes, query_bundle):
+        with span("rerank", candidates_in=len(nodes)) as record:
+            nodes = super()._apply_node_postprocessors(nodes, query_bundle=query_bundle)
+            record["candidates"] = len(nodes)
+        return nodes
+
+    def _query(self, query_bundle):
+        # Same as RetrieverQueryEngine._query, but through self.synthesize so it is timed
+        with self.callback_manager.event(
+            CBEventType.QUERY, payload={EventPayload.QUERY_STR: query_bundle.query_str}
+        ) as query_event:
+            nodes = self.retrieve(query_bundle)
+            response = self.synthesize(query_bundle, nodes)
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+        return response
+
+    async def _aquery(self, query_bundle):
+        with self.callback_manager.event(
+            CBEventType.QUERY, payload={EventPayload.QUERY_STR: query_bundle.query_str}
+        ) as query_event:
+            nodes = await self.aretrieve(query_bundle)
+            response = await self.asynthesize(query_bundle, nodes)
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+        return response
+
+    def synthesize(self, query_bundle, nodes, additional_source_nodes=None):
+        # With streaming this covers building the answer up to the first streamed call
+        with span("synthesize", nodes=len(nodes)):
+            return super().synthesize(query_bundle, nodes, additional_source_nodes)
+
+    async def asynthesize(self, query_bundle, nodes, additional_source_nodes=None):
+        with span("synthesize", nodes=len(nodes)):
+            return await super().asynthesize(query_bundle, nodes, additional_source_nodes)
 
 def initialize_query_engine(
     user_id: str,
     base_dir: str = "./user_data",
     embedding_model_name: str = "BAAI/bge-small-en-v1.5",
     llm_model_name: str = "llama3.2:3b",
-    similarity_top_k: int = 10
+    similarity_top_k: int = 10,
+    ann_nprobe: int = 8,
+    keyword_top_k: int = 10,
+    retriever_mode: str = "RRF",
+    fusion_top_k: int = 10,
+    reranker: str = None,
+    rerank_top_n: int = 5,
+    answer_cache: SemanticAnswerCache = None,
+    streaming: bool = False,
+    context_budget: int = None,
+    min_score_ratio: float = 0.5,
+    decompose: bool = False,
+    max_sub_questions: int = 3,
+    max_llm_calls: int = 6
 ):
     """
     Initializes a query engine for a specific user by automatically detecting index paths.
@@ -30,14 +108,42 @@ def initialize_query_engine(
         embedding_model_name (str): Name of the HuggingFace embedding model.
         llm_model_name (str): Name of the LLM model.
         similarity_top_k (int): Number of top results for similarity search.
+        ann_nprobe (int): Clusters probed per query when the vector index has an IVF index.
+            Higher is more accurate and slower.
+        keyword_top_k (int): Number of top results for BM25 keyword search.
+        retriever_mode (str): How CustomRetriever merges vector and keyword results:
+            'RRF', 'WEIGHTED', 'AND' or 'OR'. Default is 'RRF'.
+        fusion_top_k (int): Number of merged nodes passed on to reranking.
+        reranker (str): 'llm' (LLMRerank), 'cross_encoder' (local cross-encoder),
+            'similarity' (embedding cosine) or 'none'. Default is 'llm', or 'similarity' with
+            context_budget so that simple questions take a single LLM call.
+        rerank_top_n (int): Number of nodes kept after reranking.
+        answer_cache (SemanticAnswerCache): If given, near-duplicate questions are answered
+            from this cache instead of running the pipeline.
+        streaming (bool): Return a StreamingResponse whose tokens can be consumed as they are
+            generated. Use `iter_response_text` to read either kind of response.
+        context_budget (int): If given, the maximum number of context tokens sent to the LLM.
+            Overlapping chunks are merged, nodes are cut at the budget or a reranker score
+            cliff, an LLM reranker only runs when the budget cuts the retrieval order, and answers take a
+            single 'compact' LLM call when the context fits one prompt. Default is None,
+            which sends every reranked node to 'tree_summarize'.
+        min_score_ratio (float): With context_budget, drop nodes whose reranker score is below
+            this fraction of the best node's. Fused retrieval scores, such as RRF's rank
+            scores, are never cut this way. Default is 0.5.
+        decompose (bool): Answer compound questions, such as comparisons, by splitting them
+            into sub-questions that are retrieved and answered in parallel and then merged.
+            Default is False.
+        max_sub_questions (int): With decompose, the most sub-questions per question. Default is 3.
+        max_llm_calls (int): With decompose, the most LLM calls per decomposed question,
+            including reranking. Default is 6.
 
     Returns:
-        MultiStepQueryEngine: A query engine ready to process user queries.
+        BaseQueryEngine: A query engine ready to process user queries.
     """
-    # Dynamically locate user-specific index paths
-    user_dir = os.path.join(base_dir, user_id)
-    vector_index_path = os.path.join(user_dir, "vector_index")
-    keyword_index_path = os.path.join(user_dir, "keyword_index")
+    # Dynamically locate the user's published index paths
+    index_dir = current_index_dir(os.path.join(base_dir, user_id))
+    vector_index_path = os.path.join(index_dir, "vector_index")
+    keyword_index_path = os.path.join(index_dir, "keyword_index")
 
     if not (os.path.exists(vector_index_path) and os.path.exists(keyword_index_path)):
         raise FileNotFoundError(f"Indices for user '{user_id}' not found.")
@@ -45,58 +151,128 @@ def initialize_query_engine(
     print(f"Using vector index path: {vector_index_path}")
     print(f"Using keyword index path: {keyword_index_path}")
 
-    # Initialize embedding model
-    embed_model = HuggingFaceEmbedding(model_name=embedding_model_name, trust_remote_code=True)
+    # Reuse the process-wide embedding model, backed by the on-disk embedding cache
+    embed_model = get_embed_model(embedding_model_name, cache_path=os.path.join(base_dir, EMBEDDING_CACHE_FILENAME))
     Settings.embed_model = embed_model
 
-    # Initialize LLM
-    llm = Ollama(model=llm_model_name, request_timeout=120.0)
+    # Reuse the process-wide Ollama client
+    llm = get_llm(llm_model_name)
     Settings.llm = llm
 
-    # Load stored indices
-    vector_storage_context = StorageContext.from_defaults(persist_dir=vector_index_path)
-    keyword_storage_context = StorageContext.from_defaults(persist_dir=keyword_index_path)
+    # Load stored indices; a bundle's nodes are read from its node store on demand
+    if is_bundle(index_dir):
+        vector_index = load_bundle_index(index_dir, embed_model=embed_model)
+        vector_store = vector_index.vector_store
+    else:
+        vector_store = load_vector_store(vector_index_path)
+        vector_storage_context = StorageContext.from_defaults(persist_dir=vector_index_path, vector_store=vector_store)
+        vector_index = load_index_from_storage(storage_context=vector_storage_context)
+    if vector_store is not None:
+        vector_store.nprobe = ann_nprobe
+        if vector_store.ann is not None:
+            print(f"Using IVF index with {vector_store.ann.nlist} clusters, nprobe={ann_nprobe}.")
 
-    vector_index = load_index_from_storage(storage_context=vector_storage_context)
-    keyword_index = load_index_from_storage(storage_context=keyword_storage_context)
+    # The BM25 index shares the vector index's docstore; older users still have a keyword table
+    if BM25Index.exists(keyword_index_path):
+        keyword_index = BM25Index.load(keyword_index_path)
+    else:
+        keyword_storage_context = StorageContext.from_defaults(persist_dir=keyword_index_path)
+        keyword_index = load_index_from_storage(storage_context=keyword_storage_context)
 
     print("Indices loaded successfully.")
 
     # Set up retrievers
     vector_retriever = VectorIndexRetriever(index=vector_index, similarity_top_k=similarity_top_k)
-    keyword_retriever = KeywordTableSimpleRetriever(index=keyword_index)
+    if isinstance(keyword_index, BM25Index):
+        keyword_retriever = BM25Retriever(keyword_index, vector_index.docstore, similarity_top_k=keyword_top_k)
+    else:
+        keyword_retriever = KeywordTableSimpleRetriever(index=keyword_index)
 
     print("Retrievers set up successfully.")
 
     # Combine retrievers using a custom retriever
-    custom_retriever = CustomRetriever(vector_retriever, keyword_retriever)
+    custom_retriever = CustomRetriever(vector_retriever, keyword_retriever, mode=retriever_mode, top_k=fusion_top_k)
     print("Custom retriever initialized.")
 
+    # Set up the reranker; in context-budget mode the default one makes no LLM call
+    if reranker is None:
+        reranker = "similarity" if context_budget else "llm"
+    node_postprocessor = build_reranker(reranker, top_n=rerank_top_n, embed_model=embed_model)
+    node_postprocessors = [node_postprocessor] if node_postprocessor is not None else []
+
     # Define response synthesizer
-    response_synthesizer = get_response_synthesizer(response_mode="tree_summarize")
+    if context_budget:
+        node_postprocessors = [
+            ContextBudget(reranker=node_postprocessor, token_budget=context_budget, min_score_ratio=min_score_ratio)
+        ]
+        response_synthesizer = AdaptiveSynthesizer(llm=llm, streaming=streaming)
+        print(f"Context budget: {context_budget} tokens.")
+    else:
+        response_synthesizer = get_response_synthesizer(response_mode="tree_summarize", streaming=streaming)
 
-    # Setup query decomposition and custom query engine
-    step_decompose_transform = StepDecomposeQueryTransform(llm, verbose=True)
-    custom_query_engine = RetrieverQueryEngine(
+    # Setup custom query engine
+    custom_query_engine = AsyncRetrieverQueryEngine(
         retriever=custom_retriever,
         response_synthesizer=response_synthesizer,
-        node_postprocessors=[
-            LLMRerank(choice_batch_size=10, top_n=5)  # Reranker configuration
-        ]
+        node_postprocessors=node_postprocessors
     )
 
     print("Query engine setup completed.")
 
-    # Setup multi-step query engine
-    # query_engine = MultiStepQueryEngine(
-    #     custom_query_engine, 
-    #     query_transform=step_decompose_transform,
-    #     index_summary="You are the best giver."  # Optional context for summarization
-    # )
+    if decompose:
+        custom_query_engine = DecomposedQueryEngine(
+            custom_query_engine, llm, max_sub_questions=max_sub_questions, max_llm_calls=max_llm_calls, streaming=streaming
+        )
+        print(f"Query decomposition enabled: up to {max_sub_questions} sub-questions, {max_llm_calls} LLM calls.")
 
-    # print("Multi-step query engine initialized.")
+    if answer_cache is not None:
+        custom_query_engine = CachedQueryEngine(custom_query_engine, answer_cache, embed_model)
+        print("Semantic answer cache enabled.")
     return custom_query_engine
 
+def iter_response_text(response):
+    """
+    Yield the answer text of a query response as it is generated.
+
+    Works for both a StreamingResponse, whose tokens are yielded as the LLM produces
+    them, and a plain Response (e.g. an answer cache hit), yielded in one piece.
+
+    Args:
+        response (Response | StreamingResponse): The result of `query_engine.query`.
+
+    Yields:
+        str: Consecutive pieces of the answer.
+    """
+    if isinstance(response, StreamingResponse):
+        if response.response_txt is not None:
+            yield response.response_txt
+            return
+        response_txt = ""
+        for token in response.response_gen or ():
+            response_txt += token
+            yield token
+        response.response_txt = response_txt
+    elif response.response:
+        yield response.response
+
+async def aiter_response_text(response):
+    """
+    Async version of `iter_response_text`, for the result of `query_engine.aquery`.
+
+    Args:
+        response (Response | StreamingResponse | AsyncStreamingResponse): The query result.
+
+    Yields:
+        str: Consecutive pieces of the answer.
+    """
+    if isinstance(response, AsyncStreamingResponse):
+        async for token in response.async_response_gen():
+            if token:
+                yield token
+    else:
+        for token in iter_response_text(response):
+            yield token
+
 if __name__=="__main__":
     query_engine =initialize_query_engine('admin')
     response=query_engine.query("describe what is chain of thoughts")
@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime
+from typing import List
+
+# Default location of the chat history database
+DEFAULT_CHAT_DB = "chats.sqlite"
+
+# Files written by earlier versions of app.py and main.py
+LEGACY_CHATS_FILE = "chats.json"
+LEGACY_API_HISTORY_FILE = "chat_history.json"
+
+
+class ChatStore:
+    """
+    Append-only chat history in SQLite (WAL mode).
+
+    Each message is one row indexed by (user_id, chat_date, id), so appending a
+    message costs one insert and reading a page of a day's conversation is an
+    index range scan, independent of the total history size. WAL mode lets the
+    Streamlit app and the API server write concurrently with readers.
+    """
+
+    def __init__(self, path: str = DEFAULT_CHAT_DB):
+        """
+        Args:
+            path (str): Path of the SQLite database file. Default is 'chats.sqlite'.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        # Wait for other processes' write transactions instead of failing immediately
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                chat_date TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS messages_user_date ON messages (user_id, chat_date, id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS migrations (name TEXT PRIMARY KEY, applied_at REAL NOT NULL)")
+
+    def append(self, user_id: str, role: str, content: str, chat_date: str = None):
+        """
+        Append one message.
+
+        Args:
+            user_id (str): Unique identifier for the user.
+            role (str): 'user' or 'assistant'.
+            content (str): The message text.
+            chat_date (str): Day of the conversation as YYYY-MM-DD. Default is today.
+
+        Returns:
+            int: The id of the new message.
+        """
+        return self.append_many(user_id, [(role, content)], chat_date)[0]
+
+    def append_many(self, user_id: str, messages: List[tuple], chat_date: str = None):
+        """
+        Append several (role, content) messages in one transaction, e.g. a question and its answer.
+
+        Returns:
+            list: The ids of the new messages.
+        """
+        chat_date = chat_date or datetime.now().strftime("%Y-%m-%d")
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                ids = [
+                    self._conn.execute(
+                        "INSERT INTO messages (user_id, chat_date, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                        (user_id, chat_date, role, content, now),
+                    ).lastrowid
+                    for role, content in messages
+                ]
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return ids
+
+    def get_messages(self, user_id: str, chat_date: str = None, limit: int = 100, before_id: int = None):
+        """
+        Read one page of a user's messages, oldest first.
+
+        Pages are taken from the newest end: the first call returns the latest
+        `limit` messages and passing the smallest returned id as `before_id`
+        returns the page before it.
+
+        Args:
+            user_id (str): Unique identifier for the user.
+            chat_date (str): Only messages of this day (YYYY-MM-DD). Default is all days.
+            limit (int): Maximum number of messages. Default is 100.
+            before_id (int): Only messages with a smaller id. Default is None.
+
+        Returns:
+            list: Message dicts with id, chat_date, role, content and created_at.
+        """
+        query = "SELECT id, chat_date, role, content, created_at FROM messages WHERE user_id = ?"
+        params = [user_id]
+        if chat_date is not None:
+            query += " AND chat_date = ?"
+            params.append(chat_date)
+        if before_id is not None:
+            query += " AND id < ?"
+            params.append(before_id)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [
+            {"id": row[0], "chat_date": row[1], "role": row[2], "content": row[3], "created_at": row[4]}
+            for row in reversed(rows)
+        ]
+
+    def list_dates(self, user_id: str):
+        """Return the days on which the user chatted, newest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT chat_date FROM messages WHERE user_id = ? ORDER BY chat_date DESC", (user_id,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def count(self, user_id: str, chat_date: str = None):
+        """Return the number of messages for a user, optionally on one day."""
+        query = "SELECT COUNT(*) FROM messages WHERE user_id = ?"
+        params = [user_id]
+        if chat_date is not None:
+            query += " AND chat_date = ?"
+            params.append(chat_date)
+        with self._lock:
+            return self._conn.execute(query, params).fetchone()[0]
+
+    def _migrate(self, name: str, rows: List[tuple]):
+        """Insert (user_id, chat_date, role, content, created_at) rows once, recorded under name."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._conn.execute("SELECT 1 FROM migrations WHERE name = ?", (name,)).fetchone():
+                    self._conn.execute("ROLLBACK")
+                    return 0
+                self._conn.executemany(
+                    "INSERT INTO messages (user_id, chat_date, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._conn.execute("INSERT INTO migrations (name, applied_at) VALUES (?, ?)", (name, time.time()))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def migrate_legacy_files(
+        self,
+        chats_file: str = LEGACY_CHATS_FILE,
+        api_history_file: str = LEGACY_API_HISTORY_FILE,
+        api_user_id: str = "admin",
+    ):
+        """
+        Import the JSON histories of earlier versions, once per file.
+
+        chats.json ({user: {date: [messages]}}) comes from app.py; chat_history.json
+        ([{"user": ..., "bot": ...}]) comes from main.py and is attributed to
+        api_user_id on the file's modification date. The files are left in place.
+
+        Returns:
+            int: Number of messages imported.
+        """
+        imported = 0
+
+        chats = _read_json(chats_file)
+        if isinstance(chats, dict):
+            created_at = os.path.getmtime(chats_file)
+            rows = [
+                (user_id, chat_date, message["role"], message["content"], created_at)
+                for user_id, days in chats.items()
+                for chat_date, messages in sorted(days.items())
+                for message in messages
+            ]
+            imported += self._migrate(f"json:{os.path.abspath(chats_file)}", rows)
+
+        history = _read_json(api_history_file)
+        if isinstance(history, list):
+            created_at = os.path.getmtime(api_history_file)
+            chat_date = datetime.fromtimestamp(created_at).strftime("%Y-%m-%d")
+            rows = []
+            for entry in history:
+                rows.append((api_user_id, chat_date, "user", entry["user"], created_at))
+                rows.append((api_user_id, chat_date, "assistant", entry["bot"], created_at))
+            imported += self._migrate(f"json:{os.path.abspath(api_history_file)}", rows)
+
+        if imported:
+            print(f"Migrated {imported} chat message(s) into {self.path}.")
+        return imported
+
+
+def _read_json(path: str):
+    """Return the parsed JSON file, or None if it is missing, empty or corrupted."""
+    try:
+        if os.path.getsize(path) == 0:
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+# Stores opened in this process, keyed by database path
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_chat_store(path: str = DEFAULT_CHAT_DB):
+    """Return the process-wide ChatStore for path, migrating legacy JSON history on first use."""
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = ChatStore(path)
+            store.migrate_legacy_files()
+        return store
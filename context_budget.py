@@ -0,0 +1,214 @@
+import hashlib
+from typing import Any, List, Optional, Sequence
+
+from llama_index.core import Settings, get_response_synthesizer
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.postprocessor import LLMRerank
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.prompts.default_prompt_selectors import DEFAULT_TEXT_QA_PROMPT_SEL
+from llama_index.core.response_synthesizers import BaseSynthesizer
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle, TextNode
+
+from tracing import span
+
+# Default number of context tokens sent to the synthesizer in context-budget mode
+DEFAULT_CONTEXT_BUDGET = 2048
+
+# Characters of a chunk's start searched for in another chunk to detect splitter overlap
+OVERLAP_PROBE_CHARS = 64
+
+# Metadata key listing the node ids a merged node was built from
+MERGED_IDS_KEY = "merged_node_ids"
+
+
+def _merge_text(first: str, second: str):
+    """
+    Join two chunks if second starts with a suffix of first, as adjacent splitter chunks do.
+
+    Returns:
+        str: The joined text, or None if the chunks do not overlap.
+    """
+    probe = second[:OVERLAP_PROBE_CHARS]
+    if not probe:
+        return None
+    start = first.find(probe)
+    while start >= 0:
+        if second.startswith(first[start:]):
+            return first + second[len(first) - start:]
+        start = first.find(probe, start + 1)
+    return None
+
+
+def _merge_nodes(first: NodeWithScore, second: NodeWithScore):
+    """Merge two overlapping chunks of the same document into one node, or return None."""
+    if first.node.ref_doc_id is None or first.node.ref_doc_id != second.node.ref_doc_id:
+        return None
+    a, b = first.node.get_content(), second.node.get_content()
+    text = _merge_text(a, b)
+    if text is None:
+        text = _merge_text(b, a)
+    if text is None:
+        return None
+
+    # Keep the better-scored node's id and metadata, so citations still resolve
+    best, other = (first, second) if (first.score or 0.0) >= (second.score or 0.0) else (second, first)
+    merged_ids = best.node.metadata.get(MERGED_IDS_KEY, [best.node.node_id]) + other.node.metadata.get(
+        MERGED_IDS_KEY, [other.node.node_id]
+    )
+    excluded = [MERGED_IDS_KEY]
+    node = TextNode(
+        id_=best.node.node_id,
+        text=text,
+        metadata={**best.node.metadata, MERGED_IDS_KEY: merged_ids},
+        excluded_embed_metadata_keys=best.node.excluded_embed_metadata_keys + excluded,
+        excluded_llm_metadata_keys=best.node.excluded_llm_metadata_keys + excluded,
+        relationships=best.node.relationships,
+    )
+    return NodeWithScore(node=node, score=best.score)
+
+
+def dedupe_nodes(nodes: List[NodeWithScore]):
+    """
+    Drop exact duplicates and merge chunks that overlap because of the splitter's chunk_overlap.
+
+    With 256 tokens of overlap on 512-token chunks, neighbouring chunks share half
+    their text; merging them sends that text to the LLM once. Order follows the
+    best-scored member of each merged group.
+
+    Returns:
+        tuple: (nodes, number of chunks merged or dropped).
+    """
+    kept = []
+    seen = set()
+    for candidate in nodes:
+        digest = hashlib.sha256(candidate.node.get_content().encode("utf-8")).hexdigest()
+        if digest in seen:
+            continue
+        seen.add(digest)
+        # Absorb every kept chunk that overlaps the candidate, which grows as they merge
+        absorbed = True
+        while absorbed:
+            absorbed = False
+            for i, node in enumerate(kept):
+                merged = _merge_nodes(node, candidate)
+                if merged is not None:
+                    kept.pop(i)
+                    candidate = merged
+                    absorbed = True
+                    break
+        kept.append(candidate)
+    kept.sort(key=lambda n: n.score or 0.0, reverse=True)
+    return kept, len(nodes) - len(kept)
+
+
+class ContextBudget(BaseNodePostprocessor):
+    """
+    Rerank the retrieved nodes and choose how many of them go to the synthesizer.
+
+    Overlapping chunks are merged first, so shared text is neither reranked, counted
+    nor sent twice. Nodes are taken best first until the next one would exceed the
+    token budget or, after reranking, its score falls below `min_score_ratio` of the
+    best score. Fused retrieval scores are not used for that cut: RRF scores only
+    reflect ranks, and AND/OR keep scores on the two retrievers' different scales.
+
+    A local reranker always runs. An LLM reranker only runs when the budget cut the
+    retrieval order short, so candidates that all fit skip its LLM call.
+    """
+
+    reranker: Optional[BaseNodePostprocessor] = Field(default=None, description="Reranker run after merging.")
+    token_budget: int = Field(default=DEFAULT_CONTEXT_BUDGET, description="Maximum context tokens.")
+    min_score_ratio: float = Field(
+        default=0.5,
+        description="Stop at the first node whose reranker score is below this fraction of the best one.",
+    )
+    min_nodes: int = Field(default=1, description="Always keep at least this many nodes.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextBudget"
+
+    def _select(self, nodes: List[NodeWithScore], costs: dict, score_cliff: bool):
+        """
+        Take nodes best first until the token budget or, with score_cliff, the score cliff.
+
+        Returns:
+            tuple: (selected nodes, their tokens, stop reason: 'budget', 'score' or 'exhausted').
+        """
+        top_score = nodes[0].score if nodes and score_cliff else None
+        selected, tokens = [], 0
+        for node in nodes:
+            cost = costs[node.node.node_id]
+            if len(selected) >= self.min_nodes:
+                # Scores are only comparable as ratios when they are positive
+                if top_score and top_score > 0 and node.score is not None and node.score < top_score * self.min_score_ratio:
+                    return selected, tokens, "score"
+                if tokens + cost > self.token_budget:
+                    return selected, tokens, "budget"
+            selected.append(node)
+            tokens += cost
+        return selected, tokens, "exhausted"
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        with span("context_budget", candidates_in=len(nodes), budget=self.token_budget) as record:
+            nodes, merged = dedupe_nodes(nodes)
+            tokenizer = Settings.tokenizer
+            costs = {n.node.node_id: len(tokenizer(n.node.get_content(metadata_mode=MetadataMode.LLM))) for n in nodes}
+
+            selected, tokens, stop = self._select(nodes, costs, score_cliff=False)
+            reranked = self.reranker is not None and (not isinstance(self.reranker, LLMRerank) or stop == "budget")
+            if reranked:
+                nodes = self.reranker.postprocess_nodes(nodes, query_bundle=query_bundle)
+                selected, tokens, stop = self._select(nodes, costs, score_cliff=True)
+
+            record.update(merged=merged, reranked=reranked, candidates=len(selected), tokens=tokens, stop=stop)
+        return selected
+
+
+class AdaptiveSynthesizer(BaseSynthesizer):
+    """
+    Answer in a single 'compact' LLM call when the context fits one prompt, else with 'tree_summarize'.
+
+    tree_summarize answers oversized contexts in parallel batches and then combines the
+    partial answers, which costs several LLM calls; below one prompt it only adds a
+    less direct template.
+    """
+
+    def __init__(self, llm: Any = None, streaming: bool = False):
+        """
+        Args:
+            llm (LLM): The LLM. Default is Settings.llm.
+            streaming (bool): Return streamed responses. Default is False.
+        """
+        super().__init__(llm=llm, streaming=streaming)
+        self._text_qa_template = DEFAULT_TEXT_QA_PROMPT_SEL
+        self._compact = get_response_synthesizer(
+            llm=self._llm, response_mode="compact", text_qa_template=self._text_qa_template, streaming=streaming
+        )
+        self._tree_summarize = get_response_synthesizer(
+            llm=self._llm, response_mode="tree_summarize", streaming=streaming
+        )
+
+    def _get_prompts(self):
+        return {}
+
+    def _update_prompts(self, prompts) -> None:
+        pass
+
+    def _select(self, query_str: str, text_chunks: Sequence[str]):
+        with span("select_synthesizer") as record:
+            template = self._text_qa_template.partial_format(query_str=query_str)
+            prompts = len(self._prompt_helper.repack(template, text_chunks=text_chunks, llm=self._llm))
+            mode = "compact" if prompts <= 1 else "tree_summarize"
+            record.update(mode=mode, prompts=prompts)
+        return self._compact if mode == "compact" else self._tree_summarize
+
+    def get_response(self, query_str: str, text_chunks: Sequence[str], **response_kwargs: Any):
+        return self._select(query_str, text_chunks).get_response(query_str, text_chunks, **response_kwargs)
+
+    async def aget_response(self, query_str: str, text_chunks: Sequence[str], **response_kwargs: Any):
+        synthesizer = self._select(query_str, text_chunks)
+        return await synthesizer.aget_response(query_str, text_chunks, **response_kwargs)
@@ -0,0 +1,281 @@
+import re
+import math
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from llama_index.core import PromptTemplate
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.response.schema import AsyncStreamingResponse, Response, StreamingResponse
+from llama_index.core.indices.prompt_helper import PromptHelper
+from llama_index.core.postprocessor import LLMRerank
+from llama_index.core.prompts.default_prompts import DEFAULT_TEXT_QA_PROMPT
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+
+from tracing import bind_context, span
+
+# Shared pool that retrieves and answers the sub-questions of a query side by side
+_subquestion_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="subquestion")
+
+# Questions that name several things to explain or compare; others go straight to the wrapped engine
+COMPOUND_PATTERN = re.compile(
+    r"\b(compare|compared|comparing|comparison|contrast|versus|vs|differences?|differ|similarities|pros and cons)\b",
+    re.IGNORECASE,
+)
+
+# Numbering or bullets the LLM may put in front of a sub-question
+_LIST_MARKER = re.compile(r"^\s*(?:\d+[.):]|[-*•]|sub-question\s*\d*:?)\s*", re.IGNORECASE)
+
+DECOMPOSE_PROMPT = PromptTemplate(
+    "Split the question below into at most {max_questions} simpler sub-questions that can each be "
+    "answered on their own from a collection of documents, and that together answer the question. "
+    "Do not make a sub-question depend on the answer to another. Write one sub-question per line, "
+    "with no numbering or other text. If the question is already simple, repeat it on a single line.\n"
+    "Question: {query_str}\n"
+    "Sub-questions:\n"
+)
+
+MERGE_PROMPT = PromptTemplate(
+    "The question below was split into sub-questions, which were answered from the documents.\n"
+    "---------------------\n"
+    "{sub_answers}\n"
+    "---------------------\n"
+    "Using only these answers and not prior knowledge, write one complete answer to the question.\n"
+    "Question: {query_str}\n"
+    "Answer: "
+)
+
+
+def is_compound(query_str: str) -> bool:
+    """Whether a question asks about several things, e.g. compares two techniques."""
+    return bool(COMPOUND_PATTERN.search(query_str)) or query_str.count("?") > 1
+
+
+def parse_sub_questions(text: str, max_questions: int) -> List[str]:
+    """Read one sub-question per line of the LLM's output, dropping markers, blanks and repeats."""
+    questions = []
+    for line in text.splitlines():
+        question = _LIST_MARKER.sub("", line).strip().strip('"')
+        if question and question.lower() not in (q.lower() for q in questions):
+            questions.append(question)
+    return questions[:max_questions]
+
+
+def _rerank_calls(postprocessor: Any, n_nodes: int) -> int:
+    """Most LLM calls a postprocessor makes for n_nodes candidates."""
+    if isinstance(postprocessor, LLMRerank):
+        return math.ceil(n_nodes / postprocessor.choice_batch_size)
+    # ContextBudget reranks with a wrapped postprocessor
+    reranker = getattr(postprocessor, "reranker", None)
+    return _rerank_calls(reranker, n_nodes) if reranker is not None else 0
+
+
+def _without_llm(postprocessor: Any):
+    """The postprocessor with a wrapped LLM reranker removed."""
+    if not isinstance(postprocessor, LLMRerank) and _rerank_calls(postprocessor, 1):
+        return postprocessor.model_copy(update={"reranker": None})
+    return postprocessor
+
+
+class DecomposedQueryEngine(BaseQueryEngine):
+    """
+    Query engine wrapper that answers compound questions through parallel sub-questions.
+
+    One LLM call splits the question into independent sub-questions, which are
+    retrieved concurrently against the wrapped engine's retriever. Their results are
+    pooled, so a node found by several sub-questions is reranked and sent once, and
+    the pool is reranked once against the original question. The sub-questions are
+    then answered concurrently from the shared nodes and a final call merges their
+    answers. Latency is about that of two plain queries however many sub-questions
+    there are, and the number of LLM calls never exceeds `max_llm_calls`.
+
+    Questions that do not look compound skip decomposition and are answered by the
+    wrapped engine directly.
+    """
+
+    def __init__(
+        self,
+        query_engine: BaseQueryEngine,
+        llm: Any,
+        max_sub_questions: int = 3,
+        max_llm_calls: int = 6,
+        streaming: bool = False,
+    ) -> None:
+        """
+        Args:
+            query_engine (AsyncRetrieverQueryEngine): The engine whose retriever and rerankers are used,
+                and which answers questions that are not decomposed.
+            llm (LLM): The LLM that decomposes, answers and merges.
+            max_sub_questions (int): Most sub-questions per question. Default is 3.
+            max_llm_calls (int): Most LLM calls per decomposed question, including reranking. Default is 6.
+            streaming (bool): Stream the merged answer. Default is False.
+        """
+        self._query_engine = query_engine
+        self._llm = llm
+        # Decomposing and merging take one call each, and each sub-question takes one
+        self._max_sub_questions = max(0, min(max_sub_questions, max_llm_calls - 2))
+        self._max_llm_calls = max_llm_calls
+        self._streaming = streaming
+        self._prompt_helper = PromptHelper.from_llm_metadata(llm.metadata)
+        super().__init__(callback_manager=query_engine.callback_manager)
+
+    @property
+    def query_engine(self):
+        return self._query_engine
+
+    def __getattr__(self, name: str):
+        # Expose the wrapped engine's attributes (retriever, node postprocessors, ...)
+        query_engine = self.__dict__.get("_query_engine")
+        if query_engine is None or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(query_engine, name)
+
+    def _get_prompt_modules(self) -> Dict[str, Any]:
+        return {"query_engine": self._query_engine}
+
+    def _decompose(self, text: str) -> List[str]:
+        questions = parse_sub_questions(text, self._max_sub_questions)
+        # A single sub-question is just the question again
+        return questions if len(questions) > 1 else []
+
+    def _pool(self, sub_questions: List[str], results: List[List[NodeWithScore]]):
+        """
+        Pool the sub-questions' nodes by id, taking them rank by rank in turn so each keeps its best hits.
+
+        Returns:
+            list: The pooled nodes, cut to what the LLM calls left can rerank.
+        """
+        pooled = {}
+        for rank in range(max((len(nodes) for nodes in results), default=0)):
+            for nodes in results:
+                if rank < len(nodes):
+                    pooled.setdefault(nodes[rank].node.node_id, nodes[rank])
+        pool = list(pooled.values())
+
+        # Keep reranking within the calls that answering does not use; with none spare it is skipped
+        spare_calls = self._spare_calls(sub_questions)
+        if spare_calls > 0:
+            while len(pool) > 1 and self._rerank_calls(len(pool)) > spare_calls:
+                pool.pop()
+        return pool
+
+    def _spare_calls(self, sub_questions: List[str]) -> int:
+        """LLM calls left for reranking after decomposing, answering each sub-question and merging."""
+        return self._max_llm_calls - 2 - len(sub_questions)
+
+    def _rerank_calls(self, n_nodes: int) -> int:
+        return sum(_rerank_calls(p, n_nodes) for p in self._query_engine._node_postprocessors)
+
+    def _postprocess(self, query_bundle: QueryBundle, sub_questions: List[str], pool: List[NodeWithScore]):
+        """Rerank the pool once against the original question, without LLM reranking if it would exceed the cap."""
+        if self._rerank_calls(len(pool)) <= self._spare_calls(sub_questions):
+            return self._query_engine._apply_node_postprocessors(pool, query_bundle=query_bundle)
+
+        with span("rerank", candidates_in=len(pool), skipped_llm=True) as record:
+            for postprocessor in self._query_engine._node_postprocessors:
+                if isinstance(postprocessor, LLMRerank):
+                    # The pool's rank-by-rank order stands in for the LLM's ranking
+                    pool = pool[:postprocessor.top_n]
+                else:
+                    pool = _without_llm(postprocessor).postprocess_nodes(pool, query_bundle=query_bundle)
+            record["candidates"] = len(pool)
+        return pool
+
+    def _context(self, nodes: List[NodeWithScore], sub_questions: List[str]) -> str:
+        """
+        The shared nodes as one prompt's context.
+
+        Every sub-question gets the same context in the same order, ahead of the
+        question, so its prompts share one long prefix that Ollama evaluates once.
+        """
+        texts = [n.node.get_content(metadata_mode=MetadataMode.LLM) for n in nodes]
+        if not texts:
+            return ""
+        # Truncated to fit the longest question, so the context is identical for all of them
+        template = DEFAULT_TEXT_QA_PROMPT.partial_format(query_str=max(sub_questions, key=len))
+        return "\n\n".join(self._prompt_helper.truncate(template, texts, llm=self._llm))
+
+    def _merge_kwargs(self, query_bundle: QueryBundle, sub_questions: List[str], answers: List[str]):
+        sub_answers = "\n\n".join(
+            f"Sub-question: {question}\nAnswer: {answer.strip()}" for question, answer in zip(sub_questions, answers)
+        )
+        return {"query_str": query_bundle.query_str, "sub_answers": sub_answers}
+
+    def _metadata(self, sub_questions: List[str], answers: List[str]):
+        return {"sub_questions": [{"question": q, "answer": a} for q, a in zip(sub_questions, answers)]}
+
+    def _query(self, query_bundle: QueryBundle):
+        if self._max_sub_questions < 2 or not is_compound(query_bundle.query_str):
+            return self._query_engine.query(query_bundle)
+
+        with span("decompose") as record:
+            text = self._llm.predict(
+                DECOMPOSE_PROMPT, query_str=query_bundle.query_str, max_questions=self._max_sub_questions
+            )
+            sub_questions = self._decompose(text)
+            record["sub_questions"] = len(sub_questions)
+        if not sub_questions:
+            return self._query_engine.query(query_bundle)
+
+        retriever = self._query_engine.retriever
+        with span("retrieve", sub_questions=len(sub_questions)) as record:
+            futures = [
+                _subquestion_pool.submit(bind_context(retriever.retrieve, QueryBundle(q))) for q in sub_questions
+            ]
+            results = [future.result() for future in futures]
+            pool = self._pool(sub_questions, results)
+            record["candidates"] = len(pool)
+        nodes = self._postprocess(query_bundle, sub_questions, pool)
+
+        with span("sub_answers", sub_questions=len(sub_questions)):
+            context_str = self._context(nodes, sub_questions)
+            futures = [
+                _subquestion_pool.submit(bind_context(
+                    self._llm.predict, DEFAULT_TEXT_QA_PROMPT, context_str=context_str, query_str=q
+                ))
+                for q in sub_questions
+            ]
+            answers = [future.result() for future in futures]
+
+        merge_kwargs = self._merge_kwargs(query_bundle, sub_questions, answers)
+        metadata = self._metadata(sub_questions, answers)
+        with span("synthesize", nodes=len(nodes)):
+            if self._streaming:
+                return StreamingResponse(self._llm.stream(MERGE_PROMPT, **merge_kwargs), nodes, metadata)
+            return Response(self._llm.predict(MERGE_PROMPT, **merge_kwargs), nodes, metadata)
+
+    async def _aquery(self, query_bundle: QueryBundle):
+        if self._max_sub_questions < 2 or not is_compound(query_bundle.query_str):
+            return await self._query_engine.aquery(query_bundle)
+
+        with span("decompose") as record:
+            text = await self._llm.apredict(
+                DECOMPOSE_PROMPT, query_str=query_bundle.query_str, max_questions=self._max_sub_questions
+            )
+            sub_questions = self._decompose(text)
+            record["sub_questions"] = len(sub_questions)
+        if not sub_questions:
+            return await self._query_engine.aquery(query_bundle)
+
+        retriever = self._query_engine.retriever
+        with span("retrieve", sub_questions=len(sub_questions)) as record:
+            results = await asyncio.gather(*(retriever.aretrieve(QueryBundle(q)) for q in sub_questions))
+            pool = self._pool(sub_questions, results)
+            record["candidates"] = len(pool)
+        # Reranking is CPU-bound or blocking, so keep it off the event loop
+        loop = asyncio.get_running_loop()
+        nodes = await loop.run_in_executor(None, bind_context(self._postprocess, query_bundle, sub_questions, pool))
+
+        with span("sub_answers", sub_questions=len(sub_questions)):
+            context_str = self._context(nodes, sub_questions)
+            answers = await asyncio.gather(*(
+                self._llm.apredict(DEFAULT_TEXT_QA_PROMPT, context_str=context_str, query_str=q) for q in sub_questions
+            ))
+
+        merge_kwargs = self._merge_kwargs(query_bundle, sub_questions, answers)
+        metadata = self._metadata(sub_questions, answers)
+        with span("synthesize", nodes=len(nodes)):
+            if self._streaming:
+                response_gen = await self._llm.astream(MERGE_PROMPT, **merge_kwargs)
+                return AsyncStreamingResponse(response_gen, nodes, metadata)
+            return Response(await self._llm.apredict(MERGE_PROMPT, **merge_kwargs), nodes, metadata)
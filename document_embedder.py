@@ -1,10 +1,139 @@
 import os
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.core import Settings, VectorStoreIndex, SimpleKeywordTableIndex
+import shutil
+from llama_index.core import (
+    Settings,
+    VectorStoreIndex,
+    SimpleKeywordTableIndex,
+    StorageContext,
+    load_index_from_storage,
+)
 from llama_index.core.ingestion import IngestionPipeline
 from llama_index.core.node_parser import TokenTextSplitter
 from llama_index.core.readers import SimpleDirectoryReader
-from llama_index.llms.ollama import Ollama
+from embedding_cache import CachedEmbedding
+from embedding_service import DEFAULT_MEMORY_MB, EmbeddingService, default_onnx_dir
+from bm25_index import TOKENIZER_VERSION, BM25Index
+from ann_index import ANN_MIN_VECTORS
+from numpy_vector_store import DEFAULT_VECTOR_STORE_FNAME, NumpyVectorStore, load_vector_store
+from models import EMBEDDING_CACHE_FILENAME, get_embed_model, get_llm
+from index_versions import current_index_dir, new_version_dir, prune_versions, publish_version
+from index_bundle import is_bundle, load_bundle_index, write_bundle
+from ingest_manifest import (
+    diff_manifest,
+    file_sha256,
+    load_manifest,
+    new_manifest,
+    save_manifest,
+    scan_directory,
+)
+
+def _indices_exist(vector_store_dir: str, keyword_store_dir: str, keyword_backend: str):
+    """Return True if both persisted indices are present on disk."""
+    if is_bundle(os.path.dirname(vector_store_dir)):
+        return keyword_backend == "bm25" and BM25Index.exists(keyword_store_dir)
+    if not os.path.exists(os.path.join(vector_store_dir, "docstore.json")):
+        return False
+    if keyword_backend == "bm25":
+        return BM25Index.exists(keyword_store_dir)
+    return os.path.exists(os.path.join(keyword_store_dir, "docstore.json"))
+
+def _delete_nodes(vector_index, keyword_index, node_ids):
+    """
+    Remove nodes from both indices and their docstores.
+
+    Args:
+        vector_index (VectorStoreIndex): The user's vector index.
+        keyword_index (BM25Index | SimpleKeywordTableIndex): The user's keyword index.
+        node_ids (list): Ids of the nodes to remove.
+    """
+    if not node_ids:
+        return
+
+    # Vector side: vector store, docstore and the index struct's node table
+    vector_index.delete_nodes(node_ids, delete_from_docstore=True)
+    for node_id in node_ids:
+        vector_index.index_struct.delete(node_id)
+    vector_index.storage_context.index_store.add_index_struct(vector_index.index_struct)
+
+    if isinstance(keyword_index, BM25Index):
+        keyword_index.delete_nodes(node_ids)
+        return
+
+    # Keyword table: a single pass over the table instead of one pass per node
+    node_id_set = set(node_ids)
+    table = keyword_index.index_struct.table
+    for keyword in list(table):
+        table[keyword] -= node_id_set
+        if not table[keyword]:
+            del table[keyword]
+    keyword_index.storage_context.index_store.add_index_struct(keyword_index.index_struct)
+    for node_id in node_ids:
+        keyword_index.docstore.delete_document(node_id, raise_error=False)
+
+def _known_sha256(ocr_manifest: dict, input_dir: str, rel_path: str, path: str):
+    """Return the hash the OCR step recorded for a file, if the file is unchanged since."""
+    if not ocr_manifest or os.path.abspath(input_dir) != ocr_manifest["destination_dir"]:
+        return None
+    entry = ocr_manifest["files"].get(rel_path)
+    if not entry or "sha256" not in entry:
+        return None
+    stat = os.stat(path)
+    if (stat.st_size, stat.st_mtime_ns) != (entry["size"], entry["mtime_ns"]):
+        return None
+    return entry["sha256"]
+
+def _iter_node_batches(input_files, splitter, batch_size: int, streaming: bool = True, num_workers: int = 1):
+    """
+    Yield (nodes, number of files fully read) in batches of at most batch_size nodes.
+
+    With streaming, files are read one at a time and each document is split as it
+    is read, so only the current file's documents and one batch of nodes are held
+    in memory. Otherwise every document is loaded and split up front, which lets
+    reading and splitting use num_workers processes.
+    """
+    reader = SimpleDirectoryReader(input_files=input_files)
+    if not streaming:
+        documents = reader.load_data(show_progress=True, num_workers=num_workers)
+        nodes = IngestionPipeline(transformations=[splitter]).run(documents=documents, num_workers=num_workers)
+        for start in range(0, len(nodes), batch_size):
+            end = min(start + batch_size, len(nodes))
+            yield nodes[start:end], len(input_files) * end // len(nodes)
+        return
+
+    batch = []
+    for files_done, documents in enumerate(reader.iter_data(), start=1):
+        for document in documents:
+            for node in splitter.get_nodes_from_documents([document]):
+                batch.append(node)
+                if len(batch) >= batch_size:
+                    yield batch, files_done - 1
+                    batch = []
+        if batch:
+            # Flush at file boundaries so progress advances per file
+            yield batch, files_done
+            batch = []
+
+def _update_ann_index(vector_store: NumpyVectorStore, ann_index: str, ann_nlist: int):
+    """
+    Keep a NumpyVectorStore's IVF index in line with the requested mode and the store's size.
+
+    Args:
+        vector_store (NumpyVectorStore): The user's vector store.
+        ann_index (str): 'auto', 'ivf' or 'none'.
+        ann_nlist (int): Number of IVF clusters, or None for the default.
+    """
+    if ann_index not in ("auto", "ivf", "none"):
+        raise ValueError(f"Invalid ANN index mode: {ann_index}")
+
+    count = vector_store.count()
+    if ann_index == "none" or count == 0:
+        vector_store.drop_ann_index()
+    elif vector_store.ann is None:
+        if ann_index == "ivf" or count >= ANN_MIN_VECTORS:
+            vector_store.build_ann_index(nlist=ann_nlist)
+    elif vector_store.ann.needs_retrain(count) or (ann_nlist and ann_nlist != vector_store.ann.nlist):
+        # Inserts are assigned to existing clusters; retrain once the corpus size has drifted
+        vector_store.build_ann_index(nlist=ann_nlist)
 
 def create_and_save_user_indices(
     user_id: str,
@@ -14,10 +143,23 @@ def create_and_save_user_indices(
     chunk_overlap: int = 256, 
     num_workers: int = 1,
     embedding_model_name: str = "BAAI/bge-small-en-v1.5",
-    llm_model_name: str = "llama3.2:3b"
+    llm_model_name: str = "llama3.2:3b",
+    incremental: bool = True,
+    vector_store_backend: str = "numpy",
+    ann_index: str = "auto",
+    ann_nlist: int = None,
+    keyword_backend: str = "bm25",
+    ocr_manifest: dict = None,
+    progress=None,
+    embed_batch_nodes: int = 256,
+    streaming: bool = True,
+    embed_backend: str = "torch",
+    embed_threads: int = None,
+    embed_processes: int = 1,
+    embed_memory_mb: int = DEFAULT_MEMORY_MB
 ):
     """
-    Create and save user-specific VectorStoreIndex and KeywordTableIndex.
+    Create and save user-specific VectorStoreIndex and keyword index.
 
     Args:
         user_id (str): Unique identifier for the user.
@@ -28,47 +170,204 @@ def create_and_save_user_indices(
         num_workers (int): Number of workers for parallel processing. Default is 1.
         embedding_model_name (str): Name of the HuggingFace embedding model. Default is 'BAAI/bge-small-en-v1.5'.
         llm_model_name (str): Name of the LLM model. Default is 'llama3.2:3b'.
+        incremental (bool): Only embed new or changed files and drop nodes of deleted files,
+            using the user's manifest of file hashes. Falls back to a full rebuild when no
+            usable manifest exists or the chunking/embedding settings changed. Default is True.
+        vector_store_backend (str): 'numpy' for the memory-mapped NumpyVectorStore or 'simple'
+            for llama_index's JSON SimpleVectorStore. Default is 'numpy'.
+        ann_index (str): Approximate nearest-neighbour index for the numpy backend: 'ivf' to
+            always build one, 'none' to always search exactly, or 'auto' to build one once the
+            store holds ANN_MIN_VECTORS vectors. Default is 'auto'.
+        ann_nlist (int): Number of IVF clusters. Default is 4 * sqrt(number of vectors).
+        keyword_backend (str): 'bm25' for the ranked BM25Index or 'table' for llama_index's
+            SimpleKeywordTableIndex. Default is 'bm25'.
+        ocr_manifest (dict): Manifest returned by `ocr.ocr_pdf_files` for input_dir. Hashes it
+            recorded are reused for files that have not changed since, instead of re-reading them.
+        progress (callable): Called as progress(stage, fraction, message) while ingesting, with
+            stage one of 'scan', 'load', 'embed', 'persist' and 'publish'. Default is None.
+        embed_batch_nodes (int): Nodes embedded and inserted per step; progress is reported
+            after each step. Default is 256.
+        streaming (bool): Read and split files lazily, one file at a time, so peak memory
+            depends on embed_batch_nodes rather than on the number of documents. With False
+            all documents are loaded and split first, using num_workers. Default is True.
+        embed_backend (str): 'torch', 'onnx' or 'onnx-int8' for the batched EmbeddingService, or
+            'huggingface' for HuggingFaceEmbedding. The ONNX models are exported on first use;
+            'onnx-int8' vectors differ slightly and force a full rebuild. Default is 'torch'.
+        embed_threads (int): Intra-op threads per embedding process. Default is CPU count / processes.
+        embed_processes (int): Processes the embedding batches are sharded across. Default is 1.
+        embed_memory_mb (int): Activation memory budget that sizes embedding batches. Default is 512.
+
+    The indices are written to a new version directory under `versions/` and published
+    by atomically replacing the user's CURRENT pointer, so query engines loading them
+    never see a partial index and pick up the new version on their next request.
 
     Returns:
         dict: Paths to the stored vector and keyword indices.
     """
-    # Create user-specific directories
+    def report(stage, fraction, message=""):
+        if progress is not None:
+            progress(stage, fraction, message)
+
+    # Read from the published version; write the result to a new one
     user_dir = os.path.join(base_dir, user_id)
-    vector_store_dir = os.path.join(user_dir, "vector_index")
-    keyword_store_dir = os.path.join(user_dir, "keyword_index")
-    os.makedirs(vector_store_dir, exist_ok=True)
-    os.makedirs(keyword_store_dir, exist_ok=True)
+    os.makedirs(user_dir, exist_ok=True)
+    current_dir = current_index_dir(user_dir)
+    vector_store_dir = os.path.join(current_dir, "vector_index")
+    keyword_store_dir = os.path.join(current_dir, "keyword_index")
 
     # Initialize the LLM and embedding model
-    llm = Ollama(model=llm_model_name, request_timeout=120.0)
+    llm = get_llm(llm_model_name)
     Settings.llm = llm
 
-    embed_model = HuggingFaceEmbedding(model_name=embedding_model_name, trust_remote_code=True)
+    service_options = {}
+    if embed_backend != "huggingface":
+        service_options = {
+            "threads": embed_threads,
+            "processes": embed_processes,
+            "memory_mb": embed_memory_mb,
+            "onnx_dir": default_onnx_dir(embedding_model_name, base_dir),
+        }
+    embed_model = get_embed_model(
+        embedding_model_name,
+        cache_path=os.path.join(base_dir, EMBEDDING_CACHE_FILENAME),
+        backend=embed_backend,
+        **service_options,
+    )
     Settings.embed_model = embed_model
+    embed_service = embed_model.inner if isinstance(embed_model, CachedEmbedding) else embed_model
+    if isinstance(embed_service, EmbeddingService):
+        embed_service.reset_stats()
 
-    # Load documents from the specified directory
-    documents = SimpleDirectoryReader(input_dir=input_dir, recursive=True).load_data(
-        show_progress=True, num_workers=num_workers
-    )
+    # Hash the files on disk and work out what differs from the last ingest
+    settings = {
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        # Includes the ONNX backend suffix, since its vectors differ from the original model's
+        "embedding_model_name": embed_model.model_name,
+        "vector_store_backend": vector_store_backend,
+        "keyword_backend": keyword_backend,
+    }
+    if keyword_backend == "bm25":
+        # Indices built by an older tokenizer are rebuilt, so documents and queries split alike
+        settings["bm25_tokenizer"] = TOKENIZER_VERSION
+    report("scan", 0.0, "Hashing files")
+    current_files = scan_directory(input_dir)
+    current_hashes = {
+        rel_path: _known_sha256(ocr_manifest, input_dir, rel_path, path) or file_sha256(path)
+        for rel_path, path in current_files.items()
+    }
 
-    # Set up the ingestion pipeline
-    pipeline = IngestionPipeline(
-        transformations=[TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)]
-    )
+    manifest = load_manifest(current_dir) if incremental else None
+    if (
+        manifest is not None
+        and manifest["settings"] == settings
+        and _indices_exist(vector_store_dir, keyword_store_dir, keyword_backend)
+    ):
+        if is_bundle(current_dir):
+            vector_index = load_bundle_index(current_dir, embed_model=embed_model)
+        else:
+            vector_index = load_index_from_storage(
+                StorageContext.from_defaults(persist_dir=vector_store_dir, vector_store=load_vector_store(vector_store_dir))
+            )
+        if keyword_backend == "bm25":
+            keyword_index = BM25Index.load(keyword_store_dir)
+        else:
+            keyword_index = load_index_from_storage(StorageContext.from_defaults(persist_dir=keyword_store_dir))
+        changed, removed = diff_manifest(manifest, current_hashes)
+        print(f"Incremental ingest: {len(changed)} new or changed file(s), {len(removed)} removed file(s).")
+    else:
+        manifest = new_manifest(settings)
+        if vector_store_backend not in ("numpy", "simple"):
+            raise ValueError(f"Invalid vector store backend: {vector_store_backend}")
+        if keyword_backend not in ("bm25", "table"):
+            raise ValueError(f"Invalid keyword backend: {keyword_backend}")
+        vector_store = NumpyVectorStore() if vector_store_backend == "numpy" else None
+        vector_index = VectorStoreIndex([], storage_context=StorageContext.from_defaults(vector_store=vector_store))
+        keyword_index = BM25Index() if keyword_backend == "bm25" else SimpleKeywordTableIndex([])
+        changed, removed = list(current_hashes), []
+        print(f"Full ingest: {len(changed)} file(s).")
+
+    report("scan", 1.0, f"{len(changed)} new or changed file(s), {len(removed)} removed file(s)")
+
+    if not changed and not removed:
+        print(f"Indices for user '{user_id}' are up to date.")
+        report("publish", 1.0, "Indices are up to date")
+        return
+
+    # Drop nodes belonging to files that were modified or deleted
+    stale_node_ids = [
+        node_id
+        for rel_path in changed + removed
+        for node_id in manifest["files"].get(rel_path, {}).get("node_ids", [])
+    ]
+    _delete_nodes(vector_index, keyword_index, stale_node_ids)
+    for rel_path in removed:
+        del manifest["files"][rel_path]
+
+    if changed:
+        # Read, split, embed and insert the new or changed documents one batch at a time
+        input_files = [current_files[rel_path] for rel_path in changed]
+        splitter = TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        report("load", 0.0, f"Loading {len(changed)} file(s)")
+
+        node_ids_by_path = {}
+        inserted = 0
+        for batch, files_done in _iter_node_batches(input_files, splitter, embed_batch_nodes, streaming, num_workers):
+            vector_index.insert_nodes(batch)
+            keyword_index.insert_nodes(batch)
+            for node in batch:
+                node_ids_by_path.setdefault(os.path.abspath(node.metadata["file_path"]), []).append(node.node_id)
+            inserted += len(batch)
+            report("embed", files_done / len(input_files), f"Embedded {inserted} chunks from {files_done}/{len(input_files)} file(s)")
+
+        # Record which nodes came from which file
+        for rel_path in changed:
+            manifest["files"][rel_path] = {
+                "sha256": current_hashes[rel_path],
+                "node_ids": node_ids_by_path.get(current_files[rel_path], []),
+            }
+
+    # Build, retrain or drop the approximate nearest-neighbour index
+    if isinstance(vector_index.vector_store, NumpyVectorStore):
+        _update_ann_index(vector_index.vector_store, ann_index, ann_nlist)
 
-    # Run the pipeline to process documents
-    nodes = pipeline.run(documents=documents, num_workers=num_workers)
+    # Persist into a fresh version directory, then publish it
+    report("persist", 0.0, "Writing indices")
+    version, version_dir = new_version_dir(user_dir)
+    vector_store_dir = os.path.join(version_dir, "vector_index")
+    keyword_store_dir = os.path.join(version_dir, "keyword_index")
+    bundle = isinstance(vector_index.vector_store, NumpyVectorStore) and isinstance(keyword_index, BM25Index)
+    try:
+        if bundle:
+            # Both indices share one node store instead of JSON docstores
+            vector_index.vector_store.persist(os.path.join(vector_store_dir, DEFAULT_VECTOR_STORE_FNAME))
+            keyword_index.persist(keyword_store_dir)
+        else:
+            vector_index.storage_context.persist(persist_dir=vector_store_dir)
+            if isinstance(keyword_index, BM25Index):
+                keyword_index.persist(keyword_store_dir)
+            else:
+                keyword_index.storage_context.persist(persist_dir=keyword_store_dir)
+        save_manifest(version_dir, manifest)
+        if bundle:
+            write_bundle(version_dir, vector_index)
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+    report("persist", 1.0, "Indices written")
 
-    # Create VectorStoreIndex and KeywordTableIndex
-    vector_index = VectorStoreIndex(nodes)
-    keyword_index = SimpleKeywordTableIndex(nodes)
+    publish_version(user_dir, version)
+    prune_versions(user_dir)
+    report("publish", 1.0, f"Published index version {version}")
 
-    # Persist indices to user-specific directories
-    vector_index.storage_context.persist(persist_dir=vector_store_dir)
-    keyword_index.storage_context.persist(persist_dir=keyword_store_dir)
+    if isinstance(embed_model, CachedEmbedding):
+        print(f"Embedding cache: {embed_model.cache.stats()}")
+    if isinstance(embed_service, EmbeddingService):
+        print(f"Embedding throughput: {embed_service.stats()}")
 
-    print(f"Vector index saved at: {vector_store_dir}")
-    print(f"Keyword index saved at: {keyword_store_dir}")
+    published_dir = current_index_dir(user_dir)
+    print(f"Vector index saved at: {os.path.join(published_dir, 'vector_index')}")
+    print(f"Keyword index saved at: {os.path.join(published_dir, 'keyword_index')}")
 
     # return {
     #     "vector_index_path": vector_store_dir,
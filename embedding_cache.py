@@ -0,0 +1,209 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from typing import Any, List
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from pydantic import PrivateAttr
+
+from query_batcher import embed_queries
+
+# Default location of the shared on-disk embedding cache
+DEFAULT_CACHE_PATH = "./user_data/embedding_cache.sqlite"
+
+def normalize_text(text: str):
+    """Collapse whitespace so that re-chunked or re-extracted text maps to the same key."""
+    return re.sub(r"\s+", " ", text).strip()
+
+def text_hash(text: str):
+    """Return the cache key hash of a chunk of text."""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    SQLite-backed embedding cache keyed by (model name, normalized text hash).
+
+    Vectors are stored as raw float32 blobs. The cache is bounded by `max_entries`;
+    once it is exceeded the least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = 1_000_000):
+        """
+        Args:
+            path (str): Path of the SQLite database file.
+            max_entries (int): Maximum number of cached vectors across all models.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)")
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model: str, hashes: List[str]):
+        """
+        Look up cached vectors.
+
+        Args:
+            model (str): Embedding model name.
+            hashes (List[str]): Text hashes to look up.
+
+        Returns:
+            dict: Mapping of text hash -> embedding (list of floats) for the hits.
+        """
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            # SQLite limits the number of bound parameters per statement
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch],
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, key) for key in found],
+                )
+            self.hits += sum(1 for key in hashes if key in found)
+            self.misses += sum(1 for key in hashes if key not in found)
+        return found
+
+    def put_many(self, model: str, items: dict):
+        """
+        Store vectors and evict the least recently used entries if the cache is over its bound.
+
+        Args:
+            model (str): Embedding model name.
+            items (dict): Mapping of text hash -> embedding.
+        """
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_access) VALUES (?, ?, ?, ?)",
+                [(model, key, array("f", vector).tobytes(), now) for key, vector in items.items()],
+            )
+            self._conn.execute("COMMIT")
+            self._count += len(items)
+            if self._count > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        """Trim the cache to 90% of max_entries, oldest access first."""
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = self._count - int(self.max_entries * 0.9)
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE (model, text_hash) IN "
+                "(SELECT model, text_hash FROM embeddings ORDER BY last_access LIMIT ?)",
+                (excess,),
+            )
+            self._count -= excess
+            print(f"Embedding cache evicted {excess} entries.")
+
+    def stats(self):
+        """Return hit/miss counters and the number of cached vectors."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": self._count,
+            }
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Embedding model wrapper that serves repeated texts from an EmbeddingCache."""
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, cache: EmbeddingCache, **kwargs: Any):
+        """
+        Args:
+            inner (BaseEmbedding): The embedding model that computes cache misses.
+            cache (EmbeddingCache): The cache to read from and write to.
+        """
+        super().__init__(
+            model_name=inner.model_name,
+            embed_batch_size=inner.embed_batch_size,
+            callback_manager=inner.callback_manager,
+            **kwargs,
+        )
+        self._inner = inner
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def inner(self):
+        return self._inner
+
+    def _cached(self, namespace: str, texts: List[str], compute):
+        """Return embeddings for texts, computing and storing only the misses."""
+        model = f"{self.model_name}#{namespace}"
+        hashes = [text_hash(text) for text in texts]
+        found = self._cache.get_many(model, hashes)
+
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            computed = dict(zip(missing, compute(list(missing.values()))))
+            self._cache.put_many(model, computed)
+            found.update(computed)
+        return [found[key] for key in hashes]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._cached("query", [query], lambda qs: [self._inner._get_query_embedding(q) for q in qs])[0]
+
+    def _get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        return self._cached("query", queries, lambda qs: embed_queries(self._inner, qs))
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._cached("text", texts, self._inner._get_text_embeddings)
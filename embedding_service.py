@@ -0,0 +1,444 @@
+import os
+import json
+import time
+import argparse
+import threading
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from pydantic import PrivateAttr
+
+# Backends of EmbeddingService; the ONNX ones need an exported model (see export_onnx)
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+# Default memory budget for the activations of the batches in flight
+DEFAULT_MEMORY_MB = 512
+
+# Upper bound on sequences per batch, however short they are
+MAX_BATCH_SIZE = 256
+
+# Rough number of float32 activations per token and hidden unit alive in one encoder layer
+# (Q/K/V projections, attention output, the 4x wide feed-forward layer and residuals)
+ACTIVATIONS_PER_HIDDEN = 8
+
+# Description of an exported ONNX model, written last so a partial export is never used
+ONNX_CONFIG_FILENAME = "embedding_config.json"
+ONNX_MODEL_FILES = {"onnx": "model.onnx", "onnx-int8": "model_int8.onnx"}
+
+
+def _instructions(model_name: str):
+    """Return the (query, text) prefixes HuggingFaceEmbedding uses for model_name."""
+    from llama_index.embeddings.huggingface.utils import (
+        get_query_instruct_for_model_name,
+        get_text_instruct_for_model_name,
+    )
+    return get_query_instruct_for_model_name(model_name) or "", get_text_instruct_for_model_name(model_name) or ""
+
+
+def _normalize(vectors: np.ndarray):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _pool(hidden: np.ndarray, attention_mask: np.ndarray, pooling: str):
+    """Reduce last hidden states (batch, sequence, hidden) to one vector per sequence."""
+    if pooling == "cls":
+        return hidden[:, 0]
+    mask = attention_mask[:, :, None].astype(hidden.dtype)
+    return (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+
+class _TorchEncoder:
+    """sentence-transformers model run directly on pre-tokenized, padded batches."""
+
+    def __init__(self, model_name: str, threads: int):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        torch.set_num_threads(threads)
+        self._torch = torch
+        self.model = SentenceTransformer(model_name, device="cpu", trust_remote_code=True)
+        self.model.eval()
+        self.tokenizer = self.model.tokenizer
+        config = self.model[0].auto_model.config
+        self.hidden_size = config.hidden_size
+        self.num_heads = config.num_attention_heads
+        self.max_length = self.model.max_seq_length
+        self.pad_token_id = self.tokenizer.pad_token_id or 0
+        self.use_token_type_ids = "token_type_ids" in self.tokenizer.model_input_names
+
+    def tokenize(self, texts: List[str]):
+        encoded = self.tokenizer(texts, truncation=True, max_length=self.max_length, return_attention_mask=False)
+        return encoded["input_ids"]
+
+    def encode(self, input_ids: np.ndarray, attention_mask: np.ndarray):
+        torch = self._torch
+        features = {"input_ids": torch.from_numpy(input_ids), "attention_mask": torch.from_numpy(attention_mask)}
+        if self.use_token_type_ids:
+            features["token_type_ids"] = torch.zeros_like(features["input_ids"])
+        with torch.inference_mode():
+            vectors = self.model(features)["sentence_embedding"]
+        return _normalize(vectors.float().numpy())
+
+
+class _OnnxEncoder:
+    """ONNX Runtime session over a model written by export_onnx; needs no torch at run time."""
+
+    def __init__(self, model_dir: str, backend: str, threads: int):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, ONNX_CONFIG_FILENAME), "r") as f:
+            config = json.load(f)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, ONNX_MODEL_FILES[backend]), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.no_padding()
+        self.tokenizer.enable_truncation(config["max_length"])
+        self.hidden_size = config["hidden_size"]
+        self.num_heads = config["num_heads"]
+        self.max_length = config["max_length"]
+        self.pad_token_id = config["pad_token_id"]
+        self.pooling = config["pooling"]
+
+    def tokenize(self, texts: List[str]):
+        return [encoding.ids for encoding in self.tokenizer.encode_batch(texts)]
+
+    def encode(self, input_ids: np.ndarray, attention_mask: np.ndarray):
+        feed = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feed["token_type_ids"] = np.zeros_like(input_ids)
+        hidden = self.session.run(["last_hidden_state"], feed)[0]
+        return _normalize(_pool(hidden, attention_mask, self.pooling).astype(np.float32))
+
+
+def _load_encoder(spec: tuple, threads: int):
+    """Load the encoder described by spec: ('torch', model_name) or (backend, onnx_dir)."""
+    backend, source = spec
+    if backend == "torch":
+        return _TorchEncoder(source, threads)
+    return _OnnxEncoder(source, backend, threads)
+
+
+# Encoder of a shard worker process
+_worker_encoder = None
+
+def _init_worker(spec: tuple, threads: int):
+    global _worker_encoder
+    _worker_encoder = _load_encoder(spec, threads)
+
+def _encode_in_worker(input_ids: np.ndarray, attention_mask: np.ndarray):
+    return _worker_encoder.encode(input_ids, attention_mask)
+
+
+def default_onnx_dir(model_name: str, base_dir: str = "./user_data"):
+    """Directory an ONNX export of model_name is kept in by default."""
+    return os.path.join(base_dir, "onnx", model_name.replace("/", "--"))
+
+
+def export_onnx(model_name: str, output_dir: str, quantize: bool = True, opset: int = 17):
+    """
+    Export a sentence-transformers model to ONNX, optionally with an int8 copy.
+
+    The transformer is exported with dynamic batch and sequence axes; pooling and
+    normalization are applied by EmbeddingService. With quantize, the weights of
+    model_int8.onnx are dynamically quantized to int8, which is faster on most CPUs
+    at a small cost in vector accuracy.
+
+    Args:
+        model_name (str): Name of the HuggingFace embedding model.
+        output_dir (str): Directory for model.onnx, model_int8.onnx and the tokenizer.
+        quantize (bool): Also write the int8 model. Default is True.
+        opset (int): ONNX opset version. Default is 17.
+
+    Returns:
+        str: output_dir.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    os.makedirs(output_dir, exist_ok=True)
+    model = SentenceTransformer(model_name, device="cpu", trust_remote_code=True)
+    transformer = model[0].auto_model.eval()
+    tokenizer = model.tokenizer
+
+    print(f"Exporting {model_name} to ONNX in {output_dir}")
+    sample = tokenizer(["An example sentence to trace the model."], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+    fp32_path = os.path.join(output_dir, ONNX_MODEL_FILES["onnx"])
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            ({name: sample[name] for name in input_names},),
+            fp32_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+        )
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        print("Quantizing weights to int8")
+        quantize_dynamic(fp32_path, os.path.join(output_dir, ONNX_MODEL_FILES["onnx-int8"]), weight_type=QuantType.QInt8)
+
+    tokenizer.save_pretrained(output_dir)
+    config = {
+        "model_name": model_name,
+        "pooling": model[1].get_pooling_mode_str(),
+        "max_length": model.max_seq_length,
+        "hidden_size": transformer.config.hidden_size,
+        "num_heads": transformer.config.num_attention_heads,
+        "pad_token_id": tokenizer.pad_token_id or 0,
+        "quantized": quantize,
+    }
+    with open(os.path.join(output_dir, ONNX_CONFIG_FILENAME) + ".tmp", "w") as f:
+        json.dump(config, f, indent=2)
+    os.replace(os.path.join(output_dir, ONNX_CONFIG_FILENAME) + ".tmp", os.path.join(output_dir, ONNX_CONFIG_FILENAME))
+    return output_dir
+
+
+class EmbeddingService(BaseEmbedding):
+    """
+    CPU embedding engine for bulk ingestion.
+
+    Each call tokenizes its texts once and sorts them by token length, so every
+    batch pads to nearly the same length. Batches are sized from a memory budget:
+    short chunks go in large batches, long ones in small batches. The model runs
+    with `threads` intra-op threads. With processes > 1, batches are sharded
+    across worker processes, each with its own model copy and cores / processes
+    threads. Vectors match HuggingFaceEmbedding's for the 'torch' backend; the
+    ONNX backends use an export of the same model (see export_onnx).
+    """
+
+    _spec: tuple = PrivateAttr()
+    _encoder: Any = PrivateAttr()
+    _pool: Any = PrivateAttr(default=None)
+    _threads: int = PrivateAttr()
+    _processes: int = PrivateAttr()
+    _memory_mb: int = PrivateAttr()
+    _max_batch_size: int = PrivateAttr()
+    _query_instruction: str = PrivateAttr()
+    _text_instruction: str = PrivateAttr()
+    _stats: dict = PrivateAttr()
+    _stats_lock: Any = PrivateAttr()
+
+    def __init__(
+        self,
+        model_name: str = "BAAI/bge-small-en-v1.5",
+        backend: str = "torch",
+        onnx_dir: str = None,
+        threads: int = None,
+        processes: int = 1,
+        memory_mb: int = DEFAULT_MEMORY_MB,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        **kwargs: Any,
+    ):
+        """
+        Args:
+            model_name (str): Name of the HuggingFace embedding model.
+            backend (str): 'torch', 'onnx' or 'onnx-int8'. Default is 'torch'.
+            onnx_dir (str): Directory of the ONNX export; exported on first use if missing.
+                Default is default_onnx_dir(model_name).
+            threads (int): Intra-op threads per process. Default is CPU count / processes.
+            processes (int): Worker processes to shard batches across. Default is 1 (in-process).
+            memory_mb (int): Activation memory budget shared by the batches in flight. Default is 512.
+            max_batch_size (int): Upper bound on sequences per batch. Default is 256.
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown embedding backend {backend!r}; expected one of {BACKENDS}")
+        # Quantized vectors differ slightly, so they get their own name (and cache namespace)
+        name = model_name if backend == "torch" else f"{model_name}@{backend}"
+        # Take the whole insert batch in one call so it can be sorted and re-batched here
+        super().__init__(model_name=name, embed_batch_size=2048, **kwargs)
+
+        self._processes = max(1, processes)
+        self._threads = threads or max(1, (os.cpu_count() or 1) // self._processes)
+        self._memory_mb = memory_mb
+        self._max_batch_size = max_batch_size
+        self._query_instruction, self._text_instruction = _instructions(model_name)
+
+        if backend == "torch":
+            self._spec = ("torch", model_name)
+        else:
+            onnx_dir = onnx_dir or default_onnx_dir(model_name)
+            exported = [os.path.join(onnx_dir, ONNX_CONFIG_FILENAME), os.path.join(onnx_dir, ONNX_MODEL_FILES[backend])]
+            if not all(os.path.exists(path) for path in exported):
+                export_onnx(model_name, onnx_dir, quantize=backend == "onnx-int8")
+            self._spec = (backend, onnx_dir)
+
+        # The local encoder tokenizes and embeds queries; batches go to the workers if any
+        print(f"Loading embedding service: {name} ({self._processes} process(es) x {self._threads} thread(s))")
+        self._encoder = _load_encoder(self._spec, self._threads)
+        if self._processes > 1:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self._processes,
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self._spec, self._threads),
+            )
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "EmbeddingService"
+
+    def _sequence_bytes(self, length: int):
+        """Estimated activation bytes of one sequence padded to length tokens."""
+        encoder = self._encoder
+        return 4 * length * (encoder.hidden_size * ACTIVATIONS_PER_HIDDEN + encoder.num_heads * length)
+
+    def plan_batches(self, lengths: List[int]):
+        """
+        Split token lengths sorted longest first into (start, end) batches within the memory budget.
+
+        The first sequence of a batch is its longest, so it sets the padded length.
+        """
+        budget = self._memory_mb * 2**20 / self._processes
+        start = 0
+        while start < len(lengths):
+            size = int(max(1, min(self._max_batch_size, budget // self._sequence_bytes(lengths[start]))))
+            yield start, min(start + size, len(lengths))
+            start += size
+
+    def _pad(self, token_ids: List[List[int]]):
+        """Right-pad token id lists into (input_ids, attention_mask) int64 arrays."""
+        width = max(len(ids) for ids in token_ids)
+        input_ids = np.full((len(token_ids), width), self._encoder.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(token_ids), width), dtype=np.int64)
+        for row, ids in enumerate(token_ids):
+            input_ids[row, :len(ids)] = ids
+            attention_mask[row, :len(ids)] = 1
+        return input_ids, attention_mask
+
+    def embed(self, texts: List[str]):
+        """
+        Embed texts (already carrying any instruction prefix).
+
+        Returns:
+            np.ndarray: float32 matrix of L2-normalized vectors, one row per text.
+        """
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        start_time = time.perf_counter()
+        token_ids = self._encoder.tokenize(texts)
+        order = sorted(range(len(texts)), key=lambda i: len(token_ids[i]), reverse=True)
+        lengths = [len(token_ids[i]) for i in order]
+
+        batches = []
+        for start, end in self.plan_batches(lengths):
+            rows = order[start:end]
+            batches.append((rows, self._pad([token_ids[i] for i in rows])))
+
+        if self._pool is not None and len(batches) > 1:
+            futures = [self._pool.submit(_encode_in_worker, *arrays) for _, arrays in batches]
+            results = [future.result() for future in futures]
+        else:
+            results = [self._encoder.encode(*arrays) for _, arrays in batches]
+
+        vectors = None
+        for (rows, _), result in zip(batches, results):
+            if vectors is None:
+                vectors = np.empty((len(texts), result.shape[1]), dtype=np.float32)
+            vectors[rows] = result
+
+        with self._stats_lock:
+            self._stats["chunks"] += len(texts)
+            self._stats["tokens"] += sum(lengths)
+            self._stats["padded_tokens"] += sum(arrays[0].size for _, arrays in batches)
+            self._stats["batches"] += len(batches)
+            self._stats["seconds"] += time.perf_counter() - start_time
+        return vectors
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats = {"chunks": 0, "tokens": 0, "padded_tokens": 0, "batches": 0, "seconds": 0.0}
+
+    def stats(self):
+        """Return throughput counters since the last reset, including chunks/sec."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        seconds = stats["seconds"]
+        stats["seconds"] = round(seconds, 3)
+        stats["chunks_per_sec"] = round(stats["chunks"] / seconds, 1) if seconds else 0.0
+        stats["tokens_per_sec"] = round(stats["tokens"] / seconds, 1) if seconds else 0.0
+        stats["padding_ratio"] = round(1 - stats["tokens"] / stats["padded_tokens"], 3) if stats["padded_tokens"] else 0.0
+        return stats
+
+    def close(self):
+        """Shut down the shard worker processes."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self.embed([self._query_instruction + query])[0].tolist()
+
+    def _get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        return self.embed([self._query_instruction + query for query in queries]).tolist()
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self.embed([self._text_instruction + text for text in texts]).tolist()
+
+
+def _benchmark_texts(n: int):
+    """Synthetic chunks of varied length for the throughput benchmark."""
+    rng = np.random.default_rng(0)
+    words = "retrieval augmented generation splits documents into chunks and embeds each one".split()
+    return [" ".join(rng.choice(words, size=int(rng.integers(16, 400)))) for _ in range(n)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the embedding model to ONNX or measure embedding throughput.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export the model to ONNX, with an int8 copy.")
+    export_parser.add_argument("--model", default="BAAI/bge-small-en-v1.5")
+    export_parser.add_argument("--output", default=None, help="Default: ./user_data/onnx/<model>.")
+    export_parser.add_argument("--no-quantize", action="store_true")
+
+    bench_parser = subparsers.add_parser("bench", help="Report chunks/sec on synthetic chunks.")
+    bench_parser.add_argument("--model", default="BAAI/bge-small-en-v1.5")
+    bench_parser.add_argument("--backend", default="torch", choices=BACKENDS)
+    bench_parser.add_argument("--onnx-dir", default=None)
+    bench_parser.add_argument("--threads", type=int, default=None)
+    bench_parser.add_argument("--processes", type=int, default=1)
+    bench_parser.add_argument("--memory-mb", type=int, default=DEFAULT_MEMORY_MB)
+    bench_parser.add_argument("--chunks", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_onnx(args.model, args.output or default_onnx_dir(args.model), quantize=not args.no_quantize)
+    else:
+        service = EmbeddingService(
+            args.model,
+            backend=args.backend,
+            onnx_dir=args.onnx_dir,
+            threads=args.threads,
+            processes=args.processes,
+            memory_mb=args.memory_mb,
+        )
+        texts = _benchmark_texts(args.chunks)
+        service.embed(texts[:8])
+        service.reset_stats()
+        service.embed(texts)
+        print(json.dumps(service.stats(), indent=4))
+        service.close()
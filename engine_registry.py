@@ -0,0 +1,242 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from chat import initialize_query_engine
+from answer_cache import SemanticAnswerCache
+from index_versions import current_index_dir, current_version
+
+# Directories inside an index version (or a legacy user folder) that make up the persisted indices
+INDEX_DIR_NAMES = ("vector_index", "keyword_index", "node_store")
+
+
+def index_fingerprint(user_id: str, base_dir: str = "./user_data"):
+    """
+    Compute a fingerprint of a user's published indices.
+
+    For versioned indices this is the published version id, so publishing a new
+    version makes cached engines reload. Indices in the pre-versioning layout are
+    fingerprinted from file names, sizes and mtimes.
+
+    Args:
+        user_id (str): Unique identifier for the user.
+        base_dir (str): Base directory where user-specific indices are stored.
+
+    Returns:
+        tuple: (fingerprint string, total size in bytes) or (None, 0) if no index exists.
+    """
+    user_dir = os.path.join(base_dir, user_id)
+    version = current_version(user_dir)
+    index_root = current_index_dir(user_dir)
+    digest = hashlib.sha1()
+    total_size = 0
+    found = False
+
+    for dir_name in INDEX_DIR_NAMES:
+        index_dir = os.path.join(index_root, dir_name)
+        if not os.path.isdir(index_dir):
+            continue
+        found = True
+        for root, _, files in os.walk(index_dir):
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                total_size += stat.st_size
+                digest.update(f"{os.path.relpath(path, index_root)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+
+    if not found:
+        return None, 0
+    if version is not None:
+        return f"version:{version}", total_size
+    return digest.hexdigest(), total_size
+
+
+class _RegistryEntry:
+    """A loaded query engine together with the index state it was built from."""
+
+    def __init__(self, engine, fingerprint: str, size_bytes: int):
+        self.engine = engine
+        self.fingerprint = fingerprint
+        self.size_bytes = size_bytes
+
+
+class EngineRegistry:
+    """
+    Process-wide cache of per-user query engines.
+
+    Engines are keyed by user_id and engine config, kept in LRU order and evicted
+    once either the entry count or the estimated memory budget is exceeded. An
+    entry is rebuilt when the user's index directories change on disk.
+    """
+
+    def __init__(
+        self,
+        base_dir: str = "./user_data",
+        max_engines: int = 16,
+        memory_budget_mb: int = 2048,
+        memory_factor: float = 3.0,
+        answer_cache: bool = True,
+        answer_cache_threshold: float = 0.95,
+        answer_cache_ttl: float = 3600,
+        answer_cache_size: int = 256,
+    ):
+        """
+        Args:
+            base_dir (str): Base directory where user-specific indices are stored.
+            max_engines (int): Maximum number of engines kept loaded at once.
+            memory_budget_mb (int): Approximate memory budget for all loaded indices.
+            memory_factor (float): Multiplier from on-disk index size to in-memory size.
+            answer_cache (bool): Wrap engines in a per-user semantic answer cache. Default is True.
+            answer_cache_threshold (float): Cosine similarity needed to reuse an answer.
+            answer_cache_ttl (float): Seconds a cached answer stays valid.
+            answer_cache_size (int): Maximum cached answers per user and engine config.
+        """
+        self.base_dir = base_dir
+        self.max_engines = max_engines
+        self.memory_budget_bytes = memory_budget_mb * 1024 * 1024
+        self.memory_factor = memory_factor
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.answer_cache = answer_cache
+        self._answer_cache_options = {
+            "threshold": answer_cache_threshold,
+            "ttl_seconds": answer_cache_ttl,
+            "max_entries": answer_cache_size,
+        }
+        # Answer caches outlive evicted engines and are emptied when the index fingerprint changes
+        self._answer_caches = {}
+
+    def _make_key(self, user_id: str, config: dict):
+        return (user_id, tuple(sorted(config.items())))
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def get_query_engine(self, user_id: str, **config):
+        """
+        Return a query engine for the user, loading it only if it is not cached or is stale.
+
+        Args:
+            user_id (str): Unique identifier for the user.
+            **config: Extra keyword arguments forwarded to `initialize_query_engine`.
+
+        Returns:
+            RetrieverQueryEngine: A query engine ready to process user queries.
+        """
+        key = self._make_key(user_id, config)
+
+        # Only one thread loads a given engine; others wait and reuse it
+        with self._key_lock(key):
+            fingerprint, size_bytes = index_fingerprint(user_id, self.base_dir)
+            if fingerprint is None:
+                self.invalidate(user_id)
+                raise FileNotFoundError(f"Indices for user '{user_id}' not found.")
+
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry.fingerprint == fingerprint:
+                    self._entries.move_to_end(key)
+                    return entry.engine
+
+            if entry is not None:
+                print(f"Index for user '{user_id}' changed on disk, reloading query engine.")
+
+            answer_cache = None
+            if self.answer_cache:
+                with self._lock:
+                    answer_cache = self._answer_caches.get(key)
+                    if answer_cache is None:
+                        answer_cache = self._answer_caches[key] = SemanticAnswerCache(**self._answer_cache_options)
+                answer_cache.bind(fingerprint)
+
+            engine = initialize_query_engine(user_id, base_dir=self.base_dir, answer_cache=answer_cache, **config)
+
+            with self._lock:
+                self._entries[key] = _RegistryEntry(engine, fingerprint, int(size_bytes * self.memory_factor))
+                self._entries.move_to_end(key)
+                self._evict()
+            return engine
+
+    def _evict(self):
+        """Drop least recently used engines until the count and memory budget are respected."""
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_engines
+            or sum(e.size_bytes for e in self._entries.values()) > self.memory_budget_bytes
+        ):
+            (user_id, _), _ = self._entries.popitem(last=False)
+            print(f"Evicted query engine for user '{user_id}'.")
+
+    def invalidate(self, user_id: str = None):
+        """
+        Drop cached engines for a user, or for all users when user_id is None.
+
+        Args:
+            user_id (str): Unique identifier for the user. Default is None.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if user_id is None or key[0] == user_id:
+                    del self._entries[key]
+            for key, answer_cache in self._answer_caches.items():
+                if user_id is None or key[0] == user_id:
+                    answer_cache.clear()
+
+    def stats(self):
+        """Return the loaded engine keys and their estimated memory use."""
+        with self._lock:
+            return {
+                "engines": len(self._entries),
+                "estimated_bytes": sum(e.size_bytes for e in self._entries.values()),
+                "users": sorted({key[0] for key in self._entries}),
+            }
+
+
+def load_engine_options(user_id: str, users_file: str = "users.json", **overrides):
+    """
+    Read per-user engine options from the "engine_options" entry in users.json.
+
+    For example {"reranker": "cross_encoder", "retriever_mode": "WEIGHTED"}.
+
+    Args:
+        user_id (str): Unique identifier for the user.
+        users_file (str): Path to the users file. Default is 'users.json'.
+        **overrides: Options set by the caller, e.g. streaming=True; they win over users.json.
+
+    Returns:
+        dict: Keyword arguments for `initialize_query_engine`; empty if none are set.
+    """
+    try:
+        with open(users_file, "r") as f:
+            users = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        users = {}
+    options = dict(users.get(user_id, {}).get("engine_options") or {})
+    options.update(overrides)
+    return options
+
+
+# Default registry shared by the Streamlit app, the API server and the voice bot
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry(base_dir: str = "./user_data"):
+    """Return the process-wide EngineRegistry, creating it on first use."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = EngineRegistry(base_dir=base_dir)
+        return _registry
+
+def get_query_engine(user_id: str, **config):
+    """Shortcut for `get_registry().get_query_engine(user_id, **config)`."""
+    return get_registry().get_query_engine(user_id, **config)
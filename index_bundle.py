@@ -0,0 +1,429 @@
+import os
+import json
+import argparse
+from typing import Dict, Optional
+
+import numpy as np
+from llama_index.core import StorageContext, VectorStoreIndex
+from llama_index.core.data_structs import IndexDict
+from llama_index.core.schema import NodeRelationship
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.storage.docstore.keyval_docstore import KVDocumentStore
+from llama_index.core.storage.docstore.utils import doc_to_json
+from llama_index.core.storage.index_store import SimpleIndexStore
+from llama_index.core.storage.kvstore.types import BaseKVStore
+
+from ingest_manifest import file_sha256
+from numpy_vector_store import NumpyVectorStore
+
+# Manifest listing an index bundle's files with their sizes and checksums; written last
+BUNDLE_FILENAME = "bundle.json"
+BUNDLE_FORMAT_VERSION = 1
+
+# Directory inside an index version holding the node store shared by the vector and keyword indices
+NODE_STORE_DIR = "node_store"
+NODE_TEXT_FILENAME = "text.bin"
+NODE_OFFSETS_FILENAME = "offsets.npy"
+NODE_RECORDS_FILENAME = "records.json"
+
+# Node fields stored per node; the remaining fields are shared between the nodes that have the same values
+_OWN_FIELDS = ("id_", "text", "embedding", "metadata", "relationships", "start_char_idx", "end_char_idx")
+
+_SOURCE = NodeRelationship.SOURCE.value
+
+
+def is_bundle(index_dir: str) -> bool:
+    """Return True if index_dir holds an index bundle."""
+    return os.path.exists(os.path.join(index_dir, BUNDLE_FILENAME))
+
+
+class _Interner:
+    """Store each distinct JSON value once and refer to it by position."""
+
+    def __init__(self):
+        self.values = []
+        self._positions = {}
+
+    def __call__(self, value) -> int:
+        key = json.dumps(value, sort_keys=True)
+        position = self._positions.get(key)
+        if position is None:
+            position = self._positions[key] = len(self.values)
+            self.values.append(value)
+        return position
+
+
+class _NodeStoreWriter:
+    """
+    Write a node store one node at a time.
+
+    Texts, offsets and records go straight to disk as nodes are added; only the
+    table of shared values stays in memory until `close`.
+    """
+
+    def __init__(self, store_dir: str, n_nodes: int):
+        os.makedirs(store_dir, exist_ok=True)
+        self.count = 0
+        self._shared = _Interner()
+        self._offsets = np.lib.format.open_memmap(
+            os.path.join(store_dir, NODE_OFFSETS_FILENAME), mode="w+", dtype=np.int64, shape=(n_nodes + 1,)
+        )
+        self._offsets[0] = 0
+        self._text = open(os.path.join(store_dir, NODE_TEXT_FILENAME), "wb")
+        self._records = open(os.path.join(store_dir, NODE_RECORDS_FILENAME), "w")
+        self._records.write('{"nodes":[')
+
+    def add(self, node_id: str, node_type: str, text: bytes, common: dict, metadata: dict,
+            start, end, relationships: dict, doc_hash: str):
+        self._text.write(text)
+        self._offsets[self.count + 1] = self._offsets[self.count] + len(text)
+        shared = self._shared
+        records = {}
+        for rel, info in relationships.items():
+            # Neighbour links repeat the page's metadata, and source links repeat entirely
+            info = {**info, "metadata": shared(info.get("metadata") or {})}
+            records[rel] = shared(info) if rel == _SOURCE else info
+        record = [node_id, node_type, shared(common), shared(metadata), start, end, records, doc_hash]
+        self._records.write(("," if self.count else "") + json.dumps(record, separators=(",", ":")))
+        self.count += 1
+
+    def add_doc(self, node_id: str, doc: dict, doc_hash: str):
+        """Add a node serialized by doc_to_json."""
+        data = doc["__data__"]
+        self.add(
+            node_id,
+            doc["__type__"],
+            (data.get("text") or "").encode("utf-8"),
+            {k: v for k, v in data.items() if k not in _OWN_FIELDS},
+            data.get("metadata") or {},
+            data.get("start_char_idx"),
+            data.get("end_char_idx"),
+            data.get("relationships") or {},
+            doc_hash,
+        )
+
+    def close(self):
+        """Write the shared table and close the files."""
+        if self.count != len(self._offsets) - 1:
+            raise ValueError(f"Expected {len(self._offsets) - 1} nodes, {self.count} were written.")
+        self._records.write('],"shared":' + json.dumps(self._shared.values, separators=(",", ":")) + "}")
+        self._offsets.flush()
+        self.abort()
+
+    def abort(self):
+        """Close the files, leaving an incomplete node store."""
+        for f in (self._text, self._records):
+            f.close()
+        # Drops the memory map, so the version directory can be removed
+        self._offsets = None
+
+
+def write_node_store(index_dir: str, docstore, node_ids):
+    """
+    Write the given nodes of docstore as a compact node store.
+
+    Node texts are concatenated into one UTF-8 file addressed by an offsets array.
+    The rest of each node is a short record; metadata, excluded keys, templates and
+    source relationships, which repeat for every chunk of a page, are stored once and
+    referred to by position. Nodes are written one at a time, and nodes a bundle's
+    docstore still holds unchanged are copied from its node store without being
+    parsed, so an incremental ingest never loads the whole store.
+
+    Args:
+        index_dir (str): The index version directory.
+        docstore (BaseDocumentStore): The docstore holding the indexed nodes.
+        node_ids (Sequence[str]): Ids of the nodes to write, in order.
+
+    Returns:
+        int: The number of nodes written.
+    """
+    # A bundle's docstore is a KVDocumentStore over a BundleKVStore
+    source = getattr(docstore, "_kvstore", None)
+    if not isinstance(source, BundleKVStore):
+        source = None
+    writer = _NodeStoreWriter(os.path.join(index_dir, NODE_STORE_DIR), len(node_ids))
+    try:
+        for node_id in node_ids:
+            row = source.unchanged_row(node_id) if source is not None else None
+            if row is not None:
+                source.copy_row(row, writer)
+            else:
+                node = docstore.get_node(node_id)
+                writer.add_doc(node_id, doc_to_json(node), docstore.get_document_hash(node_id))
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return writer.count
+
+
+def write_bundle(index_dir: str, vector_index: VectorStoreIndex):
+    """
+    Seal the index version in index_dir as a bundle.
+
+    Writes the node store of the vector index's docstore, then `bundle.json` with the
+    size and SHA-256 of every file in the version. The manifest is renamed into place
+    last, so a directory with a manifest always holds a complete bundle. The vector
+    and keyword indices must already be persisted in index_dir.
+    """
+    node_ids = list(vector_index.index_struct.nodes_dict.values())
+    count = write_node_store(index_dir, vector_index.docstore, node_ids)
+    files = {}
+    for root, _, filenames in os.walk(index_dir):
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            rel_path = os.path.relpath(path, index_dir).replace(os.sep, "/")
+            if rel_path in (BUNDLE_FILENAME, BUNDLE_FILENAME + ".tmp"):
+                continue
+            files[rel_path] = {"size": os.path.getsize(path), "sha256": file_sha256(path)}
+
+    manifest = {
+        "version": BUNDLE_FORMAT_VERSION,
+        "index_id": vector_index.index_id,
+        "nodes": count,
+        "files": files,
+    }
+    path = os.path.join(index_dir, BUNDLE_FILENAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    return manifest
+
+
+def read_bundle_manifest(index_dir: str, verify: bool = False):
+    """
+    Read a bundle's manifest and check its files.
+
+    Args:
+        index_dir (str): The index version directory.
+        verify (bool): Also compare every file's SHA-256, instead of only its size. Default is False.
+
+    Returns:
+        dict: The manifest.
+
+    Raises:
+        ValueError: If the format is unsupported or a file is missing, truncated or corrupt.
+    """
+    with open(os.path.join(index_dir, BUNDLE_FILENAME), "r") as f:
+        manifest = json.load(f)
+    if manifest["version"] != BUNDLE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported index bundle version: {manifest['version']}")
+    for rel_path, expected in manifest["files"].items():
+        path = os.path.join(index_dir, rel_path)
+        if not os.path.exists(path) or os.path.getsize(path) != expected["size"]:
+            raise ValueError(f"Index bundle file '{path}' is missing or has the wrong size.")
+        if verify and file_sha256(path) != expected["sha256"]:
+            raise ValueError(f"Index bundle file '{path}' does not match its checksum.")
+    return manifest
+
+
+class BundleKVStore(BaseKVStore):
+    """
+    Read-mostly key-value store serving a KVDocumentStore from a node store.
+
+    Node text is memory-mapped and a node is only assembled when it is fetched.
+    The docstore's metadata and ref-doc collections are derived from the node
+    records. Writes, e.g. by an incremental ingest, go to an in-memory overlay and
+    reach disk when the next version is written with `write_bundle`.
+    """
+
+    def __init__(self, store_dir: str, namespace: str = "docstore"):
+        """
+        Args:
+            store_dir (str): The node store directory.
+            namespace (str): The docstore's namespace. Default is 'docstore'.
+        """
+        with open(os.path.join(store_dir, NODE_RECORDS_FILENAME), "r") as f:
+            records = json.load(f)
+        self._shared = records["shared"]
+        self._records = records["nodes"]
+        self._offsets = np.load(os.path.join(store_dir, NODE_OFFSETS_FILENAME), mmap_mode="r")
+        text_path = os.path.join(store_dir, NODE_TEXT_FILENAME)
+        self._text = np.memmap(text_path, dtype=np.uint8, mode="r") if os.path.getsize(text_path) else b""
+        if len(self._offsets) != len(self._records) + 1:
+            raise ValueError(f"Node store at '{store_dir}' is inconsistent.")
+
+        self._rows = {record[0]: row for row, record in enumerate(self._records)}
+        self._ref_doc_nodes = {}
+        for record in self._records:
+            ref_doc_id = self._ref_doc_id(record)
+            if ref_doc_id is not None:
+                self._ref_doc_nodes.setdefault(ref_doc_id, []).append(record[0])
+
+        self._data_collection = f"{namespace}/data"
+        self._metadata_collection = f"{namespace}/metadata"
+        self._ref_doc_collection = f"{namespace}/ref_doc_info"
+        # collection -> key -> value, or None for a deleted key
+        self._overlay = {}
+
+    def _relationship(self, info) -> dict:
+        info = self._shared[info] if isinstance(info, int) else info
+        return {**info, "metadata": self._shared[info["metadata"]]}
+
+    def _ref_doc_id(self, record) -> Optional[str]:
+        source = record[6].get(_SOURCE)
+        if source is None:
+            return None
+        return (self._shared[source] if isinstance(source, int) else source)["node_id"]
+
+    def _node(self, row: int) -> dict:
+        node_id, node_type, common, metadata, start, end, relationships, _ = self._records[row]
+        text = bytes(self._text[self._offsets[row]:self._offsets[row + 1]]).decode("utf-8")
+        data = dict(self._shared[common])
+        data.update(
+            id_=node_id,
+            text=text,
+            embedding=None,
+            metadata=self._shared[metadata],
+            start_char_idx=start,
+            end_char_idx=end,
+            relationships={rel: self._relationship(info) for rel, info in relationships.items()},
+        )
+        return {"__data__": data, "__type__": node_type}
+
+    def unchanged_row(self, key: str) -> Optional[int]:
+        """Return the row of a node that is served from the node store unchanged, else None."""
+        for collection in (self._data_collection, self._metadata_collection):
+            if key in self._overlay.get(collection, {}):
+                return None
+        return self._rows.get(key)
+
+    def copy_row(self, row: int, writer: _NodeStoreWriter):
+        """Add a stored node to writer without decoding its text or assembling the node."""
+        node_id, node_type, common, metadata, start, end, relationships, doc_hash = self._records[row]
+        writer.add(
+            node_id,
+            node_type,
+            bytes(self._text[self._offsets[row]:self._offsets[row + 1]]),
+            self._shared[common],
+            self._shared[metadata],
+            start,
+            end,
+            {rel: self._relationship(info) for rel, info in relationships.items()},
+            doc_hash,
+        )
+
+    def _base_get(self, key: str, collection: str) -> Optional[dict]:
+        if collection == self._ref_doc_collection:
+            node_ids = self._ref_doc_nodes.get(key)
+            if not node_ids:
+                return None
+            metadata = self._shared[self._records[self._rows[node_ids[0]]][3]]
+            return {"node_ids": list(node_ids), "metadata": metadata}
+        row = self._rows.get(key)
+        if row is None:
+            return None
+        if collection == self._data_collection:
+            return self._node(row)
+        if collection == self._metadata_collection:
+            metadata = {"doc_hash": self._records[row][7]}
+            ref_doc_id = self._ref_doc_id(self._records[row])
+            if ref_doc_id is not None:
+                metadata["ref_doc_id"] = ref_doc_id
+            return metadata
+        return None
+
+    def _base_keys(self, collection: str):
+        if collection == self._ref_doc_collection:
+            return self._ref_doc_nodes.keys()
+        if collection in (self._data_collection, self._metadata_collection):
+            return self._rows.keys()
+        return ()
+
+    def put(self, key: str, val: dict, collection: str = "data") -> None:
+        self._overlay.setdefault(collection, {})[key] = val
+
+    async def aput(self, key: str, val: dict, collection: str = "data") -> None:
+        self.put(key, val, collection)
+
+    def get(self, key: str, collection: str = "data") -> Optional[dict]:
+        overlay = self._overlay.get(collection, {})
+        if key in overlay:
+            return overlay[key]
+        return self._base_get(key, collection)
+
+    async def aget(self, key: str, collection: str = "data") -> Optional[dict]:
+        return self.get(key, collection)
+
+    def get_all(self, collection: str = "data") -> Dict[str, dict]:
+        overlay = self._overlay.get(collection, {})
+        values = {key: self._base_get(key, collection) for key in self._base_keys(collection) if key not in overlay}
+        values.update({key: value for key, value in overlay.items() if value is not None})
+        return values
+
+    async def aget_all(self, collection: str = "data") -> Dict[str, dict]:
+        return self.get_all(collection)
+
+    def delete(self, key: str, collection: str = "data") -> bool:
+        existed = self.get(key, collection) is not None
+        self._overlay.setdefault(collection, {})[key] = None
+        return existed
+
+    async def adelete(self, key: str, collection: str = "data") -> bool:
+        return self.delete(key, collection)
+
+
+def load_docstore(index_dir: str):
+    """
+    Return the docstore of the index version in index_dir: lazy for a bundle, else the JSON docstore.
+    """
+    if is_bundle(index_dir):
+        return KVDocumentStore(BundleKVStore(os.path.join(index_dir, NODE_STORE_DIR)))
+    return SimpleDocumentStore.from_persist_dir(os.path.join(index_dir, "vector_index"))
+
+
+def load_bundle_index(index_dir: str, embed_model=None, verify: bool = False):
+    """
+    Load the vector index of a bundle without parsing any per-node JSON docstore.
+
+    The vectors are memory-mapped and nodes are fetched from the node store on demand.
+
+    Args:
+        index_dir (str): The index version directory.
+        embed_model (BaseEmbedding): Embedding model for queries. Default is Settings.embed_model.
+        verify (bool): Check every file's checksum before loading. Default is False,
+            which only checks file sizes.
+
+    Returns:
+        VectorStoreIndex: The loaded index.
+    """
+    manifest = read_bundle_manifest(index_dir, verify=verify)
+    vector_store = NumpyVectorStore.from_persist_dir(os.path.join(index_dir, "vector_index"))
+    docstore = load_docstore(index_dir)
+    index_struct = IndexDict(index_id=manifest["index_id"])
+    for node_id, alive in zip(vector_store.node_ids, vector_store.alive):
+        if alive:
+            index_struct.nodes_dict[node_id] = node_id
+    storage_context = StorageContext.from_defaults(
+        docstore=docstore, index_store=SimpleIndexStore(), vector_store=vector_store
+    )
+    return VectorStoreIndex(index_struct=index_struct, storage_context=storage_context, embed_model=embed_model)
+
+
+def disk_usage(index_dir: str):
+    """Return the bytes used by each top-level entry of an index version directory."""
+    usage = {}
+    for root, _, filenames in os.walk(index_dir):
+        for filename in filenames:
+            top = os.path.relpath(os.path.join(root, filename), index_dir).split(os.sep)[0]
+            usage[top] = usage.get(top, 0) + os.path.getsize(os.path.join(root, filename))
+    return usage
+
+
+if __name__ == "__main__":
+    from index_versions import current_index_dir
+
+    parser = argparse.ArgumentParser(description="Verify a user's published index bundle and show its disk usage.")
+    parser.add_argument("user_id")
+    parser.add_argument("--base-dir", default="./user_data")
+    args = parser.parse_args()
+
+    index_dir = current_index_dir(os.path.join(args.base_dir, args.user_id))
+    print(json.dumps(disk_usage(index_dir), indent=2))
+    if not is_bundle(index_dir):
+        print(f"'{index_dir}' is not an index bundle; re-run ingestion to convert it.")
+    else:
+        manifest = read_bundle_manifest(index_dir, verify=True)
+        print(f"Bundle OK: {manifest['nodes']} nodes, {len(manifest['files'])} files verified.")
@@ -0,0 +1,106 @@
+import os
+import time
+import uuid
+import shutil
+
+# Pointer file naming the published index version inside a user's folder
+CURRENT_FILENAME = "CURRENT"
+
+# Directory inside a user's folder holding one subdirectory per index version
+VERSIONS_DIR = "versions"
+
+# Index directories of the layout used before versioning (directly in the user's folder)
+LEGACY_DIR_NAMES = ("vector_index", "keyword_index")
+
+# Suffix of a version directory that is still being written
+TMP_SUFFIX = ".tmp"
+
+# Age after which an unpublished version directory is treated as left behind by a failed ingest
+STALE_TMP_SECONDS = 24 * 3600
+
+
+def current_version(user_dir: str):
+    """Return the published version id of a user's indices, or None if nothing was published."""
+    try:
+        with open(os.path.join(user_dir, CURRENT_FILENAME), "r") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def current_index_dir(user_dir: str):
+    """
+    Return the directory holding the user's published vector_index and keyword_index.
+
+    This is the published version's directory, or the user's folder itself for
+    indices written before versioning.
+    """
+    version = current_version(user_dir)
+    if version is None:
+        return user_dir
+    return os.path.join(user_dir, VERSIONS_DIR, version)
+
+
+def new_version_dir(user_dir: str):
+    """
+    Create an empty temporary directory for a new index version.
+
+    The directory is named `<version>.tmp` until `publish_version` renames it, so a
+    version directory under its final name is always complete.
+
+    Returns:
+        tuple: (version id, directory path).
+    """
+    # Time-ordered ids keep `versions/` sorted by age
+    now = time.time_ns()
+    version = f"{time.strftime('%Y%m%d%H%M%S', time.localtime(now // 10**9))}{now % 10**9:09d}-{uuid.uuid4().hex[:8]}"
+    version_dir = os.path.join(user_dir, VERSIONS_DIR, version + TMP_SUFFIX)
+    os.makedirs(version_dir)
+    return version, version_dir
+
+
+def publish_version(user_dir: str, version: str):
+    """
+    Make version the user's current index by atomically replacing the CURRENT pointer.
+
+    A version still in its temporary directory is first renamed to its final name.
+    Readers see either the previous version or the new one, never a partial index.
+    """
+    version_dir = os.path.join(user_dir, VERSIONS_DIR, version)
+    if os.path.isdir(version_dir + TMP_SUFFIX):
+        os.replace(version_dir + TMP_SUFFIX, version_dir)
+    path = os.path.join(user_dir, CURRENT_FILENAME)
+    with open(path + ".tmp", "w") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def prune_versions(user_dir: str, keep: int = 2):
+    """
+    Delete all but the newest `keep` versions, never the current one, plus any legacy index dirs
+    and temporary directories older than STALE_TMP_SECONDS.
+
+    Old versions may still be memory-mapped by a query engine that has not yet
+    swapped; deletion errors (e.g. open files on Windows) are ignored and the
+    directory is retried on the next prune.
+    """
+    current = current_version(user_dir)
+    if current is None:
+        return
+    versions_dir = os.path.join(user_dir, VERSIONS_DIR)
+    entries = os.listdir(versions_dir)
+    versions = sorted((v for v in entries if not v.endswith(TMP_SUFFIX)), reverse=True)
+    stale = [v for v in versions[keep:] if v != current]
+    # Another ingest may still be writing a recent temporary directory
+    now = time.time()
+    stale += [
+        v for v in entries
+        if v.endswith(TMP_SUFFIX) and now - os.path.getmtime(os.path.join(versions_dir, v)) > STALE_TMP_SECONDS
+    ]
+    stale += [os.path.join("..", name) for name in LEGACY_DIR_NAMES]
+    for version in stale:
+        path = os.path.normpath(os.path.join(versions_dir, version))
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
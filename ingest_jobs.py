@@ -0,0 +1,366 @@
+import os
+import sys
+import time
+import uuid
+import shutil
+import sqlite3
+import argparse
+import threading
+import traceback
+import subprocess
+
+# Default location of the job database, shared by the app and the workers
+DEFAULT_BASE_DIR = "./user_data"
+JOBS_DB_FILENAME = "ingest_jobs.sqlite"
+
+JOB_STATES = ("queued", "running", "done", "failed")
+
+# Share of a job's overall progress covered by each stage
+STAGE_SPANS = {
+    "ocr": (0.0, 0.2),
+    "scan": (0.2, 0.25),
+    "load": (0.25, 0.35),
+    "embed": (0.35, 0.9),
+    "persist": (0.9, 0.98),
+    "publish": (0.98, 1.0),
+}
+
+# Workers refresh their heartbeat this often; a worker silent for STALE_SECONDS is presumed dead
+HEARTBEAT_SECONDS = 2
+STALE_SECONDS = 60
+
+
+class JobQueue:
+    """
+    Persistent ingestion job queue in SQLite (WAL mode).
+
+    A job is one upload waiting to be ingested for a user. Workers claim all of a
+    user's queued jobs at once and ingest them as a single batch; a user never has
+    two batches running at the same time. Job rows record status, stage, overall
+    progress and a message, so any process can show them.
+    """
+
+    def __init__(self, path: str = os.path.join(DEFAULT_BASE_DIR, JOBS_DB_FILENAME)):
+        """
+        Args:
+            path (str): Path of the SQLite database file.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                upload_dir TEXT NOT NULL,
+                description TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                progress REAL NOT NULL DEFAULT 0,
+                message TEXT,
+                error TEXT,
+                batch_id TEXT,
+                worker_id TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, created_at)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, pid INTEGER, heartbeat REAL NOT NULL)")
+
+    def _rows(self, query: str, params=()):
+        with self._lock:
+            cursor = self._conn.execute(query, params)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def _write(self, query: str, params=()):
+        with self._lock:
+            return self._conn.execute(query, params).rowcount
+
+    def enqueue(self, user_id: str, upload_dir: str, description: str = ""):
+        """
+        Queue the files in upload_dir for ingestion.
+
+        Returns:
+            str: The job id.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._write(
+            "INSERT INTO jobs (id, user_id, upload_dir, description, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+            (job_id, user_id, upload_dir, description, now, now),
+        )
+        return job_id
+
+    def get(self, job_id: str):
+        """Return a job as a dict, or None."""
+        rows = self._rows("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return rows[0] if rows else None
+
+    def list_jobs(self, user_id: str, limit: int = 20):
+        """Return a user's most recent jobs, newest first."""
+        return self._rows("SELECT * FROM jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT ?", (user_id, limit))
+
+    def claim_batch(self, worker_id: str):
+        """
+        Claim every queued job of the user with the oldest queued job, skipping users already being ingested.
+
+        Returns:
+            tuple: (batch id, user id, list of jobs) or None if nothing is queued.
+        """
+        batch_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    """
+                    SELECT user_id FROM jobs WHERE status = 'queued'
+                    AND user_id NOT IN (SELECT user_id FROM jobs WHERE status = 'running')
+                    ORDER BY created_at LIMIT 1
+                    """
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                user_id = row[0]
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'running', batch_id = ?, worker_id = ?, updated_at = ? "
+                    "WHERE user_id = ? AND status = 'queued'",
+                    (batch_id, worker_id, time.time(), user_id),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        jobs = self._rows("SELECT * FROM jobs WHERE batch_id = ? ORDER BY created_at", (batch_id,))
+        return batch_id, user_id, jobs
+
+    def update_batch(self, batch_id: str, stage: str, fraction: float, message: str = ""):
+        """Record progress of a batch; fraction is the progress within stage."""
+        low, high = STAGE_SPANS.get(stage, (0.0, 1.0))
+        progress = low + (high - low) * min(max(fraction, 0.0), 1.0)
+        self._write(
+            "UPDATE jobs SET stage = ?, progress = ?, message = ?, updated_at = ? WHERE batch_id = ?",
+            (stage, progress, message, time.time(), batch_id),
+        )
+
+    def finish_batch(self, batch_id: str, error: str = None):
+        """Mark a batch done, or failed with an error message."""
+        if error is None:
+            self._write(
+                "UPDATE jobs SET status = 'done', progress = 1, updated_at = ? WHERE batch_id = ?",
+                (time.time(), batch_id),
+            )
+        else:
+            self._write(
+                "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE batch_id = ?",
+                (error, time.time(), batch_id),
+            )
+
+    def register_worker(self, worker_id: str, pid: int = None):
+        """Record a worker's heartbeat (also used to register a worker before it starts)."""
+        self._write(
+            "INSERT OR REPLACE INTO workers (id, pid, heartbeat) VALUES (?, ?, ?)",
+            (worker_id, pid, time.time()),
+        )
+
+    def unregister_worker(self, worker_id: str):
+        self._write("DELETE FROM workers WHERE id = ?", (worker_id,))
+
+    def live_workers(self):
+        """Return the number of workers with a recent heartbeat."""
+        return self._rows(
+            "SELECT COUNT(*) AS n FROM workers WHERE heartbeat > ?", (time.time() - STALE_SECONDS,)
+        )[0]["n"]
+
+    def requeue_orphans(self):
+        """Put running jobs of dead workers back in the queue and forget those workers."""
+        cutoff = time.time() - STALE_SECONDS
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                requeued = self._conn.execute(
+                    """
+                    UPDATE jobs SET status = 'queued', batch_id = NULL, worker_id = NULL, stage = NULL,
+                    progress = 0, message = 'Requeued after a worker stopped', updated_at = ?
+                    WHERE status = 'running'
+                    AND worker_id NOT IN (SELECT id FROM workers WHERE heartbeat > ?)
+                    """,
+                    (time.time(), cutoff),
+                ).rowcount
+                self._conn.execute("DELETE FROM workers WHERE heartbeat <= ?", (cutoff,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return requeued
+
+
+def jobs_db_path(base_dir: str = DEFAULT_BASE_DIR):
+    return os.path.join(base_dir, JOBS_DB_FILENAME)
+
+
+# Queues opened in this process, keyed by base directory
+_queues = {}
+_queues_lock = threading.Lock()
+
+def get_job_queue(base_dir: str = DEFAULT_BASE_DIR):
+    """Return the process-wide JobQueue for base_dir."""
+    with _queues_lock:
+        if base_dir not in _queues:
+            _queues[base_dir] = JobQueue(jobs_db_path(base_dir))
+        return _queues[base_dir]
+
+
+def submit_upload(user_id: str, files, base_dir: str = DEFAULT_BASE_DIR):
+    """
+    Save uploaded files for a user and queue them for ingestion.
+
+    Args:
+        user_id (str): Unique identifier for the user.
+        files (list): (filename, bytes) pairs.
+        base_dir (str): Base directory for user-specific data. Default is './user_data'.
+
+    Returns:
+        str: The job id.
+    """
+    upload_dir = os.path.join(base_dir, user_id, "uploads", uuid.uuid4().hex)
+    os.makedirs(upload_dir)
+    for filename, data in files:
+        # Files appear under their final name only once fully written
+        path = os.path.join(upload_dir, os.path.basename(filename))
+        with open(path + ".part", "wb") as f:
+            f.write(data)
+        os.replace(path + ".part", path)
+    description = ", ".join(os.path.basename(filename) for filename, _ in files)
+    return get_job_queue(base_dir).enqueue(user_id, upload_dir, description)
+
+
+def ensure_workers(base_dir: str = DEFAULT_BASE_DIR, count: int = 1):
+    """
+    Start background worker processes until `count` are alive.
+
+    Workers are separate processes (so OCR can use its own process pool) that
+    exit after being idle for a while; calling this on every upload restarts them.
+    """
+    queue = get_job_queue(base_dir)
+    for _ in range(count - queue.live_workers()):
+        worker_id = uuid.uuid4().hex
+        # Register before starting so concurrent callers do not start extra workers
+        queue.register_worker(worker_id)
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "worker", "--base-dir", base_dir, "--worker-id", worker_id],
+            cwd=os.getcwd(),
+            start_new_session=True,
+        )
+        queue.register_worker(worker_id, process.pid)
+        print(f"Started ingestion worker {worker_id} (pid {process.pid}).")
+
+
+def run_batch(queue: JobQueue, batch_id: str, user_id: str, jobs, base_dir: str, ocr_options: dict = None):
+    """OCR every upload of a batch, then ingest them together in one incremental update."""
+    from ocr import ocr_pdf_files
+    from document_embedder import create_and_save_user_indices
+
+    merged_manifest = None
+    for number, job in enumerate(jobs):
+        queue.update_batch(batch_id, "ocr", number / len(jobs), f"Processing upload {number + 1}/{len(jobs)}")
+        manifest = ocr_pdf_files(user_id, job["upload_dir"], base_dir=base_dir, **(ocr_options or {}))
+        if merged_manifest is None:
+            merged_manifest = manifest
+        else:
+            merged_manifest["files"].update(manifest["files"])
+        shutil.rmtree(job["upload_dir"], ignore_errors=True)
+    queue.update_batch(batch_id, "ocr", 1.0, "Uploads processed")
+
+    create_and_save_user_indices(
+        user_id=user_id,
+        input_dir=merged_manifest["destination_dir"],
+        base_dir=base_dir,
+        ocr_manifest=merged_manifest,
+        progress=lambda stage, fraction, message: queue.update_batch(batch_id, stage, fraction, message),
+    )
+
+
+def run_worker(base_dir: str = DEFAULT_BASE_DIR, worker_id: str = None, idle_exit: float = 300, poll: float = 1.0):
+    """
+    Process queued batches until the queue has been empty for idle_exit seconds.
+
+    Args:
+        base_dir (str): Base directory for user-specific data. Default is './user_data'.
+        worker_id (str): Id under which the worker was registered. Default is a new id.
+        idle_exit (float): Seconds without work before exiting. Default is 300.
+        poll (float): Seconds between queue polls. Default is 1.
+    """
+    queue = JobQueue(jobs_db_path(base_dir))
+    worker_id = worker_id or uuid.uuid4().hex
+    queue.register_worker(worker_id, os.getpid())
+
+    # Heartbeat from a thread so long ingests do not look like dead workers
+    stop = threading.Event()
+    def heartbeat():
+        while not stop.wait(HEARTBEAT_SECONDS):
+            queue.register_worker(worker_id, os.getpid())
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    print(f"Ingestion worker {worker_id} started.")
+    idle_since = time.time()
+    try:
+        while True:
+            queue.requeue_orphans()
+            claimed = queue.claim_batch(worker_id)
+            if claimed is None and time.time() - idle_since > idle_exit:
+                # Deregister, then look once more so a job queued meanwhile is not stranded
+                queue.unregister_worker(worker_id)
+                claimed = queue.claim_batch(worker_id)
+                if claimed is None:
+                    break
+                queue.register_worker(worker_id, os.getpid())
+            if claimed is None:
+                time.sleep(poll)
+                continue
+
+            batch_id, user_id, jobs = claimed
+            print(f"Ingesting {len(jobs)} upload(s) for user '{user_id}'.")
+            try:
+                run_batch(queue, batch_id, user_id, jobs, base_dir)
+                queue.finish_batch(batch_id)
+                print(f"Ingestion for user '{user_id}' done.")
+            except Exception as e:
+                traceback.print_exc()
+                queue.finish_batch(batch_id, error=str(e))
+            idle_since = time.time()
+    finally:
+        stop.set()
+        queue.unregister_worker(worker_id)
+        print(f"Ingestion worker {worker_id} stopped.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Background ingestion jobs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    worker_parser = subparsers.add_parser("worker", help="Run an ingestion worker.")
+    worker_parser.add_argument("--base-dir", default=DEFAULT_BASE_DIR)
+    worker_parser.add_argument("--worker-id", default=None)
+    worker_parser.add_argument("--idle-exit", type=float, default=300)
+
+    status_parser = subparsers.add_parser("status", help="Show a user's recent jobs.")
+    status_parser.add_argument("user_id")
+    status_parser.add_argument("--base-dir", default=DEFAULT_BASE_DIR)
+
+    args = parser.parse_args()
+    if args.command == "worker":
+        run_worker(args.base_dir, args.worker_id, args.idle_exit)
+    else:
+        for job in JobQueue(jobs_db_path(args.base_dir)).list_jobs(args.user_id):
+            print(f"{job['id'][:8]}  {job['status']:<7} {job['progress']:>4.0%}  {job['stage'] or '':<8} "
+                  f"{job['description']}  {job['error'] or job['message'] or ''}")
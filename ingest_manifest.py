@@ -0,0 +1,98 @@
+import os
+import json
+import hashlib
+
+# File inside a user's folder that records what has been ingested
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+def file_sha256(path: str, block_size: int = 1 << 20):
+    """
+    Compute the SHA-256 of a file's contents.
+
+    Args:
+        path (str): Path to the file.
+        block_size (int): Number of bytes read per iteration. Default is 1 MiB.
+
+    Returns:
+        str: Hex digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def scan_directory(input_dir: str):
+    """
+    List the files under a directory the same way SimpleDirectoryReader does (recursive, no hidden files).
+
+    Args:
+        input_dir (str): Directory to scan.
+
+    Returns:
+        dict: Mapping of path relative to input_dir -> absolute path.
+    """
+    files = {}
+    for root, dirs, filenames in os.walk(input_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for filename in sorted(filenames):
+            if filename.startswith("."):
+                continue
+            path = os.path.join(root, filename)
+            files[os.path.relpath(path, input_dir)] = os.path.abspath(path)
+    return files
+
+def new_manifest(settings: dict):
+    """Return an empty manifest for the given ingestion settings."""
+    return {"version": MANIFEST_VERSION, "settings": settings, "files": {}}
+
+def load_manifest(user_dir: str):
+    """
+    Load a user's ingestion manifest.
+
+    Args:
+        user_dir (str): The user's data directory.
+
+    Returns:
+        dict: The manifest, or None if it is missing, unreadable or from another version.
+    """
+    path = os.path.join(user_dir, MANIFEST_FILENAME)
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def save_manifest(user_dir: str, manifest: dict):
+    """
+    Write a user's ingestion manifest atomically.
+
+    Args:
+        user_dir (str): The user's data directory.
+        manifest (dict): The manifest to save.
+    """
+    path = os.path.join(user_dir, MANIFEST_FILENAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+def diff_manifest(manifest: dict, current_hashes: dict):
+    """
+    Compare the ingested files against the files currently on disk.
+
+    Args:
+        manifest (dict): The user's ingestion manifest.
+        current_hashes (dict): Mapping of relative path -> SHA-256 of files on disk.
+
+    Returns:
+        tuple: (changed, removed) lists of relative paths. New files count as changed.
+    """
+    ingested = manifest["files"]
+    changed = [path for path, sha in current_hashes.items() if ingested.get(path, {}).get("sha256") != sha]
+    removed = [path for path in ingested if path not in current_hashes]
+    return changed, removed
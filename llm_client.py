@@ -0,0 +1,291 @@
+import os
+import json
+import asyncio
+import hashlib
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Sequence
+
+import httpx
+from llama_index.core.base.llms.generic_utils import (
+    achat_to_completion_decorator,
+    astream_chat_to_completion_decorator,
+    chat_to_completion_decorator,
+    stream_chat_to_completion_decorator,
+)
+from llama_index.core.base.llms.types import ChatMessage
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.llms.ollama import Ollama
+from ollama import AsyncClient, Client
+
+from tracing import nested_llm_call
+
+# Ollama server used unless one is configured; like Ollama's CLI, $OLLAMA_HOST may omit the scheme
+OLLAMA_BASE_URL = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+if "://" not in OLLAMA_BASE_URL:
+    OLLAMA_BASE_URL = "http://" + OLLAMA_BASE_URL
+
+# Requests one Ollama server generates at the same time; the server reads the same variable
+DEFAULT_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+
+# Seconds an idle connection to Ollama stays open for reuse
+KEEPALIVE_EXPIRY = 300.0
+
+# How long Ollama keeps the model, and with it the cached prompt prefixes, loaded after a request
+MODEL_KEEP_ALIVE = "30m"
+
+
+class ConcurrencyLimit:
+    """
+    A semaphore shared by threads and event loops, granting slots in arrival order.
+
+    A released slot is handed straight to the longest-waiting caller, whether it is
+    blocked in a thread or awaiting in any event loop.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _try_acquire(self) -> bool:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        return False
+
+    def acquire(self):
+        with self._lock:
+            if self._try_acquire():
+                return
+            event = threading.Event()
+            self._waiters.append((None, event))
+        event.wait()
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._try_acquire():
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # The slot was handed over as the caller was cancelled, so pass it on
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self.active -= 1
+                return
+            loop, waiter = self._waiters.popleft()
+        # The slot stays taken and passes to the waiter
+        if loop is None:
+            waiter.set()
+        else:
+            loop.call_soon_threadsafe(self._hand_over, waiter)
+
+    def _hand_over(self, future: asyncio.Future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+def _request_key(model: str, messages: Any, kwargs: dict) -> str:
+    """Digest identifying a request, so identical in-flight requests can share one response."""
+    payload = json.dumps([model, messages, kwargs], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PooledOllama(Ollama):
+    """
+    Ollama client that reuses connections, limits concurrency and coalesces identical requests.
+
+    Requests go over a pool of keep-alive HTTP connections, and at most `max_parallel`
+    run at once, matching the server's OLLAMA_NUM_PARALLEL, so the rest queue here
+    instead of in Ollama. A non-streaming request identical to one already in flight
+    waits for that response instead of being sent again.
+    """
+
+    max_parallel: int = DEFAULT_PARALLEL
+
+    _limit: ConcurrencyLimit = PrivateAttr()
+    _in_flight: dict = PrivateAttr()
+    _in_flight_lock: Any = PrivateAttr()
+    _async_clients: Any = PrivateAttr()
+    _stats: dict = PrivateAttr()
+
+    def __init__(
+        self,
+        model: str,
+        base_url: str = OLLAMA_BASE_URL,
+        request_timeout: float = 120.0,
+        max_parallel: int = DEFAULT_PARALLEL,
+        keep_alive: Any = MODEL_KEEP_ALIVE,
+        **kwargs: Any,
+    ) -> None:
+        """
+        Args:
+            model (str): Name of the Ollama model.
+            base_url (str): The Ollama server. Default is $OLLAMA_HOST or http://localhost:11434.
+            request_timeout (float): Seconds to wait for a response. Default is 120.
+            max_parallel (int): Requests sent at the same time. Default is $OLLAMA_NUM_PARALLEL or 4.
+            keep_alive (str): How long Ollama keeps the model loaded. Default is 30 minutes.
+        """
+        super().__init__(
+            model=model,
+            base_url=base_url,
+            request_timeout=request_timeout,
+            keep_alive=keep_alive,
+            max_parallel=max_parallel,
+            client=Client(host=base_url, timeout=request_timeout, limits=self._limits(max_parallel)),
+            **kwargs,
+        )
+        self._limit = ConcurrencyLimit(max_parallel)
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        # httpx async connections belong to the event loop that opened them
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._stats = {"requests": 0, "coalesced": 0}
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "PooledOllama"
+
+    @staticmethod
+    def _limits(max_parallel: int):
+        return httpx.Limits(
+            max_connections=max_parallel, max_keepalive_connections=max_parallel, keepalive_expiry=KEEPALIVE_EXPIRY
+        )
+
+    @property
+    def async_client(self) -> AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = AsyncClient(
+                host=self.base_url, timeout=self.request_timeout, limits=self._limits(self.max_parallel)
+            )
+        return client
+
+    def stats(self):
+        """Return request counters and the current number of active and queued requests."""
+        return {**self._stats, "active": self._limit.active, "waiting": self._limit.waiting}
+
+    def _key(self, messages: Sequence[ChatMessage], kwargs: dict) -> str:
+        return _request_key(self.model, self._convert_to_ollama_messages(messages), kwargs)
+
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any):
+        key = self._key(messages, kwargs)
+        with self._in_flight_lock:
+            self._stats["requests"] += 1
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+            else:
+                self._stats["coalesced"] += 1
+        if not leader:
+            return future.result()
+
+        try:
+            self._limit.acquire()
+            try:
+                future.set_result(super().chat(messages, **kwargs))
+            finally:
+                self._limit.release()
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+        return future.result()
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any):
+        key = (asyncio.get_running_loop(), self._key(messages, kwargs))
+        with self._in_flight_lock:
+            self._stats["requests"] += 1
+            task = self._in_flight.get(key)
+            if task is None:
+                task = self._in_flight[key] = asyncio.ensure_future(self._achat_once(key, messages, kwargs))
+            else:
+                self._stats["coalesced"] += 1
+        # A cancelled caller must not cancel the request others are waiting for
+        return await asyncio.shield(task)
+
+    async def _achat_once(self, key, messages: Sequence[ChatMessage], kwargs: dict):
+        try:
+            await self._limit.aacquire()
+            try:
+                return await super().achat(messages, **kwargs)
+            finally:
+                self._limit.release()
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any):
+        # Streams are never coalesced: each caller consumes its own tokens
+        with self._in_flight_lock:
+            self._stats["requests"] += 1
+        return self._limited(super().stream_chat(messages, **kwargs))
+
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any):
+        with self._in_flight_lock:
+            self._stats["requests"] += 1
+        return self._alimited(await super().astream_chat(messages, **kwargs))
+
+    # Completions run through chat(), whose callback would report the same call again
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        with nested_llm_call():
+            return chat_to_completion_decorator(self.chat)(prompt, **kwargs)
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        with nested_llm_call():
+            return await achat_to_completion_decorator(self.achat)(prompt, **kwargs)
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        with nested_llm_call():
+            return stream_chat_to_completion_decorator(self.stream_chat)(prompt, **kwargs)
+
+    @llm_completion_callback()
+    async def astream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        with nested_llm_call():
+            return await astream_chat_to_completion_decorator(self.astream_chat)(prompt, **kwargs)
+
+    def _limited(self, response_gen):
+        """Hold a slot from the first token until the stream is exhausted or closed."""
+        self._limit.acquire()
+        try:
+            yield from response_gen
+        finally:
+            self._limit.release()
+
+    async def _alimited(self, response_gen):
+        await self._limit.aacquire()
+        try:
+            async for response in response_gen:
+                yield response
+        finally:
+            self._limit.release()
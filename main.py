@@ -1,64 +1,370 @@
-import json
-from flask import Flask, request, jsonify
 import os
-from chat import query_engine
-app = Flask(__name__)
+import json
+import asyncio
+import argparse
+from functools import partial
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web, ClientSession, ClientTimeout
+
+from engine_registry import get_query_engine, load_engine_options
+from chat import aiter_response_text
+from chat_store import get_chat_store
+from models import configure_llm, llm_stats
+from query_batcher import DEFAULT_MAX_BATCH, DEFAULT_WINDOW_MS, configure_query_batching, get_query_batcher
+from tracing import DEFAULT_TRACE_LOG, METRICS, configure_trace_log, start_trace
+from llm_client import OLLAMA_BASE_URL
+
+# Most messages returned by one page of GET /chats
+MAX_CHATS_PAGE = 1000
+
+
+class QueryLimiter:
+    """
+    Admission control for queries that reach the LLM.
+
+    At most max_concurrent queries run at once and at most max_per_user of them
+    belong to the same user, so one busy user cannot hold every slot. Up to
+    max_waiting further requests queue for a slot; beyond that requests are
+    rejected with 503 so callers back off instead of piling up behind Ollama.
+    """
+
+    def __init__(self, max_concurrent: int = 4, max_per_user: int = 2, max_waiting: int = 64):
+        """
+        Args:
+            max_concurrent (int): Queries allowed to run at the same time. Default is 4.
+            max_per_user (int): Queries allowed to run at the same time for one user. Default is 2.
+            max_waiting (int): Requests allowed to wait for a slot. Default is 64.
+        """
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._user_semaphores = {}
+
+    @asynccontextmanager
+    async def slot(self, user_id: str):
+        """Wait for a query slot for user_id, or raise 503 if the queue is full."""
+        if self.waiting >= self.max_waiting:
+            raise web.HTTPServiceUnavailable(
+                text=json.dumps({'error': 'Server busy, retry later'}),
+                content_type='application/json',
+                headers={'Retry-After': '1'},
+            )
+
+        user_semaphore = self._user_semaphores.setdefault(user_id, asyncio.Semaphore(self.max_per_user))
+        self.waiting += 1
+        try:
+            # Take the user's slot first so a user's backlog does not block global slots
+            await user_semaphore.acquire()
+            try:
+                await self._semaphore.acquire()
+            except BaseException:
+                user_semaphore.release()
+                raise
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+            user_semaphore.release()
 
-# Path to the JSON file where chat history will be saved
-CHAT_HISTORY_FILE = 'chat_history.json'
+    def stats(self):
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'max_concurrent': self.max_concurrent,
+            'max_waiting': self.max_waiting,
+        }
 
-# Helper function to read chat history from the JSON file
-def read_chat_history():
-    if os.path.exists(CHAT_HISTORY_FILE):
-        with open(CHAT_HISTORY_FILE, 'r') as f:
-            return json.load(f)
-    return []
 
-# Helper function to save chat history to the JSON file
-def save_chat_history(chat_history):
-    with open(CHAT_HISTORY_FILE, 'w') as f:
-        json.dump(chat_history, f, indent=4)
+async def run_blocking(request, func, *args, **kwargs):
+    """Run a blocking call (engine loading, file IO) on the server's bounded worker pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app['executor'], partial(func, *args, **kwargs))
 
 
+async def load_user_engine(request, user_id):
+    """Return the user's cached streaming query engine, loading it on the worker pool if needed."""
+    options = await run_blocking(request, load_engine_options, user_id, streaming=True)
+    return await run_blocking(request, get_query_engine, user_id, **options)
 
-@app.route('/chat', methods=['POST'])
-def chat():
+
+async def read_chat_request(request):
+    """Parse {"message": ..., "user_id": ...} from the request body."""
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict) or not data.get('message'):
+        raise web.HTTPBadRequest(
+            text=json.dumps({'error': 'No message provided'}),
+            content_type='application/json',
+        )
+    if not data.get('user_id'):
+        raise web.HTTPBadRequest(
+            text=json.dumps({'error': 'No user_id provided'}),
+            content_type='application/json',
+        )
+    return data['message'], data['user_id']
+
+
+async def save_interaction(request, user_id, user_input, bot_response):
+    # One transaction appends the question and the answer
+    messages = [("user", user_input), ("assistant", bot_response)]
+    await run_blocking(request, request.app['chat_store'].append_many, user_id, messages)
+
+
+async def chat(request):
+    user_input, user_id = await read_chat_request(request)
+    trace = None
     try:
-        # Get the JSON data from the POST request
-        data = request.get_json()
-        
-        # Extract the user's input from the request data
-        user_input = data.get('message')
-        
-        if not user_input:
-            return jsonify({'error': 'No message provided'}), 400
-        
-        # Process the input with your query engine
-        bot_response = query_engine.query(user_input)
-        
-        # Read the existing chat history
-        chat_history = read_chat_history()
-        
-        # Add the new chat interaction to the history
-        chat_history.append({"user": user_input, "bot": bot_response})
-        
-        # Save the updated chat history to the JSON file
-        save_chat_history(chat_history)
-        
+        query_engine = await load_user_engine(request, user_id)
+        async with request.app['limiter'].slot(user_id):
+            trace = start_trace(user_id, user_input)
+            response = await query_engine.aquery(user_input)
+            bot_response = "".join([token async for token in trace.aiter_text(aiter_response_text(response))])
+
+        await save_interaction(request, user_id, user_input, bot_response)
+
         # Return the bot's response in JSON format
-        return jsonify({'response': bot_response}), 200
+        return web.json_response({'response': bot_response, 'trace_id': trace.trace_id})
+    except web.HTTPException:
+        raise
+    except Exception as e:
+        if trace is not None:
+            trace.finish(e)
+        return web.json_response({'error': str(e)}, status=500)
 
+
+# Format one server-sent event
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n".encode()
+
+async def chat_stream(request):
+    """Stream the answer as server-sent events: 'token' events, then 'done' with the full response."""
+    user_input, user_id = await read_chat_request(request)
+    try:
+        query_engine = await load_user_engine(request, user_id)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return web.json_response({'error': str(e)}, status=500)
 
-@app.route('/chats', methods=['GET'])
-def get_chats():
+    async with request.app['limiter'].slot(user_id):
+        stream = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
+        await stream.prepare(request)
+        trace = start_trace(user_id, user_input)
+        try:
+            tokens = []
+            response = await query_engine.aquery(user_input)
+            async for token in trace.aiter_text(aiter_response_text(response)):
+                tokens.append(token)
+                await stream.write(sse_event({'token': token}, event='token'))
+            bot_response = "".join(tokens)
+        except ConnectionResetError as e:
+            # The client went away; stop generating and free the slot
+            trace.finish(e)
+            return stream
+        except Exception as e:
+            trace.finish(e)
+            await stream.write(sse_event({'error': str(e)}, event='error'))
+            return stream
+
+    await save_interaction(request, user_id, user_input, bot_response)
+    await stream.write(sse_event({'response': bot_response, 'trace_id': trace.trace_id}, event='done'))
+    await stream.write_eof()
+    return stream
+
+
+async def get_chats(request):
+    """
+    Return one page of a user's chat history, oldest first.
+
+    Query parameters: user_id (required), date (YYYY-MM-DD), limit (1 to MAX_CHATS_PAGE,
+    default 100) and before (a message id, for the previous page; use the returned next_before).
+    """
+    params = request.query
+    user_id = params.get('user_id')
+    if not user_id:
+        return web.json_response({'error': 'No user_id provided'}, status=400)
+    try:
+        limit = int(params.get('limit', 100))
+        before_id = int(params['before']) if 'before' in params else None
+    except ValueError:
+        return web.json_response({'error': 'limit and before must be integers'}, status=400)
+    if not 1 <= limit <= MAX_CHATS_PAGE:
+        return web.json_response({'error': f'limit must be between 1 and {MAX_CHATS_PAGE}'}, status=400)
     try:
-        # Retrieve chat history from the JSON file
-        chat_history = read_chat_history()
-        return jsonify({'chats': chat_history}), 200
+        messages = await run_blocking(
+            request, request.app['chat_store'].get_messages, user_id, params.get('date'), limit, before_id
+        )
+        next_before = messages[0]['id'] if len(messages) == limit else None
+        return web.json_response({'chats': messages, 'next_before': next_before})
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return web.json_response({'error': str(e)}, status=500)
+
+
+async def health(request):
+    """Liveness: the process is up and serving requests."""
+    return web.json_response({'status': 'ok', 'queries': request.app['limiter'].stats()})
+
+
+async def ready(request):
+    """Readiness: the Ollama backend answers and the query queue has room."""
+    limiter = request.app['limiter']
+    checks = {'queue': limiter.waiting < limiter.max_waiting}
+    try:
+        async with request.app['http'].get(f"{request.app['ollama_base_url']}/api/tags") as resp:
+            checks['ollama'] = resp.status == 200
+    except Exception:
+        checks['ollama'] = False
+
+    status = 200 if all(checks.values()) else 503
+    return web.json_response({'ready': status == 200, 'checks': checks}, status=status)
+
+
+async def metrics(request):
+    """Prometheus metrics: per-stage latency histograms, candidate counts, LLM tokens and queue state."""
+    limiter = request.app['limiter']
+    lines = [
+        "# HELP rag_queries_active Queries currently running.",
+        "# TYPE rag_queries_active gauge",
+        f"rag_queries_active {limiter.active}",
+        "# HELP rag_queries_waiting Requests waiting for a query slot.",
+        "# TYPE rag_queries_waiting gauge",
+        f"rag_queries_waiting {limiter.waiting}",
+    ]
+    batcher = get_query_batcher()
+    if batcher is not None:
+        stats = batcher.stats()
+        lines += [
+            "# HELP rag_query_batches_total Batches of query embeddings and vector searches run.",
+            "# TYPE rag_query_batches_total counter",
+            f"rag_query_batches_total {stats['batches']}",
+            "# HELP rag_query_batch_requests_total Queries embedded and searched in batches.",
+            "# TYPE rag_query_batch_requests_total counter",
+            f"rag_query_batch_requests_total {stats['requests']}",
+        ]
+    stats = llm_stats()
+    lines += [
+        "# HELP rag_llm_requests_total Requests made to the Ollama client.",
+        "# TYPE rag_llm_requests_total counter",
+        f"rag_llm_requests_total {stats['requests']}",
+        "# HELP rag_llm_coalesced_total Requests answered by an identical request already in flight.",
+        "# TYPE rag_llm_coalesced_total counter",
+        f"rag_llm_coalesced_total {stats['coalesced']}",
+        "# HELP rag_llm_requests_active Requests being generated by Ollama.",
+        "# TYPE rag_llm_requests_active gauge",
+        f"rag_llm_requests_active {stats['active']}",
+        "# HELP rag_llm_requests_waiting Requests waiting for an Ollama slot.",
+        "# TYPE rag_llm_requests_waiting gauge",
+        f"rag_llm_requests_waiting {stats['waiting']}",
+    ]
+    return web.Response(text=METRICS.render() + "\n".join(lines) + "\n", content_type='text/plain')
+
+
+def create_app(
+    max_concurrent_queries: int = 4,
+    max_queries_per_user: int = 2,
+    max_waiting_queries: int = 64,
+    worker_threads: int = None,
+    ollama_base_url: str = OLLAMA_BASE_URL,
+    trace_log: str = DEFAULT_TRACE_LOG,
+    batch_window_ms: float = DEFAULT_WINDOW_MS,
+    max_batch: int = DEFAULT_MAX_BATCH,
+    llm_parallel: int = None,
+):
+    """
+    Build the API server.
+
+    Args:
+        max_concurrent_queries (int): Queries sent to the LLM at the same time.
+        max_queries_per_user (int): Concurrent queries allowed for one user.
+        max_waiting_queries (int): Queued requests before new ones get 503.
+        worker_threads (int): Size of the pool for blocking work; defaults to the CPU count.
+        ollama_base_url (str): Ollama server used for answers and checked by /ready.
+            Default is $OLLAMA_HOST or http://localhost:11434.
+        trace_log (str): JSONL file receiving one trace per query, or None to disable it.
+        batch_window_ms (float): Longest time a query waits to be embedded and searched together
+            with concurrent queries, or None to disable batching.
+        max_batch (int): Most queries embedded and searched together.
+        llm_parallel (int): Requests sent to Ollama at the same time; set it to the server's
+            OLLAMA_NUM_PARALLEL. Default is $OLLAMA_NUM_PARALLEL or 4.
+
+    Returns:
+        web.Application: The aiohttp application.
+    """
+    configure_trace_log(trace_log)
+    configure_query_batching(batch_window_ms, max_batch)
+    configure_llm(base_url=ollama_base_url, max_parallel=llm_parallel)
+    app = web.Application()
+    app['limiter'] = QueryLimiter(max_concurrent_queries, max_queries_per_user, max_waiting_queries)
+    app['chat_store'] = get_chat_store()
+    app['ollama_base_url'] = ollama_base_url.rstrip('/')
+
+    async def on_startup(app):
+        # Bounded pool for engine loading, file IO and the engines' own run_in_executor calls
+        app['executor'] = ThreadPoolExecutor(max_workers=worker_threads or os.cpu_count(), thread_name_prefix="api")
+        asyncio.get_running_loop().set_default_executor(app['executor'])
+        app['http'] = ClientSession(timeout=ClientTimeout(total=2))
+
+    async def on_cleanup(app):
+        await app['http'].close()
+        app['executor'].shutdown(wait=False)
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+
+    app.router.add_post('/chat', chat)
+    app.router.add_post('/chat/stream', chat_stream)
+    app.router.add_get('/chats', get_chats)
+    app.router.add_get('/health', health)
+    app.router.add_get('/ready', ready)
+    app.router.add_get('/metrics', metrics)
+    return app
+
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    parser = argparse.ArgumentParser(description="Async RAG chat API server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--max-concurrent", type=int, default=4, help="Queries sent to the LLM at the same time.")
+    parser.add_argument("--max-per-user", type=int, default=2, help="Concurrent queries allowed for one user.")
+    parser.add_argument("--max-waiting", type=int, default=64, help="Queued requests before returning 503.")
+    parser.add_argument("--workers", type=int, default=None, help="Threads for blocking work (default: CPU count).")
+    parser.add_argument("--ollama-url", default=OLLAMA_BASE_URL,
+                        help="Ollama server (default: $OLLAMA_HOST or http://localhost:11434).")
+    parser.add_argument("--trace-log", default=DEFAULT_TRACE_LOG, help="JSONL trace file; 'none' disables it.")
+    parser.add_argument("--batch-window-ms", type=float, default=DEFAULT_WINDOW_MS,
+                        help="Longest wait for concurrent queries to batch with; negative disables batching.")
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH, help="Most queries in one batch.")
+    parser.add_argument("--llm-parallel", type=int, default=None,
+                        help="Requests sent to Ollama at the same time (default: $OLLAMA_NUM_PARALLEL or 4).")
+    args = parser.parse_args()
+
+    web.run_app(
+        create_app(
+            args.max_concurrent,
+            args.max_per_user,
+            args.max_waiting,
+            args.workers,
+            args.ollama_url,
+            None if args.trace_log.lower() == "none" else args.trace_log,
+            None if args.batch_window_ms < 0 else args.batch_window_ms,
+            args.max_batch,
+            args.llm_parallel,
+        ),
+        host=args.host,
+        port=args.port,
+    )
@@ -0,0 +1,307 @@
+import re
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+# Port the mock listens on by default, next to Ollama's 11434
+DEFAULT_PORT = 11435
+
+# Vocabulary of the synthetic documents used by the load test
+_WORDS = (
+    "boy sheep church desert alchemist treasure dream omen caravan oasis merchant crystal king "
+    "legend heart wind sun pyramid gold water well camel tribe war battle lead lesson journey"
+).split()
+
+
+def mock_answer(prompt: str, max_words: int = 64) -> str:
+    """
+    Deterministic answer to a prompt, shaped like the model's.
+
+    Rerank prompts get a valid 'Doc: n, Relevance: r' answer ranked by word overlap
+    with the question, so LLMRerank keeps nodes as it would with a real model; other
+    prompts get the first max_words words of their context.
+    """
+    if "Let's try this now:" in prompt and "Doc: 9, Relevance: 7" in prompt:
+        body = prompt.split("Let's try this now:")[-1]
+        question = set(re.findall(r"\w+", body.split("Question:")[-1].lower()))
+        documents = re.split(r"Document (\d+):", body.split("Question:")[0])[1:]
+        scored = []
+        for number, text in zip(documents[0::2], documents[1::2]):
+            overlap = len(question & set(re.findall(r"\w+", text.lower())))
+            scored.append((overlap, -int(number)))
+        scored.sort(reverse=True)
+        return "\n".join(f"Doc: {-number}, Relevance: {1 + min(9, overlap)}" for overlap, number in scored)
+
+    context = prompt.split("---------------------")[1] if prompt.count("---------------------") >= 2 else prompt
+    return " ".join(context.split()[:max_words])
+
+
+def _common_prefix(a, b) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class MockOllama:
+    """
+    Offline stand-in for an Ollama server's chat API, for load tests.
+
+    Like Ollama it generates `parallel` requests at a time and queues the rest. Each
+    slot remembers the last prompt it evaluated, a request takes the free slot sharing
+    the longest prefix with its prompt, and only the rest of the prompt is charged
+    `prefill_ms` per word, so reuse of a stable prompt prefix shows up in latency
+    and in the reported cached tokens.
+    """
+
+    def __init__(self, parallel: int = 4, prefill_ms: float = 0.2, token_ms: float = 5.0, max_tokens: int = 64):
+        """
+        Args:
+            parallel (int): Requests generated at the same time, like OLLAMA_NUM_PARALLEL. Default is 4.
+            prefill_ms (float): Milliseconds per uncached prompt word. Default is 0.2.
+            token_ms (float): Milliseconds per generated word. Default is 5.
+            max_tokens (int): Words per answer unless the request sets num_predict. Default is 64.
+        """
+        self.parallel = parallel
+        self.prefill_ms = prefill_ms
+        self.token_ms = token_ms
+        self.max_tokens = max_tokens
+        self._slots = [[] for _ in range(parallel)]
+        self._free = set(range(parallel))
+        self._condition = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"requests": 0, "active": 0, "max_active": 0, "prompt_tokens": 0, "cached_tokens": 0}
+        self._connections = set()
+
+    def stats_dict(self):
+        prompt_tokens = self.stats["prompt_tokens"]
+        return {
+            **self.stats,
+            "connections": len(self._connections),
+            "cached_ratio": round(self.stats["cached_tokens"] / prompt_tokens, 3) if prompt_tokens else 0.0,
+        }
+
+    async def _acquire(self, tokens):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._free)
+            slot = max(sorted(self._free), key=lambda i: _common_prefix(self._slots[i], tokens))
+            self._free.remove(slot)
+        return slot
+
+    async def _release(self, slot: int):
+        async with self._condition:
+            self._free.add(slot)
+            self._condition.notify()
+
+    def _message(self, model: str, content: str, done: bool, **extra):
+        return {
+            "model": model,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "message": {"role": "assistant", "content": content},
+            "done": done,
+            **extra,
+        }
+
+    async def chat(self, request):
+        body = await request.json()
+        peer = request.transport.get_extra_info("peername") if request.transport else None
+        self._connections.add(peer)
+        model = body.get("model", "mock")
+        prompt = "\n".join(m.get("content") or "" for m in body.get("messages", []))
+        tokens = prompt.split()
+        max_words = (body.get("options") or {}).get("num_predict") or self.max_tokens
+        words = mock_answer(prompt, max_words).split(" ")
+
+        self.stats["requests"] += 1
+        slot = await self._acquire(tokens)
+        self.stats["active"] += 1
+        self.stats["max_active"] = max(self.stats["max_active"], self.stats["active"])
+        try:
+            cached = _common_prefix(self._slots[slot], tokens)
+            self._slots[slot] = tokens
+            self.stats["prompt_tokens"] += len(tokens)
+            self.stats["cached_tokens"] += cached
+            await asyncio.sleep((len(tokens) - cached) * self.prefill_ms / 1000)
+            # Like Ollama, prompt_eval_count only counts the tokens that were evaluated
+            counts = {"done_reason": "stop", "prompt_eval_count": len(tokens) - cached, "eval_count": len(words)}
+
+            if body.get("stream", True):
+                response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+                await response.prepare(request)
+                for i, word in enumerate(words):
+                    await asyncio.sleep(self.token_ms / 1000)
+                    chunk = self._message(model, word if i == 0 else " " + word, False)
+                    await response.write((json.dumps(chunk) + "\n").encode("utf-8"))
+                await response.write((json.dumps(self._message(model, "", True, **counts)) + "\n").encode("utf-8"))
+                await response.write_eof()
+                return response
+
+            await asyncio.sleep(len(words) * self.token_ms / 1000)
+            return web.json_response(self._message(model, " ".join(words), True, **counts))
+        finally:
+            self.stats["active"] -= 1
+            await self._release(slot)
+
+    async def tags(self, request):
+        return web.json_response({"models": [{"name": "llama3.2:3b", "model": "llama3.2:3b"}]})
+
+    async def version(self, request):
+        return web.json_response({"version": "mock"})
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats_dict())
+
+    async def post_reset(self, request):
+        self.reset_stats()
+        return web.json_response(self.stats_dict())
+
+    def app(self):
+        async def on_startup(app):
+            self._condition = asyncio.Condition()
+
+        app = web.Application()
+        app.on_startup.append(on_startup)
+        app.router.add_post('/api/chat', self.chat)
+        app.router.add_get('/api/tags', self.tags)
+        app.router.add_get('/api/version', self.version)
+        app.router.add_get('/stats', self.get_stats)
+        app.router.add_post('/stats/reset', self.post_reset)
+        return app
+
+
+def start_in_thread(server: MockOllama, host: str = "127.0.0.1", port: int = None):
+    """
+    Run server on its own event loop in a daemon thread.
+
+    Returns:
+        str: The server's base URL.
+    """
+    if port is None:
+        with socket.socket() as s:
+            s.bind((host, 0))
+            port = s.getsockname()[1]
+    started = threading.Event()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(server.app())
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, host, port).start())
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name="mock-ollama", daemon=True).start()
+    started.wait()
+    return f"http://{host}:{port}"
+
+
+def load_prompts(n_requests: int, duplicates: float = 0.25, n_docs: int = 10, seed: int = 0):
+    """
+    LLMRerank prompts over synthetic documents; a `duplicates` fraction repeat the previous prompt.
+
+    Repeats follow each other, as when several users ask the same question at once.
+    """
+    from llama_index.core.prompts.default_prompts import DEFAULT_CHOICE_SELECT_PROMPT
+
+    rng = random.Random(seed)
+    n_unique = max(1, round(n_requests * (1 - duplicates)))
+    unique = []
+    for _ in range(n_unique):
+        documents = "\n".join(
+            f"Document {i}:\n" + " ".join(rng.choices(_WORDS, k=60)) for i in range(1, n_docs + 1)
+        )
+        question = " ".join(rng.choices(_WORDS, k=6)) + "?"
+        unique.append(DEFAULT_CHOICE_SELECT_PROMPT.format(context_str=documents, query_str=question))
+    return [unique[int(i * n_unique / n_requests)] for i in range(n_requests)]
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def load_test(requests: int = 200, concurrency: int = 16, duplicates: float = 0.25, parallel: int = 4, **server_options):
+    """
+    Send the same concurrent completions through a new client per request and through PooledOllama.
+
+    The first mode is how the code used to call Ollama. Each reports wall time,
+    latency, TCP connections opened, the server's peak concurrency, coalesced
+    requests and cached prompt tokens.
+    """
+    import httpx
+    from llama_index.llms.ollama import Ollama
+    from llm_client import PooledOllama
+
+    server = MockOllama(parallel=parallel, **server_options)
+    base_url = start_in_thread(server)
+    prompts = load_prompts(requests, duplicates)
+
+    pooled = PooledOllama(model="llama3.2:3b", base_url=base_url, max_parallel=parallel)
+    modes = {
+        "client_per_request": lambda: Ollama(model="llama3.2:3b", base_url=base_url, request_timeout=120.0),
+        "pooled": lambda: pooled,
+    }
+    results = {}
+    for name, make_llm in modes.items():
+        httpx.post(f"{base_url}/stats/reset")
+
+        def call(prompt):
+            start = time.perf_counter()
+            make_llm().complete(prompt)
+            return (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(call, prompts))
+        seconds = time.perf_counter() - start
+        stats = httpx.get(f"{base_url}/stats").json()
+        results[name] = {
+            "seconds": round(seconds, 3),
+            "requests_per_s": round(len(prompts) / seconds, 1),
+            "p50_ms": round(_percentile(latencies, 0.5), 1),
+            "p95_ms": round(_percentile(latencies, 0.95), 1),
+            "server_requests": stats["requests"],
+            "connections": stats["connections"],
+            "server_max_active": stats["max_active"],
+            "cached_ratio": stats["cached_ratio"],
+        }
+    results["pooled"]["coalesced"] = pooled.stats()["coalesced"]
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline mock of the Ollama chat API, and a client load test.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("serve", "load"):
+        p = sub.add_parser(name)
+        p.add_argument("--parallel", type=int, default=4, help="Requests generated at the same time.")
+        p.add_argument("--prefill-ms", type=float, default=0.2, help="Milliseconds per uncached prompt word.")
+        p.add_argument("--token-ms", type=float, default=5.0, help="Milliseconds per generated word.")
+        p.add_argument("--max-tokens", type=int, default=64, help="Words per answer.")
+    serve = sub.choices["serve"]
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    load = sub.choices["load"]
+    load.add_argument("--requests", type=int, default=200)
+    load.add_argument("--concurrency", type=int, default=16, help="Client threads.")
+    load.add_argument("--duplicates", type=float, default=0.25, help="Fraction of requests repeating the previous one.")
+    args = parser.parse_args()
+
+    options = dict(prefill_ms=args.prefill_ms, token_ms=args.token_ms, max_tokens=args.max_tokens)
+    if args.command == "serve":
+        web.run_app(MockOllama(parallel=args.parallel, **options).app(), host=args.host, port=args.port)
+    else:
+        print(json.dumps(load_test(args.requests, args.concurrency, args.duplicates, args.parallel, **options), indent=2))
@@ -0,0 +1,148 @@
+import threading
+from embedding_cache import DEFAULT_CACHE_PATH, CachedEmbedding, EmbeddingCache
+from embedding_service import EmbeddingService
+from tracing import TRACING_HANDLER
+
+# Name of the embedding cache database inside a base data directory
+EMBEDDING_CACHE_FILENAME = "embedding_cache.sqlite"
+
+# Embedding models loaded in this process, keyed by ((model name, backend, options), cache path)
+_embed_models = {}
+_embed_models_lock = threading.Lock()
+
+# Open embedding caches, keyed by database path
+_embedding_caches = {}
+
+# Ollama clients created in this process, keyed by (model name, request timeout)
+_llms = {}
+_llms_lock = threading.Lock()
+
+# Server and concurrency limit for new Ollama clients; unset values use llm_client's defaults
+_llm_options = {}
+
+def get_embedding_cache(cache_path: str = DEFAULT_CACHE_PATH):
+    """
+    Return the process-wide embedding cache stored at cache_path.
+
+    Args:
+        cache_path (str): Path of the SQLite cache database.
+
+    Returns:
+        EmbeddingCache: The shared cache instance.
+    """
+    with _embed_models_lock:
+        cache = _embedding_caches.get(cache_path)
+        if cache is None:
+            cache = _embedding_caches[cache_path] = EmbeddingCache(cache_path)
+        return cache
+
+def get_embed_model(
+    embedding_model_name: str = "BAAI/bge-small-en-v1.5",
+    cache_path: str = DEFAULT_CACHE_PATH,
+    backend: str = "huggingface",
+    **service_options
+):
+    """
+    Return the process-wide embedding model for the given name, loading it on first use.
+
+    Args:
+        embedding_model_name (str): Name of the HuggingFace embedding model.
+        cache_path (str): Path of the on-disk embedding cache, or None to disable caching.
+        backend (str): 'huggingface' for HuggingFaceEmbedding, or an EmbeddingService backend
+            ('torch', 'onnx' or 'onnx-int8') for bulk ingestion. Default is 'huggingface'.
+        **service_options: EmbeddingService options (threads, processes, memory_mb, onnx_dir).
+
+    Returns:
+        BaseEmbedding: The shared embedding model instance.
+    """
+    cache = get_embedding_cache(cache_path) if cache_path else None
+    model_key = (embedding_model_name, backend, tuple(sorted(service_options.items())))
+    with _embed_models_lock:
+        base_model = _embed_models.get((model_key, None))
+        if base_model is None:
+            if backend == "huggingface":
+                # Imported on first use: it pulls in sentence-transformers and torch
+                from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+                print(f"Loading embedding model: {embedding_model_name}")
+                base_model = HuggingFaceEmbedding(model_name=embedding_model_name, trust_remote_code=True)
+            else:
+                base_model = EmbeddingService(embedding_model_name, backend=backend, **service_options)
+            _embed_models[(model_key, None)] = base_model
+        if cache is None:
+            return base_model
+
+        # The cached wrapper shares the loaded model with any uncached users
+        key = (model_key, cache_path)
+        if key not in _embed_models:
+            _embed_models[key] = CachedEmbedding(base_model, cache)
+        return _embed_models[key]
+
+def _add_tracing(llm):
+    """
+    Record every call's duration and token counts in the current query trace.
+
+    Response synthesizers replace the LLM's callback manager with Settings.callback_manager,
+    so the handler is added to both.
+    """
+    from llama_index.core import Settings
+
+    for callback_manager in (llm.callback_manager, Settings.callback_manager):
+        if TRACING_HANDLER not in callback_manager.handlers:
+            callback_manager.add_handler(TRACING_HANDLER)
+
+def configure_llm(base_url: str = None, max_parallel: int = None):
+    """
+    Set the Ollama server and concurrency limit of the clients get_llm creates from now on.
+
+    Args:
+        base_url (str): The Ollama server. Default is $OLLAMA_HOST or http://localhost:11434.
+        max_parallel (int): Requests sent at the same time, matching the server's
+            OLLAMA_NUM_PARALLEL. Default is $OLLAMA_NUM_PARALLEL or 4.
+    """
+    with _llms_lock:
+        _llm_options.update({k: v for k, v in (("base_url", base_url), ("max_parallel", max_parallel)) if v is not None})
+
+def get_llm(llm_model_name: str = "llama3.2:3b", request_timeout: float = 120.0):
+    """
+    Return the process-wide Ollama client for the given model, creating it on first use.
+
+    The client keeps its connections alive, limits concurrent requests and shares the
+    response of identical in-flight requests (see llm_client.PooledOllama).
+
+    Args:
+        llm_model_name (str): Name of the Ollama model.
+        request_timeout (float): Seconds to wait for a response. Default is 120.
+
+    Returns:
+        PooledOllama: The shared LLM instance.
+    """
+    key = (llm_model_name, request_timeout)
+    with _llms_lock:
+        llm = _llms.get(key)
+        if llm is None:
+            # Imported on first use: it pulls in llama_index and the Ollama client
+            from llm_client import PooledOllama
+            llm = _llms[key] = PooledOllama(model=llm_model_name, request_timeout=request_timeout, **_llm_options)
+            _add_tracing(llm)
+        return llm
+
+def llm_stats():
+    """Return the request counters of the shared Ollama clients, summed."""
+    totals = {"requests": 0, "coalesced": 0, "active": 0, "waiting": 0}
+    with _llms_lock:
+        llms = list(_llms.values())
+    for llm in llms:
+        if hasattr(llm, "stats"):
+            for name, value in llm.stats().items():
+                totals[name] += value
+    return totals
+
+def set_llm(llm, llm_model_name: str = "llama3.2:3b", request_timeout: float = 120.0):
+    """
+    Install llm as the shared client returned by get_llm for this model name.
+
+    Used to run the pipeline offline with a mock LLM, e.g. in benchmark.py.
+    """
+    with _llms_lock:
+        _add_tracing(llm)
+        _llms[(llm_model_name, request_timeout)] = llm
@@ -0,0 +1,380 @@
+import os
+import json
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from pydantic import PrivateAttr
+
+from ann_index import IVFIndex
+
+# Suffixes of the files written next to the path StorageContext.persist asks for
+MATRIX_SUFFIX = ".npy"
+IDS_SUFFIX = ".ids.json"
+ANN_SUFFIX = ".ivf.npz"
+
+# File name StorageContext uses for the default vector store
+DEFAULT_VECTOR_STORE_FNAME = "default__vector_store.json"
+
+
+def _base_path(persist_path: str):
+    """Strip the .json extension StorageContext appends to vector store paths."""
+    return persist_path[:-len(".json")] if persist_path.endswith(".json") else persist_path
+
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    """
+    Vector store backed by a contiguous float32 matrix.
+
+    Embeddings are L2-normalized and persisted as a `.npy` file plus a JSON id table.
+    Loading memory-maps the matrix, so it is near-instant and the pages are shared
+    between processes through the OS page cache. Queries are scored with a single
+    matrix-vector product and the top k selected with `argpartition`. With an IVF
+    index (`build_ann_index`) only the rows of the `nprobe` closest clusters are scored.
+    """
+
+    stores_text: bool = False
+    nprobe: int = 8
+
+    _matrix: np.ndarray = PrivateAttr()
+    _node_ids: List[str] = PrivateAttr()
+    _ref_doc_ids: List[Optional[str]] = PrivateAttr()
+    _alive: np.ndarray = PrivateAttr()
+    _id_to_row: dict = PrivateAttr()
+    _pending: List[List[float]] = PrivateAttr()
+    _ann: Optional[IVFIndex] = PrivateAttr()
+
+    def __init__(
+        self,
+        matrix: Optional[np.ndarray] = None,
+        node_ids: Optional[List[str]] = None,
+        ref_doc_ids: Optional[List[Optional[str]]] = None,
+        ann: Optional[IVFIndex] = None,
+        **kwargs: Any,
+    ) -> None:
+        """
+        Args:
+            matrix (np.ndarray): Normalized float32 embeddings, one row per node.
+            node_ids (List[str]): Node id of each row.
+            ref_doc_ids (List[str]): Source document id of each row.
+            ann (IVFIndex): Optional approximate nearest-neighbour index over the rows.
+        """
+        super().__init__(**kwargs)
+        self._set_data(matrix, node_ids, ref_doc_ids, ann)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "NumpyVectorStore"
+
+    def _set_data(self, matrix, node_ids, ref_doc_ids, ann=None):
+        """Replace the store's contents."""
+        self._matrix = matrix if matrix is not None else np.zeros((0, 0), dtype=np.float32)
+        self._node_ids = list(node_ids or [])
+        self._ref_doc_ids = list(ref_doc_ids or [None] * len(self._node_ids))
+        self._alive = np.ones(len(self._node_ids), dtype=bool)
+        self._id_to_row = {node_id: row for row, node_id in enumerate(self._node_ids)}
+        self._pending = []
+        self._ann = ann
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    @classmethod
+    def exists(cls, persist_dir: str):
+        """Return True if a NumpyVectorStore has been persisted in persist_dir."""
+        base = _base_path(os.path.join(persist_dir, DEFAULT_VECTOR_STORE_FNAME))
+        return os.path.exists(base + MATRIX_SUFFIX) and os.path.exists(base + IDS_SUFFIX)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str, mmap: bool = True):
+        """
+        Load the store persisted in persist_dir.
+
+        Args:
+            persist_dir (str): Directory the owning StorageContext was persisted to.
+            mmap (bool): Memory-map the matrix read-only instead of reading it into memory.
+
+        Returns:
+            NumpyVectorStore: The loaded store.
+        """
+        return cls.from_persist_path(os.path.join(persist_dir, DEFAULT_VECTOR_STORE_FNAME), mmap=mmap)
+
+    @classmethod
+    def from_persist_path(cls, persist_path: str, mmap: bool = True):
+        """Load the store from the path StorageContext passes to `persist`."""
+        base = _base_path(persist_path)
+        with open(base + IDS_SUFFIX, "r") as f:
+            ids = json.load(f)
+        matrix = np.load(base + MATRIX_SUFFIX, mmap_mode="r" if mmap else None)
+        if matrix.shape[0] != len(ids["node_ids"]):
+            raise ValueError(f"Vector store at '{base}' is inconsistent: {matrix.shape[0]} rows, {len(ids['node_ids'])} ids.")
+        ann = IVFIndex.load(base + ANN_SUFFIX) if os.path.exists(base + ANN_SUFFIX) else None
+        if ann is not None and len(ann.assignments) != matrix.shape[0]:
+            print(f"Ignoring stale ANN index at '{base}'.")
+            ann = None
+        return cls(matrix=matrix, node_ids=ids["node_ids"], ref_doc_ids=ids["ref_doc_ids"], ann=ann)
+
+    def count(self):
+        """Return the number of live vectors."""
+        self._flush_pending()
+        return int(self._alive.sum())
+
+    @property
+    def matrix(self):
+        """The normalized embedding matrix, including rows of deleted nodes."""
+        self._flush_pending()
+        return self._matrix
+
+    @property
+    def alive(self):
+        """Boolean mask of rows that belong to live nodes."""
+        self._flush_pending()
+        return self._alive
+
+    @property
+    def node_ids(self):
+        """Node id of every row of `matrix`."""
+        self._flush_pending()
+        return self._node_ids
+
+    def _flush_pending(self):
+        """Append vectors added since the last query or persist to the matrix."""
+        if not self._pending:
+            return
+        pending = np.asarray(self._pending, dtype=np.float32)
+        norms = np.linalg.norm(pending, axis=1, keepdims=True)
+        pending /= np.maximum(norms, 1e-12)
+        if self._matrix.size == 0:
+            self._matrix = pending
+        else:
+            self._matrix = np.concatenate([self._matrix, pending])
+        self._alive = np.concatenate([self._alive, np.ones(len(pending), dtype=bool)])
+        if self._ann is not None:
+            self._ann.extend(pending)
+        self._pending = []
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        """Add nodes with embeddings to the store."""
+        for node in nodes:
+            existing = self._id_to_row.get(node.node_id)
+            if existing is not None:
+                self._mark_deleted([existing])
+            self._id_to_row[node.node_id] = len(self._node_ids)
+            self._node_ids.append(node.node_id)
+            self._ref_doc_ids.append(node.ref_doc_id)
+            self._pending.append(node.get_embedding())
+        return [node.node_id for node in nodes]
+
+    def _mark_deleted(self, rows: List[int]):
+        self._flush_pending()
+        if rows:
+            self._alive[np.asarray(rows)] = False
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """Delete all nodes that came from the given document."""
+        rows = [row for row, doc_id in enumerate(self._ref_doc_ids) if doc_id == ref_doc_id]
+        self._mark_deleted(rows)
+
+    def delete_nodes(
+        self,
+        node_ids: Optional[List[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+        **delete_kwargs: Any,
+    ) -> None:
+        """Delete nodes by id."""
+        if filters is not None:
+            raise NotImplementedError("NumpyVectorStore does not store metadata and cannot delete by filter.")
+        rows = [self._id_to_row[node_id] for node_id in node_ids or [] if node_id in self._id_to_row]
+        self._mark_deleted(rows)
+
+    def clear(self) -> None:
+        """Remove every vector from the store."""
+        self._set_data(None, None, None)
+
+    def _candidate_rows(self, query: VectorStoreQuery):
+        """Rows allowed by the query's node_ids/doc_ids restrictions, or None for all rows."""
+        if query.node_ids is None and query.doc_ids is None:
+            return None
+        rows = set()
+        if query.node_ids is not None:
+            rows.update(self._id_to_row[node_id] for node_id in query.node_ids if node_id in self._id_to_row)
+        if query.doc_ids is not None:
+            doc_ids = set(query.doc_ids)
+            rows.update(row for row, doc_id in enumerate(self._ref_doc_ids) if doc_id in doc_ids)
+        return np.fromiter(sorted(rows), dtype=np.int64)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """Return the top k most similar nodes by cosine similarity."""
+        if query.filters is not None:
+            raise NotImplementedError("NumpyVectorStore does not store metadata and cannot filter.")
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Invalid query mode: {query.mode}")
+
+        self._flush_pending()
+        ids, similarities = self.search(
+            query.query_embedding,
+            query.similarity_top_k,
+            rows=self._candidate_rows(query),
+            exact=kwargs.get("exact", False),
+        )
+        return VectorStoreQueryResult(similarities=similarities, ids=ids)
+
+    def search(self, query_embedding, k: int, rows: np.ndarray = None, exact: bool = False, nprobe: int = None):
+        """
+        Find the k nearest live rows to a query embedding.
+
+        The ANN index is used when one is loaded, no row restriction is given and
+        exact is False; otherwise every candidate row is scored.
+
+        Args:
+            query_embedding (list): The query embedding.
+            k (int): Number of results.
+            rows (np.ndarray): Restrict the search to these rows. Default is all rows.
+            exact (bool): Ignore the ANN index. Default is False.
+            nprobe (int): Clusters probed by the ANN index. Default is the store's `nprobe`.
+
+        Returns:
+            tuple: (node ids, similarities), best first.
+        """
+        self._flush_pending()
+        if self._matrix.shape[0] == 0:
+            return [], []
+
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+
+        if rows is None and self._ann is not None and not exact:
+            rows = self._ann.candidates(query_vector, nprobe or self.nprobe)
+            rows = rows[self._alive[rows]]
+            # Too few rows in the probed clusters: fall back to exact search
+            if len(rows) < k:
+                rows = None
+
+        if rows is None:
+            scores = self._matrix @ query_vector
+            scores[~self._alive] = -np.inf
+            rows = np.arange(len(scores))
+        else:
+            rows = rows[self._alive[rows]]
+            scores = self._matrix[rows] @ query_vector
+
+        return self._top_k(rows, scores, k)
+
+    def search_batch(self, query_embeddings, k: int, exact: bool = False, nprobe: int = None):
+        """
+        Find the k nearest live rows to each of several query embeddings.
+
+        Without an ANN index all queries are scored with a single matrix product;
+        with one, each query is searched in its own probed clusters.
+
+        Args:
+            query_embeddings (list): The query embeddings.
+            k (int): Number of results per query.
+            exact (bool): Ignore the ANN index. Default is False.
+            nprobe (int): Clusters probed by the ANN index. Default is the store's `nprobe`.
+
+        Returns:
+            list: One (node ids, similarities) tuple per query, best first.
+        """
+        self._flush_pending()
+        if self._matrix.shape[0] == 0:
+            return [([], []) for _ in query_embeddings]
+        if self._ann is not None and not exact:
+            return [self.search(query, k, nprobe=nprobe) for query in query_embeddings]
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        scores = self._matrix @ queries.T
+        scores[~self._alive] = -np.inf
+        rows = np.arange(scores.shape[0])
+        return [self._top_k(rows, scores[:, column], k) for column in range(scores.shape[1])]
+
+    def _top_k(self, rows: np.ndarray, scores: np.ndarray, k: int):
+        """Select the k best scoring rows, best first."""
+        valid = np.isfinite(scores)
+        k = min(k, int(valid.sum()))
+        if k <= 0:
+            return [], []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self._node_ids[row] for row in rows[top]], scores[top].tolist()
+
+    @property
+    def ann(self):
+        """The IVF index used for approximate search, or None."""
+        self._flush_pending()
+        return self._ann
+
+    def build_ann_index(self, nlist: int = None):
+        """
+        Train an IVF index on the live vectors; later inserts are assigned to its clusters.
+
+        Args:
+            nlist (int): Number of clusters. Default is 4 * sqrt(number of vectors).
+        """
+        self._flush_pending()
+        self._ann = IVFIndex.train(self._matrix, self._alive, nlist=nlist)
+        print(f"Built IVF index with {self._ann.nlist} clusters over {self.count()} vectors.")
+
+    def drop_ann_index(self):
+        """Remove the ANN index so every query is exact."""
+        self._ann = None
+
+    def persist(self, persist_path: str, fs: Optional[Any] = None) -> None:
+        """
+        Compact deleted rows and write the matrix and id table.
+
+        Both files are written to temporary names first and then renamed into place.
+        """
+        self._flush_pending()
+        base = _base_path(persist_path)
+        os.makedirs(os.path.dirname(base) or ".", exist_ok=True)
+
+        keep = np.flatnonzero(self._alive)
+        matrix = np.ascontiguousarray(self._matrix[keep], dtype=np.float32) if self._matrix.size else self._matrix
+        node_ids = [self._node_ids[row] for row in keep]
+        ref_doc_ids = [self._ref_doc_ids[row] for row in keep]
+
+        with open(base + MATRIX_SUFFIX + ".tmp", "wb") as f:
+            np.save(f, matrix)
+        with open(base + IDS_SUFFIX + ".tmp", "w") as f:
+            json.dump({"node_ids": node_ids, "ref_doc_ids": ref_doc_ids}, f)
+        os.replace(base + MATRIX_SUFFIX + ".tmp", base + MATRIX_SUFFIX)
+        os.replace(base + IDS_SUFFIX + ".tmp", base + IDS_SUFFIX)
+
+        # Keep the ANN index aligned with the compacted rows
+        ann = self._ann
+        if ann is not None:
+            ann.select(keep)
+            ann.save(base + ANN_SUFFIX)
+        elif os.path.exists(base + ANN_SUFFIX):
+            os.remove(base + ANN_SUFFIX)
+
+        # A JSON file left over from a SimpleVectorStore build is stale
+        if persist_path.endswith(".json") and os.path.exists(persist_path):
+            os.remove(persist_path)
+
+        self._set_data(matrix, node_ids, ref_doc_ids, ann)
+
+
+def load_vector_store(persist_dir: str):
+    """
+    Return the NumpyVectorStore persisted in persist_dir, or None for a legacy JSON vector store.
+
+    Args:
+        persist_dir (str): Directory of a persisted vector index.
+
+    Returns:
+        NumpyVectorStore: The memory-mapped store, or None if the directory holds a SimpleVectorStore.
+    """
+    if NumpyVectorStore.exists(persist_dir):
+        return NumpyVectorStore.from_persist_dir(persist_dir)
+    return None
@@ -1,64 +1,207 @@
 import os
+import json
+import time
 import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import ocrmypdf
 
+from ingest_manifest import file_sha256
+
 # Base directory for user-specific data
 BASE_DIR = "./user_data"
 
 # Languages for OCR
 LANGUAGES = 'eng+hin+ben+chi_sim+chi_tra'
 
-def process_pdf_files_in_directory(user_id: str, source_dir: str):
+# File inside a user's folder describing the last OCR run
+OCR_MANIFEST_FILENAME = "ocr_manifest.json"
+
+
+def _atomic_output_path(output_path: str):
+    """Hidden temporary path next to output_path; hidden files are ignored by the embedder."""
+    directory, filename = os.path.split(output_path)
+    return os.path.join(directory, f".{filename}.{os.getpid()}.tmp.pdf")
+
+
+def _process_pdf(file_path: str, output_pdf: str, ocr: bool, languages: str, jobs_per_file: int):
     """
-    Process PDF files in a directory and save the OCR-processed PDFs in a user-specific directory.
+    OCR or copy one PDF to output_pdf. Runs in a worker process.
+
+    The result is written to a temporary file and renamed into place, so the
+    destination never holds a partially written PDF.
+
+    Returns:
+        dict: Manifest entry for the file.
+    """
+    start = time.perf_counter()
+    tmp_pdf = _atomic_output_path(output_pdf)
+    entry = {"source": file_path, "status": "copied", "error": None}
+
+    try:
+        if ocr:
+            try:
+                # skip_text leaves pages that already have a text layer untouched;
+                # jobs OCRs the remaining pages of this file in parallel
+                ocrmypdf.ocr(
+                    file_path,
+                    tmp_pdf,
+                    language=languages.split("+"),
+                    skip_text=True,
+                    jobs=jobs_per_file,
+                    use_threads=True,
+                    progress_bar=False,
+                )
+                entry["status"] = "ocr"
+            except Exception as e:
+                # Keep the document searchable through whatever text layer it already has
+                entry["error"] = f"OCR failed, copied original: {e}"
+                shutil.copyfile(file_path, tmp_pdf)
+        else:
+            shutil.copyfile(file_path, tmp_pdf)
+
+        os.replace(tmp_pdf, output_pdf)
+    except Exception as e:
+        if os.path.exists(tmp_pdf):
+            os.remove(tmp_pdf)
+        entry.update(status="failed", error=str(e), seconds=round(time.perf_counter() - start, 3))
+        return entry
+
+    stat = os.stat(output_pdf)
+    entry.update(
+        sha256=file_sha256(output_pdf),
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        seconds=round(time.perf_counter() - start, 3),
+    )
+    return entry
+
+
+def _save_ocr_manifest(user_dir: str, manifest: dict):
+    """Write the OCR manifest atomically."""
+    path = os.path.join(user_dir, OCR_MANIFEST_FILENAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def ocr_pdf_files(
+    user_id: str,
+    source_dir: str,
+    ocr: bool = False,
+    workers: int = None,
+    jobs_per_file: int = 1,
+    languages: str = LANGUAGES,
+    base_dir: str = BASE_DIR,
+):
+    """
+    OCR the PDFs under source_dir concurrently and move everything into the user's OCR folder.
+
+    PDFs are handled by a pool of worker processes. With ocr=True each file is run
+    through ocrmypdf, which skips pages that already have a text layer and OCRs the
+    others using jobs_per_file threads. Outputs are written atomically and the
+    originals are deleted once their output is in place. Other files are moved as is.
 
     Args:
         user_id (str): Unique identifier for the user.
-        source_dir (str): Directory containing the raw PDF files.
+        source_dir (str): Directory containing the raw files, searched recursively.
+        ocr (bool): Run OCR; otherwise PDFs are only copied. Default is False.
+        workers (int): Number of worker processes. Default is CPU count / jobs_per_file.
+        jobs_per_file (int): Pages of one PDF OCRed in parallel. Default is 1.
+        languages (str): Tesseract languages joined by '+'. Default is LANGUAGES.
+        base_dir (str): Base directory for user-specific data. Default is './user_data'.
 
     Returns:
-        str: Path to the directory where OCR-processed PDFs are saved.
+        dict: Manifest with 'destination_dir', 'total_seconds' and per-output 'files'
+            entries (source, status, seconds, sha256, size, mtime_ns, error). It is also
+            saved as ocr_manifest.json in the user's folder and can be passed to
+            `create_and_save_user_indices(ocr_manifest=...)`.
     """
+    start = time.perf_counter()
+
     # User-specific directories
-    user_dir = os.path.join(BASE_DIR, user_id)
+    user_dir = os.path.join(base_dir, user_id)
     destination_dir = os.path.join(user_dir, "ocr_processed")
     os.makedirs(destination_dir, exist_ok=True)
 
-    # Loop through all files and subdirectories in the source directory
-    for filename in os.listdir(source_dir):
-        file_path = os.path.join(source_dir, filename)
+    # Collect files from the source directory and its subdirectories
+    pdf_files, other_files = [], []
+    for root, _, filenames in os.walk(source_dir):
+        for filename in sorted(filenames):
+            file_path = os.path.join(root, filename)
+            (pdf_files if filename.endswith('.pdf') else other_files).append(file_path)
 
-        # If it's a directory, recursively process files inside
-        if os.path.isdir(file_path):
-            print(f"Entering directory: {file_path}")
-            process_pdf_files_in_directory(user_id, file_path)
-        elif filename.endswith('.pdf'):  # If it's a PDF file
-            output_pdf = os.path.join(destination_dir, filename)
+    files = {}
 
-            try:
-                print(f"Processing: {file_path}")
+    # Move non-PDF files to the user-specific directory
+    for file_path in other_files:
+        filename = os.path.basename(file_path)
+        destination_file = os.path.join(destination_dir, filename)
+        try:
+            shutil.move(file_path, destination_file)
+            files[filename] = {"source": file_path, "status": "moved", "error": None, "seconds": 0.0}
+            print(f"Moved non-PDF file: {file_path} -> {destination_file}")
+        except Exception as e:
+            files[filename] = {"source": file_path, "status": "failed", "error": str(e), "seconds": 0.0}
+            print(f"Error moving non-PDF file {file_path}: {e}")
+
+    if pdf_files:
+        jobs_per_file = max(1, jobs_per_file)
+        workers = workers or max(1, (os.cpu_count() or 1) // jobs_per_file)
+        workers = min(workers, len(pdf_files))
+        print(f"Processing {len(pdf_files)} PDF(s) with {workers} worker(s), OCR {'on' if ocr else 'off'}.")
 
-                # OCR processing step (currently skipped)
-                # ocrmypdf.ocr(file_path, output_pdf, language=LANGUAGES, force_ocr=True)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for file_path in pdf_files:
+                output_pdf = os.path.join(destination_dir, os.path.basename(file_path))
+                future = executor.submit(_process_pdf, file_path, output_pdf, ocr, languages, jobs_per_file)
+                futures[future] = file_path
 
-                # Instead of performing OCR, just copy the PDF
-                shutil.copy(file_path, output_pdf)
-                print(f"Copied PDF without OCR: {file_path} -> Saved as: {output_pdf}")
+            for future in as_completed(futures):
+                file_path = futures[future]
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    entry = {"source": file_path, "status": "failed", "error": str(e), "seconds": 0.0}
+                files[os.path.basename(file_path)] = entry
 
-                # Delete the original PDF after copying
+                if entry["status"] == "failed":
+                    print(f"Error processing {file_path}: {entry['error']}")
+                    continue
+                print(f"{entry['status'].capitalize()} {file_path} in {entry['seconds']:.2f}s")
+                if entry["error"]:
+                    print(f"  {entry['error']}")
+
+                # Delete the original PDF once its output is in place
                 os.remove(file_path)
-                print(f"Deleted original file: {file_path}")
 
-            except Exception as e:
-                print(f"Error processing {file_path}: {e}")
-        else:  # If it's not a PDF, move the file to the user-specific directory
-            try:
-                destination_file = os.path.join(destination_dir, filename)
-                shutil.move(file_path, destination_file)
-                print(f"Moved non-PDF file: {file_path} -> {destination_file}")
-            except Exception as e:
-                print(f"Error moving non-PDF file {file_path}: {e}")
+    manifest = {
+        "destination_dir": os.path.abspath(destination_dir),
+        "ocr": ocr,
+        "languages": languages,
+        "total_seconds": round(time.perf_counter() - start, 3),
+        "files": files,
+    }
+    _save_ocr_manifest(user_dir, manifest)
+
+    print(
+        f"Processing completed for user: {user_id} in {manifest['total_seconds']:.2f}s. "
+        f"OCR results saved in: {destination_dir}"
+    )
+    return manifest
 
-    print(f"Processing completed for user: {user_id}. OCR results saved in: {destination_dir}")
 
-    return destination_dir
+def process_pdf_files_in_directory(user_id: str, source_dir: str, **kwargs):
+    """
+    Process PDF files in a directory and save the OCR-processed PDFs in a user-specific directory.
+
+    Args:
+        user_id (str): Unique identifier for the user.
+        source_dir (str): Directory containing the raw PDF files.
+        **kwargs: Options for `ocr_pdf_files` (ocr, workers, jobs_per_file, languages, base_dir).
+
+    Returns:
+        str: Path to the directory where OCR-processed PDFs are saved.
+    """
+    return ocr_pdf_files(user_id, source_dir, **kwargs)["destination_dir"]
@@ -0,0 +1,193 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, List
+
+# Longest time a query waits for others to join its batch
+DEFAULT_WINDOW_MS = 5.0
+
+# Most queries embedded and searched together
+DEFAULT_MAX_BATCH = 32
+
+# The process-wide batcher; None while batching is disabled
+_batcher = {"instance": None}
+_batcher_lock = threading.Lock()
+
+
+def embed_queries(embed_model: Any, queries: List[str]):
+    """
+    Embed several queries in one forward pass when the model supports it.
+
+    CachedEmbedding and EmbeddingService batch natively; HuggingFaceEmbedding is
+    batched through its query prompt. Other models embed one query at a time.
+    """
+    if hasattr(embed_model, "_get_query_embeddings"):
+        return embed_model._get_query_embeddings(queries)
+    if hasattr(embed_model, "_embed"):
+        return embed_model._embed(queries, prompt_name="query")
+    return [embed_model.get_query_embedding(query) for query in queries]
+
+
+class _Request:
+    __slots__ = ("embed_model", "store", "query", "k", "nprobe", "embedding", "future", "enqueued")
+
+    def __init__(self, embed_model, store, query, k, nprobe, embedding):
+        self.embed_model = embed_model
+        self.store = store
+        self.query = query
+        self.k = k
+        self.nprobe = nprobe
+        self.embedding = embedding
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+def _group(requests: List[_Request], key):
+    """Group requests by the identity of key(request), keeping arrival order."""
+    groups = {}
+    for request in requests:
+        groups.setdefault(id(key(request)), []).append(request)
+    return groups.values()
+
+
+class QueryBatcher:
+    """
+    Embed and search concurrent queries in batches on one worker thread.
+
+    Queries are embedded with one forward pass per embedding model, and the queries
+    for each vector store are scored with one matrix product. When the server is
+    idle a query runs at once; a query only waits up to the window for others to
+    join when the previous batch held more than one query or more are already queued.
+    """
+
+    def __init__(self, window_ms: float = DEFAULT_WINDOW_MS, max_batch: int = DEFAULT_MAX_BATCH):
+        """
+        Args:
+            window_ms (float): Longest time a query waits for others to join its batch. Default is 5.
+            max_batch (int): Most queries in one batch. Default is 32.
+        """
+        self.window_ms = window_ms
+        self.max_batch = max_batch
+        self.batches = 0
+        self.requests = 0
+        self._queue = queue.Queue()
+        self._last_batch_size = 1
+        self._thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+        self._thread.start()
+
+    def search(self, embed_model: Any, store: Any, query: str, k: int, nprobe: int = None, embedding=None):
+        """
+        Embed query (unless embedding is given) and find its k nearest nodes in store, batched with others.
+
+        Args:
+            embed_model (BaseEmbedding): Model that embeds the query.
+            store (NumpyVectorStore): The vector store to search.
+            query (str): The query text.
+            k (int): Number of results.
+            nprobe (int): Clusters probed when the store has an ANN index.
+            embedding (list): The query embedding, if already computed.
+
+        Returns:
+            dict: 'embedding', 'ids', 'similarities', 'batch_size', 'wait_ms' and 'embed_ms'.
+        """
+        request = _Request(embed_model, store, query, k, nprobe, embedding)
+        self._queue.put(request)
+        return request.future.result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        if batch[0] is None:
+            return None
+        under_load = self._last_batch_size > 1 or not self._queue.empty()
+        deadline = time.perf_counter() + (self.window_ms / 1000 if under_load else 0.0)
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # Finish this batch, then stop
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                break
+            self._last_batch_size = len(batch)
+            self.batches += 1
+            self.requests += len(batch)
+            self._process(batch)
+
+    def _process(self, batch: List[_Request]):
+        start = time.perf_counter()
+        for requests in _group([r for r in batch if r.embedding is None], lambda r: r.embed_model):
+            try:
+                vectors = embed_queries(requests[0].embed_model, [r.query for r in requests])
+                for request, vector in zip(requests, vectors):
+                    request.embedding = vector
+            except Exception as e:
+                for request in requests:
+                    request.future.set_exception(e)
+        embed_ms = (time.perf_counter() - start) * 1000
+
+        pending = [r for r in batch if not r.future.done()]
+        for requests in _group(pending, lambda r: r.store):
+            # Requests for the same store share one matrix product, per nprobe setting
+            for same_probe in _group(requests, lambda r: r.nprobe):
+                try:
+                    k = max(r.k for r in same_probe)
+                    results = same_probe[0].store.search_batch(
+                        [r.embedding for r in same_probe], k, nprobe=same_probe[0].nprobe
+                    )
+                    for request, (ids, similarities) in zip(same_probe, results):
+                        request.future.set_result({
+                            "embedding": request.embedding,
+                            "ids": ids[:request.k],
+                            "similarities": similarities[:request.k],
+                            "batch_size": len(batch),
+                            "wait_ms": round((start - request.enqueued) * 1000, 3),
+                            "embed_ms": round(embed_ms, 3),
+                        })
+                except Exception as e:
+                    for request in same_probe:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+
+    def stats(self):
+        """Return the number of batches and queries processed so far."""
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": round(self.requests / self.batches, 3) if self.batches else 0.0,
+        }
+
+    def close(self):
+        """Stop the worker after the queued queries."""
+        self._queue.put(None)
+        self._thread.join()
+
+
+def configure_query_batching(window_ms: float = DEFAULT_WINDOW_MS, max_batch: int = DEFAULT_MAX_BATCH):
+    """
+    Batch the query embeddings and vector searches of concurrent retrievals in this process.
+
+    Args:
+        window_ms (float): Longest time a query waits for others, or None to disable batching.
+        max_batch (int): Most queries in one batch. Default is 32.
+    """
+    with _batcher_lock:
+        previous = _batcher["instance"]
+        _batcher["instance"] = QueryBatcher(window_ms, max_batch) if window_ms is not None else None
+    if previous is not None:
+        previous.close()
+
+
+def get_query_batcher():
+    """Return the process-wide QueryBatcher, or None if batching is disabled."""
+    return _batcher["instance"]
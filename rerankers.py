@@ -0,0 +1,199 @@
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.callbacks import CBEventType, EventPayload
+from llama_index.core.postprocessor import LLMRerank
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+
+# Rerankers selectable through initialize_query_engine(reranker=...)
+RERANKERS = ("llm", "cross_encoder", "similarity", "none")
+
+DEFAULT_CROSS_ENCODER = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# Cross-encoder models loaded in this process, keyed by model name
+_cross_encoders = {}
+_cross_encoders_lock = threading.Lock()
+
+
+class ScoreCache:
+    """Thread-safe LRU cache of rerank scores keyed by (query, node id)."""
+
+    def __init__(self, max_size: int = 50000):
+        self.max_size = max_size
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, query: str, node_ids: List[str]):
+        """Return the cached scores for node_ids as a dict."""
+        found = {}
+        with self._lock:
+            for node_id in node_ids:
+                score = self._scores.get((query, node_id))
+                if score is not None:
+                    self._scores.move_to_end((query, node_id))
+                    found[node_id] = score
+        return found
+
+    def put_many(self, query: str, scores: dict):
+        """Store scores for a query, evicting the least recently used entries."""
+        with self._lock:
+            for node_id, score in scores.items():
+                self._scores[(query, node_id)] = score
+                self._scores.move_to_end((query, node_id))
+            while len(self._scores) > self.max_size:
+                self._scores.popitem(last=False)
+
+
+class _CachedScoreRerank(BaseNodePostprocessor):
+    """Base class for rerankers that score all candidates in one batch and cache the scores."""
+
+    top_n: int = Field(default=5, description="Number of nodes to return sorted by score.")
+    _score_cache: ScoreCache = PrivateAttr()
+
+    def __init__(self, cache_size: int = 50000, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._score_cache = ScoreCache(cache_size)
+
+    def _score(self, query: str, texts: List[str]) -> List[float]:
+        """Score every (query, text) pair in a single batch."""
+        raise NotImplementedError
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if query_bundle is None:
+            raise ValueError("Missing query bundle in extra info.")
+        if len(nodes) == 0:
+            return []
+
+        query = query_bundle.query_str
+        node_ids = [n.node.node_id for n in nodes]
+        scores = self._score_cache.get_many(query, node_ids)
+
+        missing = [n for n in nodes if n.node.node_id not in scores]
+        if missing:
+            with self.callback_manager.event(
+                CBEventType.RERANKING,
+                payload={
+                    EventPayload.NODES: missing,
+                    EventPayload.QUERY_STR: query,
+                    EventPayload.TOP_K: self.top_n,
+                },
+            ) as event:
+                texts = [n.node.get_content(metadata_mode=MetadataMode.EMBED) for n in missing]
+                computed = dict(zip((n.node.node_id for n in missing), self._score(query, texts)))
+                event.on_end(payload={EventPayload.NODES: missing})
+            self._score_cache.put_many(query, computed)
+            scores.update(computed)
+
+        reranked = [NodeWithScore(node=n.node, score=float(scores[n.node.node_id])) for n in nodes]
+        reranked.sort(key=lambda n: n.score, reverse=True)
+        return reranked[: self.top_n]
+
+
+class SimilarityRerank(_CachedScoreRerank):
+    """
+    Rerank by cosine similarity between the query and node embeddings.
+
+    Node embeddings come from the embedding model, which serves chunks that were
+    embedded at ingestion time from the embedding cache, so this costs one query
+    embedding and no LLM calls.
+    """
+
+    _embed_model: Any = PrivateAttr()
+
+    def __init__(self, embed_model: Any, top_n: int = 5, cache_size: int = 50000):
+        """
+        Args:
+            embed_model (BaseEmbedding): The embedding model used for the index.
+            top_n (int): Number of nodes to return. Default is 5.
+            cache_size (int): Maximum number of cached (query, node) scores.
+        """
+        super().__init__(top_n=top_n, cache_size=cache_size)
+        self._embed_model = embed_model
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SimilarityRerank"
+
+    def _score(self, query: str, texts: List[str]) -> List[float]:
+        query_vector = np.asarray(self._embed_model.get_query_embedding(query), dtype=np.float32)
+        text_vectors = np.asarray(self._embed_model.get_text_embedding_batch(texts), dtype=np.float32)
+        query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+        text_vectors /= np.maximum(np.linalg.norm(text_vectors, axis=1, keepdims=True), 1e-12)
+        return (text_vectors @ query_vector).tolist()
+
+
+class CrossEncoderRerank(_CachedScoreRerank):
+    """
+    Rerank with a small local sentence-transformers cross-encoder on CPU.
+
+    All candidates are scored in one forward pass and the model is loaded once per process.
+    """
+
+    model: str = Field(default=DEFAULT_CROSS_ENCODER, description="Cross-encoder model name.")
+    device: str = Field(default="cpu", description="Device to run the cross-encoder on.")
+
+    def __init__(
+        self,
+        model: str = DEFAULT_CROSS_ENCODER,
+        top_n: int = 5,
+        device: str = "cpu",
+        cache_size: int = 50000,
+    ):
+        """
+        Args:
+            model (str): Cross-encoder model name. Default is 'cross-encoder/ms-marco-MiniLM-L-6-v2'.
+            top_n (int): Number of nodes to return. Default is 5.
+            device (str): Torch device. Default is 'cpu'.
+            cache_size (int): Maximum number of cached (query, node) scores.
+        """
+        super().__init__(model=model, top_n=top_n, device=device, cache_size=cache_size)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CrossEncoderRerank"
+
+    def _load_model(self):
+        with _cross_encoders_lock:
+            key = (self.model, self.device)
+            if key not in _cross_encoders:
+                from sentence_transformers import CrossEncoder
+
+                print(f"Loading cross-encoder: {self.model}")
+                _cross_encoders[key] = CrossEncoder(self.model, max_length=512, device=self.device)
+            return _cross_encoders[key]
+
+    def _score(self, query: str, texts: List[str]) -> List[float]:
+        model = self._load_model()
+        scores = model.predict([(query, text) for text in texts], batch_size=len(texts), show_progress_bar=False)
+        return [float(score) for score in scores]
+
+
+def build_reranker(reranker: str, top_n: int = 5, embed_model: Any = None):
+    """
+    Create the node postprocessor for a reranker name.
+
+    Args:
+        reranker (str): 'llm' (LLMRerank), 'cross_encoder', 'similarity' or 'none'.
+        top_n (int): Number of nodes kept after reranking. Default is 5.
+        embed_model (BaseEmbedding): Embedding model, required for 'similarity'.
+
+    Returns:
+        BaseNodePostprocessor: The reranker, or None for 'none'.
+    """
+    if reranker == "llm":
+        return LLMRerank(choice_batch_size=10, top_n=top_n)
+    if reranker == "cross_encoder":
+        return CrossEncoderRerank(top_n=top_n)
+    if reranker == "similarity":
+        return SimilarityRerank(embed_model, top_n=top_n)
+    if reranker == "none":
+        return None
+    raise ValueError(f"Invalid reranker: {reranker}. Expected one of {RERANKERS}.")
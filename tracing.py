@@ -0,0 +1,434 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+from functools import partial
+from typing import Any, Dict, List, Optional
+
+from llama_index.core.callbacks import CBEventType, EventPayload
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+
+# Default JSONL file receiving one line per finished query trace
+DEFAULT_TRACE_LOG = "./user_data/traces.jsonl"
+
+# The trace log is rotated to <name>.1 once it grows past this size
+MAX_TRACE_LOG_BYTES = 50 * 1024 * 1024
+
+# Histogram buckets (seconds) of the per-stage latency metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Trace of the query being handled and the innermost open span, per thread / asyncio task
+_current_trace = contextvars.ContextVar("query_trace", default=None)
+_current_span = contextvars.ContextVar("query_span", default=None)
+
+# Set while an LLM call that is already being traced runs its inner call
+_nested_llm_call = contextvars.ContextVar("nested_llm_call", default=False)
+
+
+class QueryTrace:
+    """
+    Timings of one query through the pipeline.
+
+    Stages record spans (name, offset and duration in ms, plus attributes such as
+    candidate counts) through `span()`; LLM calls are added by TracingCallbackHandler
+    with their token counts. The trace is finished once the answer has been fully
+    generated, which writes it to the JSONL log and the metrics.
+    """
+
+    def __init__(self, user_id: str, query: str):
+        self.trace_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.query = query
+        self.timestamp = time.time()
+        self.spans: List[dict] = []
+        self.attributes: Dict[str, Any] = {}
+        self.finished = False
+        # Set by start_trace, to restore the context's previous trace once this one finishes
+        self._context_token = None
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _ms(self, seconds: float):
+        return round(seconds * 1000, 2)
+
+    def add_span(self, name: str, start: float, end: float, **attributes):
+        """Record a span from perf_counter() timestamps start to end."""
+        record = {"name": name, "start_ms": self._ms(start - self._start), "duration_ms": self._ms(end - start)}
+        record.update(attributes)
+        with self._lock:
+            self.spans.append(record)
+        return record
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Time the enclosed block; attributes can be added to the yielded dict."""
+        start = time.perf_counter()
+        token = _current_span.set(name)
+        try:
+            yield attributes
+        finally:
+            _current_span.reset(token)
+            self.add_span(name, start, time.perf_counter(), **attributes)
+
+    def iter_text(self, chunks):
+        """Pass answer chunks through, timing generation and finishing the trace at the end."""
+        start = time.perf_counter()
+        first = None
+        error = None
+        try:
+            for chunk in chunks:
+                if first is None:
+                    first = time.perf_counter()
+                yield chunk
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._end_generation(start, first, error)
+
+    async def aiter_text(self, chunks):
+        """Async version of iter_text."""
+        start = time.perf_counter()
+        first = None
+        error = None
+        try:
+            async for chunk in chunks:
+                if first is None:
+                    first = time.perf_counter()
+                yield chunk
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._end_generation(start, first, error)
+
+    def _end_generation(self, start: float, first: Optional[float], error: Optional[BaseException]):
+        end = time.perf_counter()
+        self.add_span("generate", start, end)
+        if first is not None:
+            self.attributes["ttft_ms"] = self._ms(first - self._start)
+        self.finish(error)
+
+    def finish(self, error: BaseException = None):
+        """Close the trace and hand it to the log and metrics. Later calls do nothing."""
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+            self.attributes["total_ms"] = self._ms(time.perf_counter() - self._start)
+        self._detach()
+        if error is not None:
+            self.attributes["error"] = f"{type(error).__name__}: {error}"
+        record = self.to_dict()
+        _write_trace(record)
+        METRICS.observe(record)
+
+    def _detach(self):
+        """Stop being the current trace of the context that started it."""
+        token, self._context_token = self._context_token, None
+        if token is None or _current_trace.get() is not self:
+            return
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # Finished from another context, e.g. a stream drained in a worker thread;
+            # the starting context's value is ignored now that the trace is finished
+            pass
+
+    def llm_totals(self):
+        """Return the number of LLM calls and their prompt and completion tokens."""
+        llm_spans = [s for s in self.spans if s["name"] == "llm"]
+        return {
+            "calls": len(llm_spans),
+            "prompt_tokens": sum(s.get("prompt_tokens") or 0 for s in llm_spans),
+            "completion_tokens": sum(s.get("completion_tokens") or 0 for s in llm_spans),
+        }
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s["start_ms"])
+        return {
+            "trace_id": self.trace_id,
+            "timestamp": self.timestamp,
+            "user_id": self.user_id,
+            "query": self.query,
+            **self.attributes,
+            "llm": self.llm_totals(),
+            "spans": spans,
+        }
+
+    def breakdown(self):
+        """Rows (stage, ms, details) in start order, for display."""
+        rows = []
+        for s in self.to_dict()["spans"]:
+            details = {k: v for k, v in s.items() if k not in ("name", "start_ms", "duration_ms")}
+            rows.append({
+                "stage": s["name"] if "parent" not in s else f"{s['name']} ({s['parent']})",
+                "start (ms)": s["start_ms"],
+                "duration (ms)": s["duration_ms"],
+                "details": ", ".join(f"{k}={v}" for k, v in details.items()),
+            })
+        return rows
+
+
+def start_trace(user_id: str, query: str):
+    """
+    Start tracing a query in the current thread or task.
+
+    Spans recorded by the pipeline while this context is active belong to the
+    returned trace. Finish it with `trace.iter_text(...)` / `trace.aiter_text(...)`
+    around the answer, or with `trace.finish()`; later work in the same context,
+    e.g. the next loop of a Streamlit script or the voice bot, is no longer traced.
+    """
+    trace = QueryTrace(user_id, query)
+    trace._context_token = _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    """Return the trace of the query being handled, or None."""
+    trace = _current_trace.get()
+    return trace if trace is not None and not trace.finished else None
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time the enclosed block as a stage of the current trace; a no-op when nothing is traced."""
+    trace = current_trace()
+    if trace is None:
+        yield attributes
+        return
+    with trace.span(name, **attributes) as record:
+        yield record
+
+
+def bind_context(func, *args, **kwargs):
+    """
+    Return a callable running func in a copy of the current context.
+
+    Thread pools do not carry contextvars over, so work submitted to them is
+    wrapped with this to keep its spans in the submitting query's trace.
+    """
+    return partial(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+@contextmanager
+def nested_llm_call():
+    """
+    Leave LLM events started in the enclosed block out of the trace.
+
+    Wraps the chat call a completion makes, so the call is counted once.
+    """
+    token = _nested_llm_call.set(True)
+    try:
+        yield
+    finally:
+        _nested_llm_call.reset(token)
+
+
+def _raw_count(raw, key: str):
+    """Read a token count from an LLM's raw response (dict or subscriptable model)."""
+    try:
+        value = raw[key] if raw is not None else None
+    except (KeyError, TypeError, IndexError):
+        value = None
+    return int(value) if value is not None else None
+
+
+def _count_tokens(text: str):
+    from llama_index.core.utils import get_tokenizer
+    return len(get_tokenizer()(text))
+
+
+def _llm_token_counts(start_payload: dict, end_payload: dict):
+    """
+    Return (prompt_tokens, completion_tokens, estimated) for one LLM call.
+
+    Ollama reports exact counts (prompt_eval_count, eval_count) in the raw response;
+    otherwise the prompt and completion text are counted with the default tokenizer.
+    """
+    response = end_payload.get(EventPayload.RESPONSE) or end_payload.get(EventPayload.COMPLETION)
+    raw = getattr(response, "raw", None)
+    prompt_tokens = _raw_count(raw, "prompt_eval_count")
+    completion_tokens = _raw_count(raw, "eval_count")
+    estimated = False
+
+    if prompt_tokens is None:
+        estimated = True
+        prompt = start_payload.get(EventPayload.PROMPT)
+        if prompt is None:
+            prompt = "\n".join(str(m.content or "") for m in start_payload.get(EventPayload.MESSAGES) or [])
+        prompt_tokens = _count_tokens(prompt)
+    if completion_tokens is None:
+        estimated = True
+        message = getattr(response, "message", None)
+        text = message.content if message is not None else getattr(response, "text", None)
+        completion_tokens = _count_tokens(text or "")
+    return prompt_tokens, completion_tokens, estimated
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Adds an 'llm' span with token counts to the current trace for every LLM call."""
+
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        if event_type == CBEventType.LLM and not _nested_llm_call.get():
+            trace = current_trace()
+            if trace is not None:
+                with self._lock:
+                    self._open[event_id] = (trace, _current_span.get(), time.perf_counter(), payload or {})
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        if event_type != CBEventType.LLM:
+            return
+        # Streaming calls end in whichever thread drains the stream, so match on event id
+        with self._lock:
+            entry = self._open.pop(event_id, None)
+        if entry is None:
+            return
+        trace, parent, start, start_payload = entry
+        if trace.finished:
+            return
+        payload = payload or {}
+        attributes = {"parent": parent}
+        if EventPayload.EXCEPTION in payload:
+            attributes["error"] = str(payload[EventPayload.EXCEPTION])
+        else:
+            try:
+                prompt_tokens, completion_tokens, estimated = _llm_token_counts(start_payload, payload)
+                attributes.update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+                if estimated:
+                    attributes["tokens_estimated"] = True
+            except Exception:
+                pass
+        trace.add_span("llm", start, time.perf_counter(), **attributes)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        pass
+
+
+# Handler registered on the shared LLM clients (see models.get_llm)
+TRACING_HANDLER = TracingCallbackHandler()
+
+
+class TraceMetrics:
+    """In-process aggregates of finished traces, rendered in the Prometheus text format."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._queries = {}
+        self._latency = {}
+        self._candidates = {}
+        self._tokens = {}
+
+    def _observe_latency(self, stage: str, seconds: float):
+        counts, total, count = self._latency.get(stage, ([0] * len(self.buckets), 0.0, 0))
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                counts[i] += 1
+        self._latency[stage] = (counts, total + seconds, count + 1)
+
+    def observe(self, record: dict):
+        """Add one finished trace."""
+        with self._lock:
+            outcome = "error" if "error" in record else ("cache_hit" if record.get("cache_hit") else "ok")
+            self._queries[outcome] = self._queries.get(outcome, 0) + 1
+            self._observe_latency("total", record["total_ms"] / 1000)
+            if "ttft_ms" in record:
+                self._observe_latency("first_token", record["ttft_ms"] / 1000)
+            for s in record["spans"]:
+                stage = s["name"] if s["name"] != "llm" else f"llm:{s.get('parent')}"
+                self._observe_latency(stage, s["duration_ms"] / 1000)
+                if "candidates" in s:
+                    total, count = self._candidates.get(stage, (0, 0))
+                    self._candidates[stage] = (total + s["candidates"], count + 1)
+                for kind in ("prompt", "completion"):
+                    if s.get(f"{kind}_tokens") is not None:
+                        key = (stage, kind)
+                        self._tokens[key] = self._tokens.get(key, 0) + s[f"{kind}_tokens"]
+
+    def render(self):
+        """Return all metrics as Prometheus exposition text."""
+        lines = []
+        with self._lock:
+            lines.append("# HELP rag_queries_total Finished queries by outcome.")
+            lines.append("# TYPE rag_queries_total counter")
+            for outcome, value in sorted(self._queries.items()):
+                lines.append(f'rag_queries_total{{outcome="{outcome}"}} {value}')
+
+            lines.append("# HELP rag_stage_duration_seconds Latency of each pipeline stage.")
+            lines.append("# TYPE rag_stage_duration_seconds histogram")
+            for stage, (counts, total, count) in sorted(self._latency.items()):
+                for bound, value in zip(self.buckets, counts):
+                    lines.append(f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {value}')
+                lines.append(f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                lines.append(f'rag_stage_duration_seconds_sum{{stage="{stage}"}} {total:.6f}')
+                lines.append(f'rag_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+
+            lines.append("# HELP rag_stage_candidates Nodes remaining after each retrieval stage.")
+            lines.append("# TYPE rag_stage_candidates summary")
+            for stage, (total, count) in sorted(self._candidates.items()):
+                lines.append(f'rag_stage_candidates_sum{{stage="{stage}"}} {total}')
+                lines.append(f'rag_stage_candidates_count{{stage="{stage}"}} {count}')
+
+            lines.append("# HELP rag_llm_tokens_total LLM tokens by calling stage and kind.")
+            lines.append("# TYPE rag_llm_tokens_total counter")
+            for (stage, kind), value in sorted(self._tokens.items()):
+                lines.append(f'rag_llm_tokens_total{{stage="{stage}",kind="{kind}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of this process
+METRICS = TraceMetrics()
+
+# Where finished traces are appended; None disables the log
+_trace_log = {"path": DEFAULT_TRACE_LOG}
+_trace_log_lock = threading.Lock()
+
+def configure_trace_log(path: Optional[str] = DEFAULT_TRACE_LOG):
+    """Set the JSONL file finished traces are appended to, or None to disable it."""
+    _trace_log["path"] = path
+
+def _write_trace(record: dict):
+    path = _trace_log["path"]
+    if path is None:
+        return
+    line = json.dumps(record, default=str) + "\n"
+    try:
+        with _trace_log_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            if os.path.exists(path) and os.path.getsize(path) > MAX_TRACE_LOG_BYTES:
+                os.replace(path, path + ".1")
+            with open(path, "a") as f:
+                f.write(line)
+    except OSError as e:
+        print(f"Could not write trace: {e}")
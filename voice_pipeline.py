@@ -0,0 +1,475 @@
+import os
+import json
+import time
+import wave
+import queue
+import argparse
+import threading
+from collections import deque
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+# Audio format used throughout the pipeline: 16-bit mono PCM
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+
+# Frame length fed to the VAD and recognizer; webrtcvad accepts 10, 20 or 30 ms
+FRAME_MS = 30
+
+# Voice-activity detectors selectable through VoicePipeline(vad=...)
+VAD_BACKENDS = ("auto", "webrtc", "energy")
+
+# Local Vosk model, downloaded from https://alphacephei.com/vosk/models
+DEFAULT_VOSK_MODEL_DIR = "./models/vosk-model-small-en-us-0.15"
+
+# Vosk models loaded in this process, keyed by model directory
+_vosk_models = {}
+_vosk_models_lock = threading.Lock()
+
+# The process-wide TTS worker
+_tts_worker = None
+_tts_worker_lock = threading.Lock()
+
+
+def frame_size(sample_rate: int = SAMPLE_RATE, frame_ms: int = FRAME_MS):
+    """Number of bytes in one frame of 16-bit mono PCM."""
+    return sample_rate * frame_ms // 1000 * SAMPLE_WIDTH
+
+
+def microphone_frames(sample_rate: int = SAMPLE_RATE, frame_ms: int = FRAME_MS):
+    """
+    Yield PCM frames from the default microphone until the generator is closed.
+
+    Args:
+        sample_rate (int): Sample rate in Hz. Default is 16000.
+        frame_ms (int): Frame length in milliseconds. Default is 30.
+    """
+    import pyaudio
+
+    samples = sample_rate * frame_ms // 1000
+    audio = pyaudio.PyAudio()
+    stream = audio.open(
+        format=pyaudio.paInt16, channels=1, rate=sample_rate, input=True, frames_per_buffer=samples
+    )
+    try:
+        while True:
+            yield stream.read(samples, exception_on_overflow=False)
+    finally:
+        stream.stop_stream()
+        stream.close()
+        audio.terminate()
+
+
+def read_wav(path: str, sample_rate: int = SAMPLE_RATE):
+    """
+    Load a WAV file as 16-bit mono PCM at sample_rate.
+
+    Other sample widths, channel counts and rates are converted: channels are
+    averaged and the signal is linearly resampled.
+
+    Returns:
+        bytes: The PCM data.
+    """
+    with wave.open(path, "rb") as f:
+        width, channels, rate = f.getsampwidth(), f.getnchannels(), f.getframerate()
+        raw = f.readframes(f.getnframes())
+
+    if width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) * 256
+    elif width == 2:
+        samples = np.frombuffer(raw, dtype="<i2").astype(np.float32)
+    elif width == 4:
+        samples = np.frombuffer(raw, dtype="<i4").astype(np.float32) / 65536
+    else:
+        raise ValueError(f"Unsupported WAV sample width: {width} bytes.")
+
+    samples = samples.reshape(-1, channels).mean(axis=1)
+    if rate != sample_rate and len(samples):
+        positions = np.arange(int(len(samples) * sample_rate / rate)) * (rate / sample_rate)
+        samples = np.interp(positions, np.arange(len(samples)), samples)
+    return np.clip(np.round(samples), -32768, 32767).astype("<i2").tobytes()
+
+
+def wav_frames(path: str, sample_rate: int = SAMPLE_RATE, frame_ms: int = FRAME_MS, realtime: bool = False):
+    """
+    Yield PCM frames from a WAV file, so the pipeline can run without a microphone.
+
+    Args:
+        path (str): The WAV file.
+        sample_rate (int): Sample rate in Hz. Default is 16000.
+        frame_ms (int): Frame length in milliseconds. Default is 30.
+        realtime (bool): Pace frames like a live microphone. Default is False (as fast as possible).
+    """
+    pcm = read_wav(path, sample_rate)
+    size = frame_size(sample_rate, frame_ms)
+    start_time = time.perf_counter()
+    # The last partial frame is dropped, since webrtcvad only accepts whole frames
+    for index, start in enumerate(range(0, len(pcm) - size + 1, size)):
+        if realtime:
+            delay = start_time + index * frame_ms / 1000 - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        yield pcm[start:start + size]
+
+
+class EnergyVad:
+    """
+    Voice activity from frame loudness, for when webrtcvad is not installed.
+
+    A frame is speech when its RMS exceeds both `min_rms` and `ratio` times the
+    noise floor, which tracks the loudness of non-speech frames.
+    """
+
+    def __init__(self, ratio: float = 3.0, min_rms: float = 300.0, floor_decay: float = 0.95):
+        self.ratio = ratio
+        self.min_rms = min_rms
+        self.floor_decay = floor_decay
+        self._floor = min_rms / ratio
+
+    def is_speech(self, frame: bytes, sample_rate: int = SAMPLE_RATE):
+        samples = np.frombuffer(frame, dtype="<i2").astype(np.float32)
+        rms = float(np.sqrt(np.mean(samples * samples))) if len(samples) else 0.0
+        speech = rms > max(self.min_rms, self._floor * self.ratio)
+        if not speech:
+            self._floor = self.floor_decay * self._floor + (1 - self.floor_decay) * rms
+        return speech
+
+
+class WebRtcVad:
+    """Voice activity from the WebRTC VAD (webrtcvad package)."""
+
+    def __init__(self, aggressiveness: int = 2):
+        """
+        Args:
+            aggressiveness (int): 0 (least) to 3 (most aggressive at filtering out non-speech).
+        """
+        import webrtcvad
+
+        self._vad = webrtcvad.Vad(aggressiveness)
+
+    def is_speech(self, frame: bytes, sample_rate: int = SAMPLE_RATE):
+        return self._vad.is_speech(frame, sample_rate)
+
+
+def make_vad(backend: str = "auto", aggressiveness: int = 2):
+    """
+    Create a voice-activity detector.
+
+    Args:
+        backend (str): 'webrtc', 'energy', or 'auto' (webrtc if installed, else energy).
+        aggressiveness (int): WebRTC VAD aggressiveness, 0 to 3. Default is 2.
+    """
+    if backend not in VAD_BACKENDS:
+        raise ValueError(f"Invalid VAD backend: {backend}. Expected one of {VAD_BACKENDS}.")
+    if backend in ("auto", "webrtc"):
+        try:
+            return WebRtcVad(aggressiveness)
+        except ImportError:
+            if backend == "webrtc":
+                raise
+            print("webrtcvad is not installed; using the energy VAD.")
+    return EnergyVad()
+
+
+def load_vosk_model(model_dir: str = DEFAULT_VOSK_MODEL_DIR):
+    """Return the Vosk model in model_dir, loading it once per process."""
+    with _vosk_models_lock:
+        model = _vosk_models.get(model_dir)
+        if model is None:
+            if not os.path.isdir(model_dir):
+                raise FileNotFoundError(
+                    f"Vosk model not found at '{model_dir}'. Download one from "
+                    "https://alphacephei.com/vosk/models and unpack it there."
+                )
+            import vosk
+
+            vosk.SetLogLevel(-1)
+            print(f"Loading speech recognition model: {model_dir}")
+            model = _vosk_models[model_dir] = vosk.Model(model_dir)
+        return model
+
+
+class VoskTranscriber:
+    """Local CPU speech-to-text with Vosk, decoding audio as it arrives."""
+
+    def __init__(self, model_dir: str = DEFAULT_VOSK_MODEL_DIR, sample_rate: int = SAMPLE_RATE):
+        """
+        Args:
+            model_dir (str): Directory of an unpacked Vosk model.
+            sample_rate (int): Sample rate of the audio. Default is 16000.
+        """
+        self.model = load_vosk_model(model_dir)
+        self.sample_rate = sample_rate
+
+    def stream(self):
+        """Start transcribing a new utterance."""
+        return _VoskStream(self.model, self.sample_rate)
+
+
+class _VoskStream:
+    def __init__(self, model, sample_rate: int):
+        from vosk import KaldiRecognizer
+
+        self._recognizer = KaldiRecognizer(model, sample_rate)
+        self._final = []
+
+    def accept(self, frame: bytes):
+        """Decode a frame and return the transcript so far."""
+        if self._recognizer.AcceptWaveform(frame):
+            self._final.append(json.loads(self._recognizer.Result()).get("text", ""))
+            partial = ""
+        else:
+            partial = json.loads(self._recognizer.PartialResult()).get("partial", "")
+        return " ".join(t for t in self._final + [partial] if t)
+
+    def finish(self):
+        """Return the final transcript of the utterance."""
+        self._final.append(json.loads(self._recognizer.FinalResult()).get("text", ""))
+        return " ".join(t for t in self._final if t)
+
+
+class VoicePipeline:
+    """
+    Split an audio stream into utterances with a VAD and transcribe each one while it is spoken.
+
+    Frames are fed to the recognizer as soon as speech starts, so only the last
+    moments of audio remain to be decoded when the speaker stops.
+    """
+
+    def __init__(
+        self,
+        transcriber: VoskTranscriber = None,
+        vad: str = "auto",
+        sample_rate: int = SAMPLE_RATE,
+        frame_ms: int = FRAME_MS,
+        start_ms: int = 90,
+        silence_ms: int = 700,
+        pre_roll_ms: int = 300,
+        max_utterance_s: float = 20.0,
+    ):
+        """
+        Args:
+            transcriber (VoskTranscriber): Speech-to-text backend. Default is the default Vosk model.
+            vad (str): 'auto', 'webrtc' or 'energy'. Default is 'auto'.
+            sample_rate (int): Sample rate of the frames. Default is 16000.
+            frame_ms (int): Frame length in milliseconds. Default is 30.
+            start_ms (int): Continuous speech needed to start an utterance. Default is 90.
+            silence_ms (int): Silence that ends an utterance. Default is 700.
+            pre_roll_ms (int): Audio before the detected start that is also transcribed,
+                so the first syllable is not cut off. Default is 300.
+            max_utterance_s (float): Utterances are cut after this many seconds. Default is 20.
+        """
+        self.transcriber = transcriber or VoskTranscriber(sample_rate=sample_rate)
+        self.vad = make_vad(vad)
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+        self.start_frames = max(1, start_ms // frame_ms)
+        self.silence_frames = max(1, silence_ms // frame_ms)
+        self.pre_roll_frames = max(self.start_frames, pre_roll_ms // frame_ms)
+        self.max_frames = int(max_utterance_s * 1000 // frame_ms)
+
+    def utterances(self, frames: Iterable[bytes], on_partial: Optional[Callable[[str], None]] = None):
+        """
+        Yield one result per utterance in the audio stream.
+
+        Args:
+            frames (Iterable[bytes]): PCM frames, e.g. from `microphone_frames` or `wav_frames`.
+            on_partial (callable): Called with the transcript so far whenever it changes.
+
+        Yields:
+            dict: 'text', 'start_s' and 'end_s' (position in the stream), and 'finalize_ms',
+                the time from the end of the audio to the final transcript.
+        """
+        pre_roll = deque(maxlen=self.pre_roll_frames)
+        stream, voiced, silent, length, start_index, partial = None, 0, 0, 0, 0, ""
+        index = -1
+        for index, frame in enumerate(frames):
+            speech = self.vad.is_speech(frame, self.sample_rate)
+            if stream is None:
+                pre_roll.append(frame)
+                voiced = voiced + 1 if speech else 0
+                if voiced < self.start_frames:
+                    continue
+                stream, silent, partial = self.transcriber.stream(), 0, ""
+                start_index, length = index - len(pre_roll) + 1, len(pre_roll)
+                for buffered in pre_roll:
+                    stream.accept(buffered)
+                pre_roll.clear()
+                continue
+
+            text = stream.accept(frame)
+            if on_partial is not None and text != partial:
+                on_partial(text)
+            partial = text
+            length += 1
+            silent = 0 if speech else silent + 1
+            if silent >= self.silence_frames or length >= self.max_frames:
+                yield self._finish(stream, start_index, index + 1)
+                stream, voiced = None, 0
+
+        if stream is not None:
+            yield self._finish(stream, start_index, index + 1)
+
+    def _finish(self, stream: _VoskStream, start_index: int, end_index: int):
+        start = time.perf_counter()
+        text = stream.finish()
+        return {
+            "text": text,
+            "start_s": round(start_index * self.frame_ms / 1000, 3),
+            "end_s": round(end_index * self.frame_ms / 1000, 3),
+            "finalize_ms": round((time.perf_counter() - start) * 1000, 2),
+        }
+
+    def listen_once(self, frames: Iterable[bytes], on_partial: Optional[Callable[[str], None]] = None):
+        """
+        Return the first utterance with any recognized words, then stop reading frames.
+
+        Returns:
+            dict: The utterance (see `utterances`), or None if the stream ended first.
+        """
+        utterances = self.utterances(frames, on_partial=on_partial)
+        try:
+            for utterance in utterances:
+                if utterance["text"]:
+                    return utterance
+            return None
+        finally:
+            utterances.close()
+            # Release the microphone
+            if hasattr(frames, "close"):
+                frames.close()
+
+
+class TTSWorker:
+    """
+    One long-lived pyttsx3 engine on its own thread, speaking queued sentences in order.
+
+    The engine is created and its voice chosen once; pyttsx3 engines must be used
+    from the thread that created them, so every call goes through the queue.
+    """
+
+    def __init__(self, voice_keywords=("female", "woman"), rate: int = None):
+        """
+        Args:
+            voice_keywords (tuple): The first voice whose name contains one of these is used;
+                otherwise the first voice. Default is ('female', 'woman').
+            rate (int): Speech rate in words per minute. Default is the engine's.
+        """
+        self.voice_keywords = voice_keywords
+        self.rate = rate
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="tts", daemon=True)
+        self._thread.start()
+
+    def _init_engine(self):
+        import pyttsx3
+
+        engine = pyttsx3.init()
+        voices = engine.getProperty("voices")
+        for voice in voices:
+            if any(keyword in voice.name.lower() for keyword in self.voice_keywords):
+                engine.setProperty("voice", voice.id)
+                break
+        else:
+            if voices:
+                engine.setProperty("voice", voices[0].id)
+        if self.rate is not None:
+            engine.setProperty("rate", self.rate)
+        return engine
+
+    def _run(self):
+        try:
+            engine = self._init_engine()
+        except Exception as e:
+            # Keep draining the queue so callers waiting in flush() are released
+            print(f"Could not start text-to-speech: {e}")
+            engine = None
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            if engine is None:
+                continue
+            try:
+                engine.say(item)
+                engine.runAndWait()
+            except Exception as e:
+                print(f"Text-to-speech error: {e}")
+
+    def speak(self, sentence: str):
+        """Queue a sentence for speech and return immediately."""
+        self._queue.put(sentence)
+
+    def flush(self, timeout: float = None):
+        """Wait until every sentence queued so far has been spoken."""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        """Stop the worker after the queued sentences."""
+        self._queue.put(None)
+        self._thread.join()
+
+
+def get_tts_worker():
+    """Return the process-wide TTS worker, starting it on first use."""
+    global _tts_worker
+    with _tts_worker_lock:
+        if _tts_worker is None:
+            _tts_worker = TTSWorker()
+        return _tts_worker
+
+
+def transcribe_wav(path: str, model_dir: str = DEFAULT_VOSK_MODEL_DIR, vad: str = "auto", realtime: bool = False):
+    """
+    Transcribe every utterance in a WAV file and measure the pipeline's speed.
+
+    Returns:
+        dict: 'utterances', 'audio_s', 'seconds' and 'realtime_factor' (processing time / audio time).
+    """
+    pipeline = VoicePipeline(VoskTranscriber(model_dir), vad=vad)
+    start = time.perf_counter()
+    frames = 0
+
+    def counted(source):
+        nonlocal frames
+        for frame in source:
+            frames += 1
+            yield frame
+
+    utterances = list(pipeline.utterances(counted(wav_frames(path, realtime=realtime))))
+    seconds = time.perf_counter() - start
+    audio_s = frames * pipeline.frame_ms / 1000
+    return {
+        "utterances": utterances,
+        "audio_s": round(audio_s, 3),
+        "seconds": round(seconds, 3),
+        "realtime_factor": round(seconds / audio_s, 4) if audio_s else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline voice pipeline: transcribe a WAV file or speak text.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    transcribe = subparsers.add_parser("transcribe", help="Transcribe a WAV file and report timings.")
+    transcribe.add_argument("wav")
+    transcribe.add_argument("--model-dir", default=DEFAULT_VOSK_MODEL_DIR)
+    transcribe.add_argument("--vad", default="auto", choices=VAD_BACKENDS)
+    transcribe.add_argument("--realtime", action="store_true", help="Feed frames at microphone speed.")
+
+    speak = subparsers.add_parser("speak", help="Speak text with the TTS worker.")
+    speak.add_argument("text")
+
+    args = parser.parse_args()
+    if args.command == "transcribe":
+        print(json.dumps(transcribe_wav(args.wav, args.model_dir, vad=args.vad, realtime=args.realtime), indent=2))
+    else:
+        worker = get_tts_worker()
+        worker.speak(args.text)
+        worker.close()
@@ -1,58 +1,102 @@
-import os
-import speech_recognition as sr
-import pyttsx3
-from chat import initialize_query_engine
-import pyaudio
-
-def recognize_audio():
-    """Converts audio input into text using SpeechRecognition."""
-    recognizer = sr.Recognizer()
-    with sr.Microphone() as source:
-        print("Listening...")
-        audio = recognizer.listen(source)
-        try:
-            print("Processing audio...")
-            return recognizer.recognize_google(audio)
-        except sr.UnknownValueError:
-            return "Sorry, I couldn't understand that."
-        except sr.RequestError as e:
-            return f"Error with STT service: {e}"
+import re
+from engine_registry import get_query_engine, load_engine_options
+from chat import iter_response_text
+from voice_pipeline import VoicePipeline, get_tts_worker, microphone_frames, wav_frames
+
+def recognize_audio(wav_path: str = None):
+    """
+    Transcribe one utterance locally with voice-activity detection and Vosk.
+
+    Args:
+        wav_path (str): Read the audio from this WAV file instead of the microphone.
+
+    Returns:
+        str: The recognized text, or an empty string if nothing was understood.
+    """
+    pipeline = VoicePipeline()
+    frames = wav_frames(wav_path) if wav_path else microphone_frames()
+    print("Listening...")
+    utterance = pipeline.listen_once(frames, on_partial=lambda text: print(f"Heard: {text}", end="\r"))
+    print()
+    return utterance["text"] if utterance else ""
+
+# A sentence ends at ., ! or ? followed by whitespace
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
 
 def speak_text(text):
-    """Converts text into audio using pyttsx3 with a customizable voice."""
-    engine = pyttsx3.init()
+    """Speak text with the shared TTS engine and wait until it has been spoken."""
+    worker = get_tts_worker()
+    worker.speak(text)
+    worker.flush()
 
-    # Get available voices
-    voices = engine.getProperty('voices')
+class SentenceSpeaker:
+    """
+    Speaks sentences on the shared TTS thread while the answer is still being generated.
 
-    # Select a female voice
-    for voice in voices:
-        if "female" in voice.name.lower() or "woman" in voice.name.lower():
-            engine.setProperty('voice', voice.id)
-            break
-    else:
-        # Fallback to the first voice if no female voice is found
-        engine.setProperty('voice', voices[0].id)
+    Use `tee` to pass streamed chunks through (e.g. to a UI) while every completed
+    sentence is queued for speech, then `close` to wait until speaking has finished.
+    """
+
+    def __init__(self):
+        self._worker = get_tts_worker()
+
+    def speak(self, sentence: str):
+        """Queue a sentence for speech."""
+        self._worker.speak(sentence)
+
+    def tee(self, chunks):
+        """Yield chunks unchanged and queue each sentence as soon as it is complete."""
+        buffer = ""
+        for chunk in chunks:
+            yield chunk
+            buffer += chunk
+            *sentences, buffer = SENTENCE_END.split(buffer)
+            for sentence in sentences:
+                if sentence.strip():
+                    self.speak(sentence.strip())
+        if buffer.strip():
+            self.speak(buffer.strip())
+
+    def close(self):
+        """Wait until every queued sentence has been spoken."""
+        self._worker.flush()
+
+def speak_stream(chunks):
+    """
+    Speak streamed text sentence by sentence, starting as soon as the first sentence is complete.
+
+    Args:
+        chunks (iterable): Text pieces, e.g. from `iter_response_text`.
 
-    engine.say(text)
-    engine.runAndWait()
+    Returns:
+        str: The full text that was spoken.
+    """
+    speaker = SentenceSpeaker()
+    try:
+        return "".join(speaker.tee(chunks))
+    finally:
+        speaker.close()
 
 
 
 def voicebot(user_id:str):
-    query_engine = initialize_query_engine(user_id)
     while True:
         print("Say something or 'exit' to quit:")
         user_query = recognize_audio()
+        if not user_query:
+            continue
         if user_query.lower() == "exit":
             print("Exiting voice bot.")
             speak_text("Goodbye!")
             break
         
         print(f"Query: {user_query}")
+        # Fetched per query, like app.py and main.py, to pick up newly published indices
+        query_engine = get_query_engine(user_id, **load_engine_options(user_id, streaming=True))
         response = query_engine.query(user_query)
-        print(f"Response: {response.response}")
-        speak_text(response.response)
+        # Start speaking at the first complete sentence instead of waiting for the whole answer
+        response_text = speak_stream(iter_response_text(response))
+        print(f"Response: {response_text}")
 
 if __name__ == "__main__":
     voicebot("admin")
\ No newline at end of file